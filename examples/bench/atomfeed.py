@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+# Namespaced output benchmark
+#
+# Objective: Serialize an Atom feed with 10000 entries, each of which has
+# XHTML content that declares its own namespace.
+
+import sys
+import timeit
+from genshi.core import Stream
+from genshi.template import MarkupTemplate
+
+entries = [dict(id='urn:uuid:%d' % x, title='Entry %d' % x,
+                updated='2010-06-%02dT12:00:00Z' % (x % 28 + 1),
+                author='author%d' % (x % 10),
+                text='The text of entry %d.' % x)
+           for x in range(10000)]
+
+genshi_tmpl = MarkupTemplate("""
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:py="http://genshi.edgewall.org/">
+  <title>Feed</title>
+  <updated>2010-06-28T12:00:00Z</updated>
+  <entry py:for="entry in entries">
+    <id>${entry.id}</id>
+    <title>${entry.title}</title>
+    <updated>${entry.updated}</updated>
+    <author><name>${entry.author}</name></author>
+    <link rel="alternate" href="/entries/${entry.id}"/>
+    <content type="xhtml">
+      <div xmlns="http://www.w3.org/1999/xhtml">
+        <p class="text">${entry.text}</p>
+      </div>
+    </content>
+  </entry>
+</feed>
+""")
+
+events = Stream(list(genshi_tmpl.generate(entries=entries)))
+
+def test_serialize():
+    """Serialize the feed"""
+    events.render('xml')
+
+def test_serialize_nocache():
+    """Serialize the feed without caching"""
+    events.render('xml', cache=False)
+
+def test_serialize_fused():
+    """Serialize the feed in a single loop"""
+    events.render('xml', fused=True)
+
+def test_genshi():
+    """Genshi template"""
+    genshi_tmpl.generate(entries=entries).render('xml')
+
+
+def run(which=None, number=10):
+    tests = ['test_serialize', 'test_serialize_nocache',
+             'test_serialize_fused', 'test_genshi']
+
+    if which:
+        tests = filter(lambda n: n[5:] in which, tests)
+
+    for test in [t for t in tests if hasattr(sys.modules[__name__], t)]:
+        t = timeit.Timer(setup='from __main__ import %s;' % test,
+                         stmt='%s()' % test)
+        time = min(t.repeat(repeat=3, number=number)) / number
+        print '%-40s %16.2f ms' % (getattr(sys.modules[__name__],
+                                           test).__doc__, 1000 * time)
+
+
+if __name__ == '__main__':
+    which = [arg for arg in sys.argv[1:] if arg[0] != '-']
+
+    if '-p' in sys.argv:
+        import cProfile, pstats
+        prof = cProfile.Profile()
+        prof.run('run(%r, number=1)' % which)
+        stats = pstats.Stats(prof)
+        stats.strip_dirs()
+        stats.sort_stats('time', 'calls')
+        stats.print_stats(25)
+    else:
+        run(which)
@@ -9,8 +9,8 @@ from StringIO import StringIO
 import sys
 import timeit
 
-__all__ = ['clearsilver', 'mako', 'django', 'kid', 'genshi', 'genshi_text',
-           'simpletal']
+__all__ = ['clearsilver', 'mako', 'django', 'kid', 'genshi', 'genshi_nested',
+           'genshi_text', 'simpletal']
 
 def genshi(dirname, verbose=False):
     from genshi.template import TemplateLoader
@@ -25,6 +25,26 @@ def genshi(dirname, verbose=False):
         print render()
     return render
 
+def genshi_nested(dirname, verbose=False, depth=24):
+    # Variable lookups from deeply nested scopes
+    from genshi.template import MarkupTemplate
+    source = '<table xmlns:py="http://genshi.edgewall.org/">'
+    for level in range(depth):
+        source += '<py:with vars="v%d = %d">' % (level, level)
+    source += """<tr py:for="idx, item in enumerate(items)">
+      <td py:for="col in range(4)">$title $user $idx ${item[col]} $v0</td>
+    </tr>"""
+    source += '</py:with>' * depth + '</table>'
+    template = MarkupTemplate(source)
+    def render():
+        data = dict(title='Just a test', user='joe',
+                    items=['Number %d' % num for num in range(1, 15)])
+        return template.generate(**data).render('xhtml')
+
+    if verbose:
+        print render()
+    return render
+
 def genshi_text(dirname, verbose=False):
     from genshi.core import escape
     from genshi.template import TemplateLoader, NewTextTemplate
@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+# Template memory benchmark
+#
+# Objective: Measure the memory held by loaded and rendered templates, with
+# and without keeping the ASTs of their expressions
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+__all__ = ['keep_ast', 'discard_ast']
+
+TEMPLATE = """<html xmlns:py="http://genshi.edgewall.org/">
+  <head><title>${title} %(num)d</title></head>
+  <body>
+    <div py:for="idx, item in enumerate(items_%(num)d)"
+         class="${idx %% 2 and 'odd' or 'even'} item-%(num)d">
+      <h2 py:if="item.title">${item.title.strip().capitalize()}</h2>
+      <p py:choose="">
+        <span py:when="item.count > %(num)d">${item.count * 2} (many)</span>
+        <span py:otherwise="">${'%%d of %%d' %% (item.count, len(items_%(num)d))}</span>
+      </p>
+      <a href="${url('item', id=item.id, page=%(num)d)}">${item.link_text}</a>
+      <ul py:with="tags = sorted(item.tags, key=lambda t: t.lower())">
+        <li py:for="tag in tags" title="${tag.upper()}">${tag} %(num)d</li>
+      </ul>
+    </div>
+    <p py:if="not items_%(num)d">${_('No items found on page %%d') %% %(num)d}</p>
+  </body>
+</html>
+"""
+
+def _rss():
+    """Return the resident set size of this process in kilobytes."""
+    try:
+        fileobj = open('/proc/self/statm')
+        try:
+            pages = int(fileobj.read().split()[1])
+        finally:
+            fileobj.close()
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024.
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _render(tmpl, num):
+    data = {'title': 'Just a test', '_': lambda s: s, 'items_%d' % num: []}
+    return tmpl.generate(**data).render('html')
+
+def _measure(dirname, count, keep_ast):
+    import gc
+    from genshi.template import TemplateLoader
+    loader = TemplateLoader([dirname], max_cache_size=count,
+                            keep_ast=keep_ast)
+    # Render one template first, so that modules and caches are in place
+    _render(loader.load('warmup.html'), 0)
+    gc.collect()
+    before_rss, before_objs = _rss(), len(gc.get_objects())
+    for num in range(count):
+        _render(loader.load('tmpl%d.html' % num), num)
+    gc.collect()
+    return (_rss() - before_rss) / count, \
+           float(len(gc.get_objects()) - before_objs) / count
+
+def keep_ast(dirname, count):
+    return _measure(dirname, count, True)
+
+def discard_ast(dirname, count):
+    return _measure(dirname, count, False)
+
+def run(modes, count=200):
+    dirname = tempfile.mkdtemp(prefix='genshi_bench')
+    try:
+        for num in range(count):
+            fileobj = open(os.path.join(dirname, 'tmpl%d.html' % num), 'w')
+            try:
+                fileobj.write(TEMPLATE % {'num': num})
+            finally:
+                fileobj.close()
+        shutil.copy(os.path.join(dirname, 'tmpl0.html'),
+                    os.path.join(dirname, 'warmup.html'))
+        for mode in modes:
+            # Every mode is measured in a fresh interpreter, so that the
+            # measurements don't affect each other
+            output = subprocess.Popen(
+                [sys.executable, __file__, '--measure', mode, dirname,
+                 str(count)], stdout=subprocess.PIPE
+            ).communicate()[0]
+            kbytes, objects = [float(value) for value in output.split()]
+            print '%s: %.1f KB, %d objects per template' % (mode, kbytes,
+                                                             objects)
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    if '--measure' in sys.argv:
+        mode, dirname, count = sys.argv[sys.argv.index('--measure') + 1:]
+        print '%f %f' % globals()[mode](dirname, int(count))
+        sys.exit(0)
+
+    modes = [arg for arg in sys.argv[1:] if arg[0] != '-']
+    if not modes:
+        modes = __all__
+
+    run(modes)
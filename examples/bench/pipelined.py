@@ -0,0 +1,105 @@
+# -*- encoding: utf-8 -*-
+# Pipelined output benchmark
+#
+# Objective: Render a big table to a socket, with the template running either
+# in the thread that writes to the socket, or in a separate thread that feeds
+# the writing thread through a queue.
+
+import socket
+import sys
+import threading
+import time
+import timeit
+from genshi.template import MarkupTemplate
+
+table = [dict(a=1,b=2,c=3,d=4,e=5,f=6,g=7,h=8,i=9,j=10)
+          for x in range(1000)]
+
+genshi_tmpl = MarkupTemplate("""
+<table xmlns:py="http://genshi.edgewall.org/">
+<tr py:for="row in table">
+<td py:for="c in row.values()" py:content="c"/>
+</tr>
+</table>
+""")
+
+class SocketOutput(object):
+    """Writes to a socket, the other end of which is read by a separate thread
+    that acts as the client, optionally waiting a while after every read like
+    a client on a slow network would."""
+
+    def __init__(self, delay=0, recv_size=16384):
+        self.sock, peer = socket.socketpair()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, recv_size)
+        def _read():
+            while peer.recv(recv_size):
+                if delay:
+                    time.sleep(delay)
+            peer.close()
+        self.reader = threading.Thread(target=_read)
+        self.reader.start()
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+        self.reader.join()
+
+def test_render_out():
+    """Render to a socket"""
+    out = SocketOutput()
+    genshi_tmpl.generate(table=table).render('html', encoding='utf-8',
+                                             out=out)
+    out.close()
+
+def test_render_out_queued():
+    """Render to a socket from a thread"""
+    out = SocketOutput()
+    genshi_tmpl.generate(table=table).render('html', encoding='utf-8',
+                                             out=out, queue_size=4)
+    out.close()
+
+def test_render_slow():
+    """Render to a slow client"""
+    out = SocketOutput(delay=0.002)
+    genshi_tmpl.generate(table=table).render('html', encoding='utf-8',
+                                             out=out)
+    out.close()
+
+def test_render_slow_queued():
+    """Render to a slow client from a thread"""
+    out = SocketOutput(delay=0.002)
+    genshi_tmpl.generate(table=table).render('html', encoding='utf-8',
+                                             out=out, queue_size=4)
+    out.close()
+
+
+def run(which=None, number=10):
+    tests = ['test_render_out', 'test_render_out_queued',
+             'test_render_slow', 'test_render_slow_queued']
+
+    if which:
+        tests = filter(lambda n: n[5:] in which, tests)
+
+    for test in [t for t in tests if hasattr(sys.modules[__name__], t)]:
+        t = timeit.Timer(setup='from __main__ import %s;' % test,
+                         stmt='%s()' % test)
+        time = min(t.repeat(repeat=3, number=number)) / number
+        print '%-40s %16.2f ms' % (getattr(sys.modules[__name__],
+                                           test).__doc__, 1000 * time)
+
+
+if __name__ == '__main__':
+    which = [arg for arg in sys.argv[1:] if arg[0] != '-']
+
+    if '-p' in sys.argv:
+        import cProfile, pstats
+        prof = cProfile.Profile()
+        prof.run('run(%r, number=1)' % which)
+        stats = pstats.Stats(prof)
+        stats.strip_dirs()
+        stats.sort_stats('time', 'calls')
+        stats.print_stats(25)
+    else:
+        run(which)
@@ -25,6 +25,8 @@
 /* We only use Unicode Strings in this module */
 #ifndef IS_PY3K
 #   define PyObject_Str PyObject_Unicode
+#else
+#   define PyString_InternFromString PyUnicode_InternFromString
 #endif
 
 static PyObject *amp1, *amp2, *lt1, *lt2, *gt1, *gt2, *qt1, *qt2;
@@ -653,13 +655,1426 @@ PyTypeObject MarkupType = {
     0           /*tp_weaklist*/
 };
 
+/* Serializer loop */
+
+enum { METHOD_XML, METHOD_XHTML, METHOD_HTML };
+
+enum { K_START, K_EMPTY, K_END, K_TEXT, K_COMMENT, K_PI, K_XML_DECL,
+       K_DOCTYPE, K_START_CDATA, K_END_CDATA, K_FLUSH, K_COUNT };
+
+static PyObject *kinds[K_COUNT];
+/* The output for FLUSH events, without and with an encoding */
+static PyObject *flush_marker, *encoded_flush_marker;
+static PyObject *empty, *space, *eqqt, *slashgt, *spaceslashgt, *langeqqt,
+                *colon, *xmllang, *xmlspace, *lang, *xmlns, *endfmt,
+                *closefmt, *commentfmt, *pifmt, *cdatastart, *cdataend,
+                *declfmt, *encodingfmt, *standalonefmt, *yes, *no, *declend,
+                *doctypefmt, *publicfmt, *systemfmt, *sysidfmt, *gtnl,
+                *get_str, *set_str;
+
+static void
+init_serializer_constants(void)
+{
+    empty = PyUnicode_DecodeASCII("", 0, NULL);
+    space = PyUnicode_DecodeASCII(" ", 1, NULL);
+    eqqt = PyUnicode_DecodeASCII("=\"", 2, NULL);
+    slashgt = PyUnicode_DecodeASCII("/>", 2, NULL);
+    spaceslashgt = PyUnicode_DecodeASCII(" />", 3, NULL);
+    langeqqt = PyUnicode_DecodeASCII(" lang=\"", 7, NULL);
+    colon = PyUnicode_DecodeASCII(":", 1, NULL);
+    xmllang = PyUnicode_DecodeASCII("xml:lang", 8, NULL);
+    xmlspace = PyUnicode_DecodeASCII("xml:space", 9, NULL);
+    lang = PyUnicode_DecodeASCII("lang", 4, NULL);
+    xmlns = PyUnicode_DecodeASCII("xmlns", 5, NULL);
+    endfmt = PyUnicode_DecodeASCII("</%s>", 5, NULL);
+    closefmt = PyUnicode_DecodeASCII("></%s>", 6, NULL);
+    commentfmt = PyUnicode_DecodeASCII("<!--%s-->", 9, NULL);
+    pifmt = PyUnicode_DecodeASCII("<?%s %s?>", 9, NULL);
+    cdatastart = PyUnicode_DecodeASCII("<![CDATA[", 9, NULL);
+    cdataend = PyUnicode_DecodeASCII("]]>", 3, NULL);
+    declfmt = PyUnicode_DecodeASCII("<?xml version=\"%s\"", 18, NULL);
+    encodingfmt = PyUnicode_DecodeASCII(" encoding=\"%s\"", 14, NULL);
+    standalonefmt = PyUnicode_DecodeASCII(" standalone=\"%s\"", 16, NULL);
+    yes = PyUnicode_DecodeASCII("yes", 3, NULL);
+    no = PyUnicode_DecodeASCII("no", 2, NULL);
+    declend = PyUnicode_DecodeASCII("?>\n", 3, NULL);
+    doctypefmt = PyUnicode_DecodeASCII("<!DOCTYPE %s", 12, NULL);
+    publicfmt = PyUnicode_DecodeASCII(" PUBLIC \"%s\"", 12, NULL);
+    systemfmt = PyUnicode_DecodeASCII(" SYSTEM", 7, NULL);
+    sysidfmt = PyUnicode_DecodeASCII(" \"%s\"", 5, NULL);
+    gtnl = PyUnicode_DecodeASCII(">\n", 2, NULL);
+    get_str = PyString_InternFromString("get");
+    set_str = PyString_InternFromString("set");
+}
+
+/* The event kinds are looked up on first use, as genshi.output imports this
+   module */
+static int
+init_kinds(void)
+{
+    static const char *names[K_COUNT] = {
+        "START", "EMPTY", "END", "TEXT", "COMMENT", "PI", "XML_DECL",
+        "DOCTYPE", "START_CDATA", "END_CDATA", "FLUSH"
+    };
+    PyObject *module;
+    int i;
+
+    if (encoded_flush_marker != NULL)
+        return 0;
+    module = PyImport_ImportModule("genshi.output");
+    if (module == NULL)
+        return -1;
+    for (i = 0; i < K_COUNT; i++) {
+        if (kinds[i] == NULL) {
+            kinds[i] = PyObject_GetAttrString(module, names[i]);
+            if (kinds[i] == NULL) {
+                Py_DECREF(module);
+                return -1;
+            }
+        }
+    }
+    if (flush_marker == NULL)
+        flush_marker = PyObject_GetAttrString(module, "_FLUSH");
+    if (flush_marker != NULL)
+        encoded_flush_marker = PyObject_GetAttrString(module,
+                                                      "_FLUSH_ENCODED");
+    Py_DECREF(module);
+    return encoded_flush_marker == NULL ? -1 : 0;
+}
+
+/* Create a Markup instance from a string, stealing the reference */
+static PyObject *
+markup(PyObject *text)
+{
+    PyObject *args, *ret;
+
+    if (text == NULL)
+        return NULL;
+    args = PyTuple_New(1);
+    if (args == NULL) {
+        Py_DECREF(text);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(args, 0, text);
+    ret = MarkupType.tp_new(&MarkupType, args, NULL);
+    Py_DECREF(args);
+    return ret;
+}
+
+/* Same as Markup.escape(text, quotes) */
+static PyObject *
+escape_value(PyObject *text, int quotes)
+{
+    int isfalse = PyObject_Not(text);
+
+    if (isfalse < 0)
+        return NULL;
+    if (isfalse)
+        return markup(PyUnicode_FromUnicode(NULL, 0));
+    return escape(text, quotes);
+}
+
+/* Same as format % (arg,) */
+static PyObject *
+format1(PyObject *format, PyObject *arg)
+{
+    PyObject *args, *ret;
+
+    args = PyTuple_Pack(1, arg);
+    if (args == NULL)
+        return NULL;
+    ret = PyUnicode_Format(format, args);
+    Py_DECREF(args);
+    return ret;
+}
+
+/* Append an object to a list, stealing the reference */
+static int
+append(PyObject *list, PyObject *item)
+{
+    int ret;
+
+    if (item == NULL)
+        return -1;
+    ret = PyList_Append(list, item);
+    Py_DECREF(item);
+    return ret;
+}
+
+/* Unpack a sequence of exactly n items into new references */
+static int
+unpack(PyObject *seq, Py_ssize_t n, PyObject **items)
+{
+    PyObject *fast;
+    Py_ssize_t i, size;
+
+    fast = PySequence_Fast(seq, "need a sequence to unpack");
+    if (fast == NULL)
+        return -1;
+    size = PySequence_Fast_GET_SIZE(fast);
+    if (size != n) {
+        if (size > n)
+            PyErr_SetString(PyExc_ValueError, "too many values to unpack");
+        else
+            PyErr_Format(PyExc_ValueError, "need more than %d value%s to "
+                         "unpack", (int) size, size == 1 ? "" : "s");
+        Py_DECREF(fast);
+        return -1;
+    }
+    for (i = 0; i < n; i++) {
+        items[i] = PySequence_Fast_GET_ITEM(fast, i);
+        Py_INCREF(items[i]);
+    }
+    Py_DECREF(fast);
+    return 0;
+}
+
+static int
+contains(PyObject *container, PyObject *item)
+{
+    if (container == NULL || container == Py_None)
+        return 0;
+    return PySequence_Contains(container, item);
+}
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *stream;
+    PyObject *cache;
+    PyObject *shared_cache; /* a SerializationCache for the output of tags */
+    PyObject *cache_key;
+    Py_ssize_t cache_size; /* size limit of the cache if a shared one is used */
+    PyObject *boolean_attrs;
+    PyObject *empty_elems;
+    PyObject *noescape_elems;
+    char *encoding; /* the encoding of the output, or NULL for Markup */
+    int method;
+    int drop_xml_decl;
+    int have_decl;
+    int have_doctype;
+    int noescape; /* inside a CDATA section, or an HTML script/style element */
+    int flush; /* whether a FLUSH event ended the last batch of output */
+} SerializerObject;
+
+static int
+serialize_attr(PyObject *buf, PyObject *name, PyObject *value)
+{
+    if (PyList_Append(buf, space) < 0 || PyList_Append(buf, name) < 0 ||
+            PyList_Append(buf, eqqt) < 0 ||
+            append(buf, escape_value(value, 1)) < 0 ||
+            PyList_Append(buf, qt1) < 0)
+        return -1;
+    return 0;
+}
+
+static int
+serialize_lang(PyObject *buf, PyObject *attrib, PyObject *value)
+{
+    int has_lang = PySequence_Contains(attrib, lang);
+
+    if (has_lang < 0)
+        return -1;
+    if (!has_lang) {
+        if (PyList_Append(buf, langeqqt) < 0 ||
+                append(buf, escape_value(value, 1)) < 0 ||
+                PyList_Append(buf, qt1) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+static int
+serialize_attrs(SerializerObject *self, PyObject *buf, PyObject *attrib)
+{
+    PyObject *iter, *item, *attr[2];
+    int ret = 0, cmp;
+
+    iter = PyObject_GetIter(attrib);
+    if (iter == NULL)
+        return -1;
+    while (ret == 0 && (item = PyIter_Next(iter)) != NULL) {
+        ret = unpack(item, 2, attr);
+        Py_DECREF(item);
+        if (ret < 0)
+            break;
+
+        if (self->method == METHOD_XML) {
+            ret = serialize_attr(buf, attr[0], attr[1]);
+
+        } else if (self->method == METHOD_XHTML) {
+            cmp = contains(self->boolean_attrs, attr[0]);
+            if (cmp > 0) {
+                ret = serialize_attr(buf, attr[0], attr[0]);
+            } else if (cmp == 0) {
+                cmp = PyObject_RichCompareBool(attr[0], xmllang, Py_EQ);
+                if (cmp > 0) {
+                    /* xml:lang is kept, and copied to lang */
+                    ret = serialize_lang(buf, attrib, attr[1]);
+                    cmp = 0;
+                } else if (cmp == 0) {
+                    cmp = PyObject_RichCompareBool(attr[0], xmlspace, Py_EQ);
+                }
+                if (cmp == 0 && ret == 0)
+                    ret = serialize_attr(buf, attr[0], attr[1]);
+            }
+            if (cmp < 0)
+                ret = -1;
+
+        } else {
+            cmp = contains(self->boolean_attrs, attr[0]);
+            if (cmp > 0) {
+                cmp = PyObject_IsTrue(attr[1]);
+                if (cmp > 0 && (PyList_Append(buf, space) < 0 ||
+                                PyList_Append(buf, attr[0]) < 0))
+                    ret = -1;
+            } else if (cmp == 0) {
+                cmp = PySequence_Contains(attr[0], colon);
+                if (cmp > 0) {
+                    cmp = PyObject_RichCompareBool(attr[0], xmllang, Py_EQ);
+                    if (cmp > 0)
+                        ret = serialize_lang(buf, attrib, attr[1]);
+                } else if (cmp == 0) {
+                    cmp = PyObject_RichCompareBool(attr[0], xmlns, Py_NE);
+                    if (cmp > 0)
+                        ret = serialize_attr(buf, attr[0], attr[1]);
+                }
+            }
+            if (cmp < 0)
+                ret = -1;
+        }
+
+        Py_DECREF(attr[0]);
+        Py_DECREF(attr[1]);
+    }
+    Py_DECREF(iter);
+    if (ret == 0 && PyErr_Occurred())
+        ret = -1;
+    return ret;
+}
+
+static PyObject *
+serialize_start(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    PyObject *buf, *ret = NULL, *item[2];
+    int cmp;
+
+    if (unpack(data, 2, item) < 0)
+        return NULL;
+    buf = PyList_New(0);
+    if (buf == NULL)
+        goto done;
+    if (PyList_Append(buf, lt1) < 0 || PyList_Append(buf, item[0]) < 0 ||
+            serialize_attrs(self, buf, item[1]) < 0)
+        goto done;
+
+    if (self->method == METHOD_XML) {
+        if (PyList_Append(buf, kind == kinds[K_EMPTY] ? slashgt : gt1) < 0)
+            goto done;
+    } else if (self->method == METHOD_XHTML) {
+        if (kind == kinds[K_EMPTY]) {
+            cmp = contains(self->empty_elems, item[0]);
+            if (cmp < 0)
+                goto done;
+            if (cmp) {
+                if (PyList_Append(buf, spaceslashgt) < 0)
+                    goto done;
+            } else if (append(buf, format1(closefmt, item[0])) < 0) {
+                goto done;
+            }
+        } else if (PyList_Append(buf, gt1) < 0) {
+            goto done;
+        }
+    } else {
+        if (PyList_Append(buf, gt1) < 0)
+            goto done;
+        if (kind == kinds[K_EMPTY]) {
+            cmp = contains(self->empty_elems, item[0]);
+            if (cmp < 0)
+                goto done;
+            if (!cmp && append(buf, format1(endfmt, item[0])) < 0)
+                goto done;
+        }
+    }
+
+    ret = markup(PyUnicode_Join(empty, buf));
+    if (ret != NULL && self->method == METHOD_HTML) {
+        cmp = contains(self->noescape_elems, item[0]);
+        if (cmp < 0) {
+            Py_CLEAR(ret);
+        } else if (cmp) {
+            self->noescape = 1;
+        }
+    }
+
+done:
+    Py_XDECREF(buf);
+    Py_DECREF(item[0]);
+    Py_DECREF(item[1]);
+    return ret;
+}
+
+static PyObject *
+serialize_xml_decl(PyObject *data)
+{
+    PyObject *buf, *item[3], *ret = NULL;
+    int cmp;
+
+    if (unpack(data, 3, item) < 0)
+        return NULL;
+    buf = PyList_New(0);
+    if (buf == NULL)
+        goto done;
+    if (append(buf, format1(declfmt, item[0])) < 0)
+        goto done;
+    cmp = PyObject_IsTrue(item[1]);
+    if (cmp < 0 || (cmp && append(buf, format1(encodingfmt, item[1])) < 0))
+        goto done;
+    if (!PyInt_Check(item[2]) || PyInt_AS_LONG(item[2]) != -1) {
+        cmp = PyObject_IsTrue(item[2]);
+        if (cmp < 0 || append(buf, format1(standalonefmt, cmp ? yes : no)) < 0)
+            goto done;
+    }
+    if (PyList_Append(buf, declend) < 0)
+        goto done;
+    ret = markup(PyUnicode_Join(empty, buf));
+
+done:
+    Py_XDECREF(buf);
+    Py_DECREF(item[0]);
+    Py_DECREF(item[1]);
+    Py_DECREF(item[2]);
+    return ret;
+}
+
+static PyObject *
+serialize_doctype(PyObject *data)
+{
+    PyObject *buf = NULL, *args = NULL, *format = NULL, *item[3],
+             *ret = NULL;
+    int pubid, sysid, i;
+
+    if (unpack(data, 3, item) < 0)
+        return NULL;
+    pubid = PyObject_IsTrue(item[1]);
+    sysid = PyObject_IsTrue(item[2]);
+    if (pubid < 0 || sysid < 0)
+        goto done;
+    buf = PyList_New(0);
+    if (buf == NULL || PyList_Append(buf, doctypefmt) < 0)
+        goto done;
+    if (pubid) {
+        if (PyList_Append(buf, publicfmt) < 0)
+            goto done;
+    } else if (sysid) {
+        if (PyList_Append(buf, systemfmt) < 0)
+            goto done;
+    }
+    if (sysid && PyList_Append(buf, sysidfmt) < 0)
+        goto done;
+    if (PyList_Append(buf, gtnl) < 0)
+        goto done;
+    format = markup(PyUnicode_Join(empty, buf));
+    if (format == NULL)
+        goto done;
+
+    /* The format arguments are the non-empty parts of the declaration */
+    Py_CLEAR(buf);
+    buf = PyList_New(0);
+    if (buf == NULL)
+        goto done;
+    for (i = 0; i < 3; i++) {
+        int istrue = PyObject_IsTrue(item[i]);
+        if (istrue < 0 || (istrue && PyList_Append(buf, item[i]) < 0))
+            goto done;
+    }
+    args = PyList_AsTuple(buf);
+    if (args == NULL)
+        goto done;
+    ret = PyNumber_Remainder(format, args);
+
+done:
+    Py_XDECREF(buf);
+    Py_XDECREF(args);
+    Py_XDECREF(format);
+    Py_DECREF(item[0]);
+    Py_DECREF(item[1]);
+    Py_DECREF(item[2]);
+    return ret;
+}
+
+/* Return the output for an event, or NULL without an exception set if the
+   event produces no output */
+/* Return the output for a tag from the shared cache, or None */
+static PyObject *
+shared_cache_get(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    PyObject *key, *output;
+
+    key = PyTuple_Pack(3, self->cache_key, kind, data);
+    if (key == NULL)
+        return NULL;
+    output = PyObject_CallMethodObjArgs(self->shared_cache, get_str, key,
+                                        NULL);
+    Py_DECREF(key);
+    return output;
+}
+
+static int
+shared_cache_set(SerializerObject *self, PyObject *kind, PyObject *data,
+                 PyObject *output)
+{
+    PyObject *key, *result;
+
+    key = PyTuple_Pack(3, self->cache_key, kind, data);
+    if (key == NULL)
+        return -1;
+    result = PyObject_CallMethodObjArgs(self->shared_cache, set_str, key,
+                                        output, NULL);
+    Py_DECREF(key);
+    if (result == NULL)
+        return -1;
+    Py_DECREF(result);
+    return 0;
+}
+
+/* Store output in the private cache, which is emptied when it reaches its
+   size limit */
+static int
+cache_output(SerializerObject *self, PyObject *key, PyObject *output)
+{
+    if (self->cache_size >= 0 && PyDict_Size(self->cache) >= self->cache_size)
+        PyDict_Clear(self->cache);
+    return PyDict_SetItem(self->cache, key, output);
+}
+
+static PyObject *
+serialize_event(SerializerObject *self, PyObject *kind, PyObject *data)
+{
+    PyObject *key = NULL, *output = NULL, *tag;
+    int cmp;
+
+    if (kind == kinds[K_TEXT] && PyObject_TypeCheck(data, &MarkupType)) {
+        Py_INCREF(data);
+        return data;
+    } else if (kind == kinds[K_FLUSH]) {
+        Py_INCREF(flush_marker);
+        return flush_marker;
+    }
+
+    /* With a shared cache, only the output of tags is cached, and the shared
+       cache is only consulted if the output isn't in the private one yet */
+    if (self->cache != NULL && (self->shared_cache == NULL ||
+            kind == kinds[K_START] || kind == kinds[K_EMPTY] ||
+            kind == kinds[K_END])) {
+        key = PyTuple_Pack(2, kind, data);
+        if (key == NULL || PyObject_Hash(key) == -1) {
+            Py_XDECREF(key);
+            return NULL;
+        }
+        output = PyDict_GetItem(self->cache, key);
+        Py_XINCREF(output);
+        if (output == NULL && self->shared_cache != NULL) {
+            output = shared_cache_get(self, kind, data);
+            if (output == NULL) {
+                Py_DECREF(key);
+                return NULL;
+            }
+            if (output == Py_None) {
+                Py_CLEAR(output);
+            } else if (cache_output(self, key, output) < 0) {
+                Py_DECREF(key);
+                Py_DECREF(output);
+                return NULL;
+            }
+        }
+    }
+    if (output != NULL) {
+        Py_DECREF(key);
+        if (self->method == METHOD_HTML) {
+            if (kind == kinds[K_START] || kind == kinds[K_EMPTY]) {
+                tag = PySequence_GetItem(data, 0);
+                if (tag == NULL) {
+                    Py_DECREF(output);
+                    return NULL;
+                }
+                cmp = contains(self->noescape_elems, tag);
+                Py_DECREF(tag);
+                if (cmp < 0) {
+                    Py_DECREF(output);
+                    return NULL;
+                }
+                if (cmp)
+                    self->noescape = 1;
+            } else if (kind == kinds[K_END]) {
+                self->noescape = 0;
+            }
+        }
+        return output;
+    }
+
+    if (kind == kinds[K_START] || kind == kinds[K_EMPTY]) {
+        output = serialize_start(self, kind, data);
+    } else if (kind == kinds[K_END]) {
+        output = markup(format1(endfmt, data));
+        if (self->method == METHOD_HTML)
+            self->noescape = 0;
+    } else if (kind == kinds[K_TEXT]) {
+        if (self->noescape) {
+            Py_INCREF(data);
+            output = data;
+        } else {
+            output = escape_value(data, 0);
+        }
+    } else if (kind == kinds[K_COMMENT]) {
+        output = markup(format1(commentfmt, data));
+    } else if (kind == kinds[K_PI]) {
+        output = markup(PyUnicode_Format(pifmt, data));
+
+    } else {
+        /* These events are not cached */
+        Py_CLEAR(key);
+        if (kind == kinds[K_XML_DECL]) {
+            if (!self->have_decl && self->method != METHOD_HTML &&
+                    !(self->method == METHOD_XHTML && self->drop_xml_decl)) {
+                output = serialize_xml_decl(data);
+                self->have_decl = 1;
+            }
+        } else if (kind == kinds[K_DOCTYPE]) {
+            if (!self->have_doctype) {
+                output = serialize_doctype(data);
+                self->have_doctype = 1;
+            }
+        } else if (self->method != METHOD_HTML) {
+            if (kind == kinds[K_START_CDATA]) {
+                Py_INCREF(cdatastart);
+                output = markup(cdatastart);
+                self->noescape = 1;
+            } else if (kind == kinds[K_END_CDATA]) {
+                Py_INCREF(cdataend);
+                output = markup(cdataend);
+                self->noescape = 0;
+            }
+        }
+        return output;
+    }
+
+    if (output != NULL && key != NULL) {
+        if (self->shared_cache != NULL &&
+                shared_cache_set(self, kind, data, output) < 0)
+            Py_CLEAR(output);
+        else if (cache_output(self, key, output) < 0)
+            Py_CLEAR(output);
+    }
+    Py_XDECREF(key);
+    return output;
+}
+
+/* Return the output for the next event that produces any */
+static PyObject *
+next_output(SerializerObject *self)
+{
+    PyObject *event, *item[3], *output;
+
+    while ((event = PyIter_Next(self->stream)) != NULL) {
+        if (unpack(event, 3, item) < 0) {
+            Py_DECREF(event);
+            return NULL;
+        }
+        Py_DECREF(event);
+        output = serialize_event(self, item[0], item[1]);
+        Py_DECREF(item[0]);
+        Py_DECREF(item[1]);
+        Py_DECREF(item[2]);
+        if (output != NULL || PyErr_Occurred())
+            return output;
+    }
+    return NULL;
+}
+
+/* With an encoding, the output of a number of events is joined and encoded
+   at once */
+#define ENCODE_BATCH 64
+
+static PyObject *
+Serializer_iternext(SerializerObject *self)
+{
+    PyObject *batch, *output, *joined;
+
+    if (self->encoding == NULL)
+        return next_output(self);
+    if (self->flush) {
+        self->flush = 0;
+        Py_INCREF(encoded_flush_marker);
+        return encoded_flush_marker;
+    }
+
+    batch = PyList_New(0);
+    if (batch == NULL)
+        return NULL;
+    while (PyList_GET_SIZE(batch) < ENCODE_BATCH &&
+            (output = next_output(self)) != NULL) {
+        if (output == flush_marker) {
+            /* The output so far is passed on before the marker */
+            Py_DECREF(output);
+            if (PyList_GET_SIZE(batch) == 0) {
+                Py_DECREF(batch);
+                Py_INCREF(encoded_flush_marker);
+                return encoded_flush_marker;
+            }
+            self->flush = 1;
+            break;
+        }
+        if (PyList_Append(batch, output) < 0) {
+            Py_DECREF(output);
+            Py_DECREF(batch);
+            return NULL;
+        }
+        Py_DECREF(output);
+    }
+    if (PyErr_Occurred() || PyList_GET_SIZE(batch) == 0) {
+        Py_DECREF(batch);
+        return NULL;
+    }
+    joined = PyUnicode_Join(empty, batch);
+    Py_DECREF(batch);
+    if (joined == NULL)
+        return NULL;
+    output = PyUnicode_AsEncodedString(joined, self->encoding,
+                                       "xmlcharrefreplace");
+    Py_DECREF(joined);
+    return output;
+}
+
+static int
+Serializer_traverse(SerializerObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->stream);
+    Py_VISIT(self->cache);
+    Py_VISIT(self->shared_cache);
+    Py_VISIT(self->cache_key);
+    Py_VISIT(self->boolean_attrs);
+    Py_VISIT(self->empty_elems);
+    Py_VISIT(self->noescape_elems);
+    return 0;
+}
+
+static int
+Serializer_clear(SerializerObject *self)
+{
+    Py_CLEAR(self->stream);
+    Py_CLEAR(self->cache);
+    Py_CLEAR(self->shared_cache);
+    Py_CLEAR(self->cache_key);
+    Py_CLEAR(self->boolean_attrs);
+    Py_CLEAR(self->empty_elems);
+    Py_CLEAR(self->noescape_elems);
+    return 0;
+}
+
+static void
+Serializer_dealloc(SerializerObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Serializer_clear(self);
+    if (self->encoding != NULL)
+        PyMem_Free(self->encoding);
+    PyObject_GC_Del(self);
+}
+
+PyTypeObject SerializerType = {
+#ifdef IS_PY3K
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "genshi._speedups.SerializerIterator",
+    sizeof(SerializerObject),
+    0,
+    (destructor) Serializer_dealloc, /*tp_dealloc*/
+    0,          /*tp_print*/
+    0,          /*tp_getattr*/
+    0,          /*tp_setattr*/
+    0,          /*tp_compare*/
+    0,          /*tp_repr*/
+    0,          /*tp_as_number*/
+    0,          /*tp_as_sequence*/
+    0,          /*tp_as_mapping*/
+    0,          /*tp_hash */
+
+    0,          /*tp_call*/
+    0,          /*tp_str*/
+    0,          /*tp_getattro*/
+    0,          /*tp_setattro*/
+    0,          /*tp_as_buffer*/
+
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /*tp_flags*/
+
+    0,          /*tp_doc*/
+
+    (traverseproc) Serializer_traverse, /*tp_traverse*/
+    (inquiry) Serializer_clear, /*tp_clear*/
+
+    0,          /*tp_richcompare*/
+    0,          /*tp_weaklistoffset*/
+
+    PyObject_SelfIter, /*tp_iter*/
+    (iternextfunc) Serializer_iternext, /*tp_iternext*/
+};
+
+PyDoc_STRVAR(serialize__doc__,
+"Return an iterator over the serialized output of a stream of markup\n\
+events, as produced by the `XMLSerializer`, `XHTMLSerializer`, and\n\
+`HTMLSerializer` classes after applying their filters.\n\
+\n\
+:param stream: the filtered event stream\n\
+:param method: the serialization method, \"xml\", \"xhtml\", or \"html\"\n\
+:param cache: whether to cache the output per event, or a\n\
+              `SerializationCache` for the output of tags\n\
+:param boolean_attrs: the set of boolean attribute names\n\
+:param empty_elems: the set of names of elements that are always empty\n\
+:param noescape_elems: the set of names of elements whose text content is\n\
+                       not escaped (HTML only)\n\
+:param drop_xml_decl: whether the XML declaration is dropped (XHTML only)\n\
+:param cache_key: the key of the serializer configuration in the shared\n\
+                  cache; if given, `cache` is used as a shared cache\n\
+:param encoding: if given, the output is produced as byte strings in this\n\
+                 encoding instead of `Markup` objects\n\
+:return: an iterator over the output strings\n\
+:see: `genshi.output`\n\
+");
+
+static PyObject *
+serialize(PyObject *module, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"stream", "method", "cache", "boolean_attrs",
+                             "empty_elems", "noescape_elems", "drop_xml_decl",
+                             "cache_key", "encoding", 0};
+    PyObject *stream = NULL, *cache = Py_True, *boolean_attrs = NULL,
+             *empty_elems = NULL, *noescape_elems = NULL,
+             *drop_xml_decl = Py_True, *cache_key = Py_None;
+    char *method = "xml", *encoding = NULL;
+    SerializerObject *self;
+    int use_cache, drop;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|sOOOOOOz", kwlist,
+                                     &stream, &method, &cache, &boolean_attrs,
+                                     &empty_elems, &noescape_elems,
+                                     &drop_xml_decl, &cache_key, &encoding)) {
+        return NULL;
+    }
+    if (init_kinds() < 0)
+        return NULL;
+    use_cache = PyObject_IsTrue(cache);
+    drop = PyObject_IsTrue(drop_xml_decl);
+    if (use_cache < 0 || drop < 0)
+        return NULL;
+
+    self = PyObject_GC_New(SerializerObject, &SerializerType);
+    if (self == NULL)
+        return NULL;
+    self->stream = NULL;
+    self->cache = self->shared_cache = self->cache_key = NULL;
+    self->boolean_attrs = boolean_attrs;
+    Py_XINCREF(boolean_attrs);
+    self->empty_elems = empty_elems;
+    Py_XINCREF(empty_elems);
+    self->noescape_elems = noescape_elems;
+    Py_XINCREF(noescape_elems);
+    self->drop_xml_decl = drop;
+    self->have_decl = self->have_doctype = self->noescape = self->flush = 0;
+    self->encoding = NULL;
+    PyObject_GC_Track(self);
+
+    if (encoding != NULL) {
+        self->encoding = PyMem_Malloc(strlen(encoding) + 1);
+        if (self->encoding == NULL) {
+            Py_DECREF(self);
+            return PyErr_NoMemory();
+        }
+        strcpy(self->encoding, encoding);
+    }
+
+    if (strcmp(method, "xml") == 0) {
+        self->method = METHOD_XML;
+    } else if (strcmp(method, "xhtml") == 0) {
+        self->method = METHOD_XHTML;
+    } else if (strcmp(method, "html") == 0) {
+        self->method = METHOD_HTML;
+    } else {
+        PyErr_Format(PyExc_ValueError, "unknown serialization method %s",
+                     method);
+        Py_DECREF(self);
+        return NULL;
+    }
+    self->stream = PyObject_GetIter(stream);
+    if (self->stream == NULL) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    self->cache_size = -1;
+    if (cache_key != Py_None) {
+        PyObject *capacity = PyObject_GetAttrString(cache, "capacity");
+        if (capacity == NULL) {
+            Py_DECREF(self);
+            return NULL;
+        }
+        self->cache_size = PyNumber_AsSsize_t(capacity, PyExc_OverflowError);
+        Py_DECREF(capacity);
+        if (self->cache_size == -1 && PyErr_Occurred()) {
+            Py_DECREF(self);
+            return NULL;
+        }
+        Py_INCREF(cache);
+        self->shared_cache = cache;
+        Py_INCREF(cache_key);
+        self->cache_key = cache_key;
+        use_cache = 1;
+    }
+    if (use_cache) {
+        self->cache = PyDict_New();
+        if (self->cache == NULL) {
+            Py_DECREF(self);
+            return NULL;
+        }
+    }
+    return (PyObject *) self;
+}
+
+/* Template flattener */
+
+#ifdef IS_PY3K
+#   define PyString_FromString PyUnicode_FromString
+#   define IS_STRING(obj) PyUnicode_Check(obj)
+#   define IS_NUMBER(obj) (PyLong_Check(obj) || PyFloat_Check(obj))
+#else
+#   define IS_STRING(obj) (PyString_Check(obj) || PyUnicode_Check(obj))
+#   define IS_NUMBER(obj) (PyInt_Check(obj) || PyLong_Check(obj) || \
+                           PyFloat_Check(obj))
+#endif
+
+enum { T_START, T_TEXT, T_EXPR, T_SUB, T_EXEC, T_ATTRS, T_OVERLAY, T_ENSURE,
+       T_COUNT };
+
+static PyObject *template_objects[T_COUNT];
+static PyObject *evaluate_str, *execute_str, *iter_str, *join_str, *empty_str;
+
+static void
+init_flattener_constants(void)
+{
+    evaluate_str = PyString_InternFromString("evaluate");
+    execute_str = PyString_InternFromString("execute");
+    iter_str = PyString_InternFromString("__iter__");
+    join_str = PyString_InternFromString("join");
+    empty_str = PyString_FromString("");
+}
+
+/* The event kinds and helper functions are looked up on first use, as
+   genshi.template.base imports this module indirectly */
+static int
+init_template_objects(void)
+{
+    static const char *names[T_COUNT] = {
+        "START", "TEXT", "EXPR", "SUB", "EXEC", "Attrs", "_overlay", "_ensure"
+    };
+    PyObject *module;
+    int i;
+
+    if (template_objects[T_COUNT - 1] != NULL)
+        return 0;
+    module = PyImport_ImportModule("genshi.template.base");
+    if (module == NULL)
+        return -1;
+    for (i = 0; i < T_COUNT; i++) {
+        if (template_objects[i] == NULL) {
+            template_objects[i] = PyObject_GetAttrString(module, names[i]);
+            if (template_objects[i] == NULL) {
+                Py_DECREF(module);
+                return -1;
+            }
+        }
+    }
+    Py_DECREF(module);
+    return 0;
+}
+
+/* Same as seq[idx] */
+static PyObject *
+getitem(PyObject *seq, Py_ssize_t idx)
+{
+    if (PyTuple_CheckExact(seq) && idx < PyTuple_GET_SIZE(seq)) {
+        PyObject *item = PyTuple_GET_ITEM(seq, idx);
+        Py_INCREF(item);
+        return item;
+    }
+    return PySequence_GetItem(seq, idx);
+}
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *stream;
+    PyObject *stack;
+    PyObject *ctxt;
+    PyObject *vars;
+    PyObject *number_conv;
+} FlattenerObject;
+
+PyTypeObject FlattenerType; /* declared later */
+
+static PyObject *
+new_flattener(PyObject *stream, PyObject *ctxt, PyObject *vars,
+              PyObject *number_conv)
+{
+    FlattenerObject *self;
+
+    self = PyObject_GC_New(FlattenerObject, &FlattenerType);
+    if (self == NULL)
+        return NULL;
+    self->stream = NULL;
+    self->stack = PyList_New(0);
+    Py_INCREF(ctxt);
+    self->ctxt = ctxt;
+    Py_INCREF(vars);
+    self->vars = vars;
+    Py_INCREF(number_conv);
+    self->number_conv = number_conv;
+    PyObject_GC_Track(self);
+
+    if (self->stack == NULL) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    self->stream = PyObject_GetIter(stream);
+    if (self->stream == NULL) {
+        Py_DECREF(self);
+        return NULL;
+    }
+    return (PyObject *) self;
+}
+
+/* Return the object code is evaluated or executed with: the context, or an
+   overlay of the additional variables on the context */
+static PyObject *
+get_scope(FlattenerObject *self)
+{
+    if (PyDict_Size(self->vars) > 0) {
+        return PyObject_CallFunctionObjArgs(template_objects[T_OVERLAY],
+                                            self->ctxt, self->vars, NULL);
+    }
+    Py_INCREF(self->ctxt);
+    return self->ctxt;
+}
+
+/* Continue with the given stream, returning to the current one once it is
+   exhausted */
+static int
+push_stream(FlattenerObject *self, PyObject *stream)
+{
+    PyObject *iter;
+
+    if (stream == NULL)
+        return -1;
+    iter = PyObject_GetIter(stream);
+    Py_DECREF(stream);
+    if (iter == NULL)
+        return -1;
+    if (PyList_Append(self->stack, self->stream) < 0) {
+        Py_DECREF(iter);
+        return -1;
+    }
+    Py_DECREF(self->stream);
+    self->stream = iter;
+    return 0;
+}
+
+/* Return the text of an interpolated attribute value, or None if the value
+   produces no text */
+static PyObject *
+flatten_attr(FlattenerObject *self, PyObject *value)
+{
+    PyObject *flattener, *values, *event, *kind, *data, *ret = NULL;
+    int err = 0;
+
+    flattener = new_flattener(value, self->ctxt, self->vars,
+                              self->number_conv);
+    if (flattener == NULL)
+        return NULL;
+    values = PyList_New(0);
+    if (values == NULL) {
+        Py_DECREF(flattener);
+        return NULL;
+    }
+    while (!err && (event = PyIter_Next(flattener)) != NULL) {
+        kind = getitem(event, 0);
+        if (kind == NULL) {
+            err = 1;
+        } else if (kind == template_objects[T_TEXT]) {
+            data = getitem(event, 1);
+            if (data == NULL || (data != Py_None &&
+                                 PyList_Append(values, data) < 0))
+                err = 1;
+            Py_XDECREF(data);
+        }
+        Py_XDECREF(kind);
+        Py_DECREF(event);
+    }
+    Py_DECREF(flattener);
+
+    if (!err && !PyErr_Occurred()) {
+        if (PyList_GET_SIZE(values)) {
+            ret = PyObject_CallMethodObjArgs(empty_str, join_str, values,
+                                             NULL);
+        } else {
+            Py_INCREF(Py_None);
+            ret = Py_None;
+        }
+    }
+    Py_DECREF(values);
+    return ret;
+}
+
+/* Evaluate the interpolated attributes of a start tag */
+static PyObject *
+flatten_start(FlattenerObject *self, PyObject *kind, PyObject *data,
+              PyObject *pos)
+{
+    PyObject *item[2], *attr[2], *new_attrs = NULL, *iter = NULL, *value,
+             *pair, *ret = NULL;
+    int err = 0;
+
+    if (unpack(data, 2, item) < 0)
+        return NULL;
+    new_attrs = PyList_New(0);
+    if (new_attrs == NULL)
+        goto done;
+    iter = PyObject_GetIter(item[1]);
+    if (iter == NULL)
+        goto done;
+    while (!err && (pair = PyIter_Next(iter)) != NULL) {
+        err = unpack(pair, 2, attr);
+        Py_DECREF(pair);
+        if (err)
+            break;
+        if (PyList_CheckExact(attr[1])) {
+            /* This is an interpolated string */
+            value = flatten_attr(self, attr[1]);
+        } else {
+            Py_INCREF(attr[1]);
+            value = attr[1];
+        }
+        if (value == NULL) {
+            err = 1;
+        } else if (value != Py_None || !PyList_CheckExact(attr[1])) {
+            pair = PyTuple_Pack(2, attr[0], value);
+            if (pair == NULL || PyList_Append(new_attrs, pair) < 0)
+                err = 1;
+            Py_XDECREF(pair);
+        }
+        Py_XDECREF(value);
+        Py_DECREF(attr[0]);
+        Py_DECREF(attr[1]);
+    }
+    if (err || PyErr_Occurred())
+        goto done;
+
+    value = PyObject_CallFunctionObjArgs(template_objects[T_ATTRS], new_attrs,
+                                         NULL);
+    if (value == NULL)
+        goto done;
+    data = PyTuple_Pack(2, item[0], value);
+    Py_DECREF(value);
+    if (data == NULL)
+        goto done;
+    ret = PyTuple_Pack(3, kind, data, pos);
+    Py_DECREF(data);
+
+done:
+    Py_XDECREF(iter);
+    Py_XDECREF(new_attrs);
+    Py_DECREF(item[0]);
+    Py_DECREF(item[1]);
+    return ret;
+}
+
+/* Evaluate an expression; return the resulting event, or NULL without an
+   exception set if the result produces no event by itself */
+static PyObject *
+flatten_expr(FlattenerObject *self, PyObject *data, PyObject *pos)
+{
+    PyObject *scope, *result, *text, *ret;
+
+    scope = get_scope(self);
+    if (scope == NULL)
+        return NULL;
+    result = PyObject_CallMethodObjArgs(data, evaluate_str, scope, NULL);
+    Py_DECREF(scope);
+    if (result == NULL)
+        return NULL;
+    if (result == Py_None) {
+        Py_DECREF(result);
+        return NULL;
+    }
+
+    /* First check for a string, otherwise the iterable test below succeeds,
+       and the string will be chopped up into individual characters */
+    if (IS_STRING(result)) {
+        text = result;
+    } else if (IS_NUMBER(result)) {
+        text = PyObject_CallFunctionObjArgs(self->number_conv, result, NULL);
+        Py_DECREF(result);
+    } else if (PyObject_HasAttr(result, iter_str)) {
+        push_stream(self, PyObject_CallFunctionObjArgs(
+            template_objects[T_ENSURE], result, NULL));
+        Py_DECREF(result);
+        return NULL;
+    } else {
+        text = PyObject_Str(result);
+        Py_DECREF(result);
+    }
+    if (text == NULL)
+        return NULL;
+    ret = PyTuple_Pack(3, template_objects[T_TEXT], text, pos);
+    Py_DECREF(text);
+    return ret;
+}
+
+/* Apply the directives of a SUB event to its substream, and continue with
+   the resulting stream */
+static int
+flatten_sub(FlattenerObject *self, PyObject *data)
+{
+    PyObject *item[2], *directive = NULL, *rest = NULL, *args = NULL,
+             *iter = NULL, *stream = NULL;
+    int ret = -1, istrue;
+
+    if (unpack(data, 2, item) < 0)
+        return -1;
+    istrue = PyObject_IsTrue(item[0]);
+    if (istrue < 0)
+        goto done;
+    if (!istrue) {
+        Py_INCREF(item[1]);
+        ret = push_stream(self, item[1]);
+        goto done;
+    }
+    directive = getitem(item[0], 0);
+    if (directive == NULL)
+        goto done;
+    rest = PySequence_GetSlice(item[0], 1, PY_SSIZE_T_MAX);
+    if (rest == NULL)
+        goto done;
+    iter = PyObject_GetIter(item[1]);
+    if (iter == NULL)
+        goto done;
+    args = PyTuple_Pack(3, iter, rest, self->ctxt);
+    if (args == NULL)
+        goto done;
+    stream = PyObject_Call(directive, args, self->vars);
+    ret = push_stream(self, stream);
+
+done:
+    Py_XDECREF(directive);
+    Py_XDECREF(rest);
+    Py_XDECREF(iter);
+    Py_XDECREF(args);
+    Py_DECREF(item[0]);
+    Py_DECREF(item[1]);
+    return ret;
+}
+
+static PyObject *
+Flattener_iternext(FlattenerObject *self)
+{
+    PyObject *event, *item[3], *attrs, *scope, *result, *ret;
+    PyObject *kind, *data, *pos;
+    Py_ssize_t size;
+    int istrue;
+
+    while (1) {
+        event = PyIter_Next(self->stream);
+        if (event == NULL) {
+            size = PyList_GET_SIZE(self->stack);
+            if (PyErr_Occurred() || size == 0)
+                return NULL;
+            Py_DECREF(self->stream);
+            self->stream = PyList_GET_ITEM(self->stack, size - 1);
+            Py_INCREF(self->stream);
+            if (PySequence_DelItem(self->stack, size - 1) < 0)
+                return NULL;
+            continue;
+        }
+        if (unpack(event, 3, item) < 0) {
+            Py_DECREF(event);
+            return NULL;
+        }
+        kind = item[0];
+        data = item[1];
+        pos = item[2];
+        ret = NULL;
+
+        if (kind == template_objects[T_START]) {
+            /* Attributes may still contain expressions in start tags at this
+               point, so do some evaluation */
+            attrs = getitem(data, 1);
+            if (attrs == NULL) {
+                istrue = -1;
+            } else {
+                istrue = PyObject_IsTrue(attrs);
+                Py_DECREF(attrs);
+            }
+            if (istrue > 0) {
+                ret = flatten_start(self, kind, data, pos);
+            } else if (istrue == 0) {
+                Py_INCREF(event);
+                ret = event;
+            }
+
+        } else if (kind == template_objects[T_EXPR]) {
+            ret = flatten_expr(self, data, pos);
+
+        } else if (kind == template_objects[T_SUB]) {
+            /* This event is a list of directives and a list of nested
+               events to which those directives should be applied */
+            flatten_sub(self, data);
+
+        } else if (kind == template_objects[T_EXEC]) {
+            scope = get_scope(self);
+            if (scope != NULL) {
+                result = PyObject_CallMethodObjArgs(data, execute_str, scope,
+                                                    NULL);
+                Py_DECREF(scope);
+                Py_XDECREF(result);
+            }
+
+        } else if (PyTuple_CheckExact(event)) {
+            Py_INCREF(event);
+            ret = event;
+        } else {
+            ret = PyTuple_Pack(3, kind, data, pos);
+        }
+
+        Py_DECREF(event);
+        Py_DECREF(kind);
+        Py_DECREF(data);
+        Py_DECREF(pos);
+        if (ret != NULL || PyErr_Occurred())
+            return ret;
+    }
+}
+
+static int
+Flattener_traverse(FlattenerObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->stream);
+    Py_VISIT(self->stack);
+    Py_VISIT(self->ctxt);
+    Py_VISIT(self->vars);
+    Py_VISIT(self->number_conv);
+    return 0;
+}
+
+static int
+Flattener_clear(FlattenerObject *self)
+{
+    Py_CLEAR(self->stream);
+    Py_CLEAR(self->stack);
+    Py_CLEAR(self->ctxt);
+    Py_CLEAR(self->vars);
+    Py_CLEAR(self->number_conv);
+    return 0;
+}
+
+static void
+Flattener_dealloc(FlattenerObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    Flattener_clear(self);
+    PyObject_GC_Del(self);
+}
+
+PyTypeObject FlattenerType = {
+#ifdef IS_PY3K
+    PyVarObject_HEAD_INIT(NULL, 0)
+#else
+    PyObject_HEAD_INIT(NULL)
+    0,
+#endif
+    "genshi._speedups.FlattenerIterator",
+    sizeof(FlattenerObject),
+    0,
+    (destructor) Flattener_dealloc, /*tp_dealloc*/
+    0,          /*tp_print*/
+    0,          /*tp_getattr*/
+    0,          /*tp_setattr*/
+    0,          /*tp_compare*/
+    0,          /*tp_repr*/
+    0,          /*tp_as_number*/
+    0,          /*tp_as_sequence*/
+    0,          /*tp_as_mapping*/
+    0,          /*tp_hash */
+
+    0,          /*tp_call*/
+    0,          /*tp_str*/
+    0,          /*tp_getattro*/
+    0,          /*tp_setattro*/
+    0,          /*tp_as_buffer*/
+
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC, /*tp_flags*/
+
+    0,          /*tp_doc*/
+
+    (traverseproc) Flattener_traverse, /*tp_traverse*/
+    (inquiry) Flattener_clear, /*tp_clear*/
+
+    0,          /*tp_richcompare*/
+    0,          /*tp_weaklistoffset*/
+
+    PyObject_SelfIter, /*tp_iter*/
+    (iternextfunc) Flattener_iternext, /*tp_iternext*/
+};
+
+PyDoc_STRVAR(flatten__doc__,
+"Return an iterator over the events of a prepared template stream with\n\
+expressions evaluated, code blocks executed, and directives applied, as\n\
+produced by `Template._flatten`.\n\
+\n\
+:param stream: the prepared event stream\n\
+:param ctxt: the `Context`\n\
+:param vars: a dictionary of additional variables that should be available\n\
+             when Python code is executed\n\
+:param number_conv: the function used to convert numbers to event data\n\
+:return: an iterator over the flattened events\n\
+:see: `genshi.template.base`\n\
+");
+
+static PyObject *
+flatten(PyObject *module, PyObject *args)
+{
+    PyObject *stream, *ctxt, *vars, *number_conv;
+
+    if (!PyArg_ParseTuple(args, "OOO!O", &stream, &ctxt, &PyDict_Type, &vars,
+                          &number_conv)) {
+        return NULL;
+    }
+    if (init_template_objects() < 0)
+        return NULL;
+    return new_flattener(stream, ctxt, vars, number_conv);
+}
+
+static PyMethodDef module_methods[] = {
+    {"serialize", (PyCFunction) serialize, METH_VARARGS|METH_KEYWORDS,
+     serialize__doc__},
+    {"flatten", (PyCFunction) flatten, METH_VARARGS, flatten__doc__},
+    {NULL}  /* Sentinel */
+};
+
 #ifdef IS_PY3K
 struct PyModuleDef module_def = {
     PyModuleDef_HEAD_INIT, /*m_base*/
     "_speedups",           /*m_name*/
     NULL,                  /*m_doc*/
     -1,                    /*m_size*/
-    NULL,                  /*m_methods*/
+    module_methods,        /*m_methods*/
     NULL,                  /*m_reload*/
     NULL,                  /*m_traverse*/
     NULL,                  /*m_clear*/
@@ -679,7 +2094,8 @@ init_speedups(void)
         <http://www.python.it/faq/faq-3.html#3.24> */
     MarkupType.tp_base = &PyUnicode_Type;
 
-    if (PyType_Ready(&MarkupType) < 0)
+    if (PyType_Ready(&MarkupType) < 0 || PyType_Ready(&SerializerType) < 0 ||
+            PyType_Ready(&FlattenerType) < 0)
 #ifdef IS_PY3K
         return NULL;
 #else
@@ -687,11 +2103,13 @@ init_speedups(void)
 #endif
 
     init_constants();
+    init_serializer_constants();
+    init_flattener_constants();
 
 #ifdef IS_PY3K
     module = PyModule_Create(&module_def);
 #else
-    module = Py_InitModule("_speedups", NULL);
+    module = Py_InitModule("_speedups", module_methods);
 #endif
     Py_INCREF(&MarkupType);
     PyModule_AddObject(module, "Markup", (PyObject *) &MarkupType);
@@ -87,6 +87,23 @@ else:
                         code.co_varnames, filename, name, lineno,
                         code.co_lnotab, (), ())
 
+# Raising an exception again with the traceback of another thread
+
+if IS_PYTHON2:
+    def reraise(exc_info):
+        raise exc_info[0], exc_info[1], exc_info[2]
+else:
+    def reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+
+# Asynchronous iteration only exists in Python >= 3.5
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        pass
+
 # Compatibility fallback implementations for Python < 2.6
 
 try:
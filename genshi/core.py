@@ -70,6 +70,8 @@ class Stream(object):
     END_CDATA = StreamEventKind('END_CDATA') #: end CDATA section
     PI = StreamEventKind('PI') #: processing instruction
     COMMENT = StreamEventKind('COMMENT') #: comment
+    FLUSH = StreamEventKind('FLUSH') #: flush the output written so far
+    AWAIT = StreamEventKind('AWAIT') #: await an object before continuing
 
     def __init__(self, events, serializer=None):
         """Initialize the stream with a sequence of markup events.
@@ -154,7 +156,8 @@ class Stream(object):
         """
         return reduce(operator.or_, (self,) + filters)
 
-    def render(self, method=None, encoding=None, out=None, **kwargs):
+    def render(self, method=None, encoding=None, out=None, buffer_size=16384,
+               queue_size=0, **kwargs):
         """Return a string representation of the stream.
         
         Any additional keyword arguments are passed to the serializer, and thus
@@ -167,21 +170,155 @@ class Stream(object):
         :param encoding: how the output string should be encoded; if set to
                          `None`, this method returns a `unicode` object
         :param out: a file-like object that the output should be written to
-                    instead of being returned as one big string; note that if
-                    this is a file or socket (or similar), the `encoding` must
-                    not be `None` (that is, the output must be encoded)
+                    instead of being returned as one big string, or the number
+                    of a file descriptor; note that if this is a file or
+                    socket (or similar), the `encoding` must not be `None`
+                    (that is, the output must be encoded)
+        :param buffer_size: the number of characters of output that are
+                            collected before they are encoded and written to
+                            `out`; if `0` or `None`, the output is written
+                            as soon as the serializer produces it
+        :param queue_size: if not `0` or `None`, the stream is serialized in a
+                           separate thread while the output is written to
+                           `out`, getting ahead of the writing by up to
+                           `queue_size` pieces of `buffer_size` characters
         :return: a `str` or `unicode` object (depending on the `encoding`
                  parameter), or `None` if the `out` parameter is provided
         :rtype: `basestring`
         
         :see: XMLSerializer, XHTMLSerializer, HTMLSerializer, TextSerializer
         :note: Changed in 0.5: added the `out` parameter
+        :note: Changed in 0.7: added the `buffer_size` and `queue_size`
+               parameters
         """
         from genshi.output import encode
         if method is None:
             method = self.serializer or 'xml'
-        generator = self.serialize(method=method, **kwargs)
-        return encode(generator, method=method, encoding=encoding, out=out)
+        generator = self._serialize_encoded(method, encoding, kwargs)
+        return encode(generator, method=method, encoding=encoding, out=out,
+                      buffer_size=buffer_size, queue_size=queue_size)
+
+    def render_iter(self, method=None, encoding='utf-8', chunk_size=16384,
+                    queue_size=0, **kwargs):
+        """Return an iterator over the string representation of the stream,
+        in chunks of about `chunk_size` characters.
+        
+        Unlike `render()`, this does not build the complete output in memory,
+        and unlike `serialize()`, it does not produce a chunk for every event,
+        so the iterator can be used as the response body of a WSGI application:
+        
+        >>> from genshi.input import XML
+        >>> stream = XML('<ul>%s</ul>' % ('<li>Item</li>' * 500))
+        >>> [len(chunk) for chunk in stream.render_iter(chunk_size=2000,
+        ...                                             encoding=None)]
+        [2001, 2002, 2002, 504]
+        
+        Chunks of serializer output that are bigger than `chunk_size`, such as
+        the pre-serialized static markup of templates, are passed on without
+        being split or joined with other output. A `FLUSH` event in the stream
+        ends the current chunk.
+        
+        With a `queue_size`, the stream is serialized in a separate thread,
+        which keeps up to `queue_size` chunks ready while the previous chunks
+        are being sent. Any code in the stream, such as the expressions of a
+        template, then runs in that thread.
+
+        Any additional keyword arguments are passed to the serializer, and thus
+        depend on the `method` parameter value.
+        
+        :param method: determines how the stream is serialized; can be either
+                       "xml", "xhtml", "html", "text", or a custom serializer
+                       class; if `None`, the default serialization method of
+                       the stream is used
+        :param encoding: how the output strings should be encoded; if set to
+                         `None`, the iterator produces `unicode` objects
+        :param chunk_size: the number of characters of output that are
+                           collected before a chunk is produced
+        :param queue_size: if not `0` or `None`, the number of chunks the
+                           serializing thread can get ahead of the iteration
+        :return: an iterator over `str` or `unicode` objects (depending on the
+                 `encoding` parameter)
+        :rtype: ``iterator``
+        
+        :see: XMLSerializer, XHTMLSerializer, HTMLSerializer, TextSerializer
+        :since: version 0.7
+        """
+        from genshi.output import _iterencode
+        if method is None:
+            method = self.serializer or 'xml'
+        generator = self._serialize_encoded(method, encoding, kwargs)
+        return _iterencode(generator, method=method, encoding=encoding,
+                           chunk_size=chunk_size, queue_size=queue_size)
+
+    def render_async(self, out, method=None, encoding='utf-8',
+                     chunk_size=16384, **kwargs):
+        """Return an awaitable object that writes the string representation of
+        the stream to an asynchronous writer, in chunks of about `chunk_size`
+        characters.
+        
+        This is how streams produced by `Template.generate_async()` are
+        rendered: at every `AWAIT` event in the stream, the object in the event
+        data is awaited before the rest of the stream is generated. Between
+        chunks, control is returned to the event loop, so that rendering a big
+        document does not keep other tasks from running::
+        
+            async def handle(reader, writer):
+                stream = tmpl.generate_async(entries=fetch_entries())
+                await stream.render_async(writer, method='html')
+                writer.close()
+        
+        The `write()` method of `out` may return an awaitable, which is then
+        awaited. If `out` has a ``drain()`` method, like the ``StreamWriter``
+        of ``asyncio``, it is awaited after every write. A `FLUSH` event in the
+        stream ends the current chunk.
+        
+        Any additional keyword arguments are passed to the serializer, and thus
+        depend on the `method` parameter value.
+        
+        :param out: the object the output is written to
+        :param method: determines how the stream is serialized; can be either
+                       "xml", "xhtml", "html", "text", or a custom serializer
+                       class; if `None`, the default serialization method of
+                       the stream is used
+        :param encoding: how the output strings should be encoded; if set to
+                         `None`, `unicode` objects are written
+        :param chunk_size: the number of characters of output that are
+                           collected before a chunk is written
+        :return: an awaitable object that completes when the output has been
+                 written
+        
+        :see: XMLSerializer, XHTMLSerializer, HTMLSerializer, TextSerializer
+        :since: version 0.7
+        """
+        from genshi.output import _AsyncRender
+        if method is None:
+            method = self.serializer or 'xml'
+        awaiting = []
+
+        def _pipe(stream):
+            # The serializers stop at a flush, so that the awaitables can be
+            # resolved before any event after them is generated
+            for event in stream:
+                if event[0] is AWAIT:
+                    awaiting.append(event[1])
+                    yield FLUSH, None, event[2]
+                else:
+                    yield event
+        generator = self.__class__(_pipe(self.events), self.serializer) \
+                        ._serialize_encoded(method, encoding, kwargs)
+        return _AsyncRender(generator, awaiting, out, method=method,
+                            encoding=encoding, chunk_size=chunk_size)
+
+    def _serialize_encoded(self, method, encoding, kwargs):
+        from genshi.output import XMLSerializer, XHTMLSerializer, \
+                                  HTMLSerializer
+        if encoding is not None and method in ('xml', 'xhtml', 'html',
+                                               XMLSerializer, XHTMLSerializer,
+                                               HTMLSerializer):
+            # The markup serializers produce encoded output themselves, so
+            # that cached output is only encoded once
+            kwargs['encoding'] = encoding
+        return self.serialize(method=method, **kwargs)
 
     def select(self, path, namespaces=None, variables=None):
         """Return a new stream that contains the events matching the given
@@ -265,6 +402,8 @@ START_CDATA = Stream.START_CDATA
 END_CDATA = Stream.END_CDATA
 PI = Stream.PI
 COMMENT = Stream.COMMENT
+FLUSH = Stream.FLUSH
+AWAIT = Stream.AWAIT
 
 
 def _ensure(stream):
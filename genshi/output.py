@@ -15,21 +15,42 @@
 streams.
 """
 
+from copy import copy
 from itertools import chain
+import os
+from Queue import Queue, Empty
 import re
+import sys
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
+from genshi.compat import reraise
 from genshi.core import escape, Attrs, Markup, Namespace, QName, StreamEventKind
 from genshi.core import START, END, TEXT, XML_DECL, DOCTYPE, START_NS, END_NS, \
-                        START_CDATA, END_CDATA, PI, COMMENT, XML_NAMESPACE
-
-__all__ = ['encode', 'get_serializer', 'DocType', 'XMLSerializer',
-           'XHTMLSerializer', 'HTMLSerializer', 'TextSerializer']
+                        START_CDATA, END_CDATA, PI, COMMENT, FLUSH, \
+                        XML_NAMESPACE
+from genshi.util import LRUCache
+
+try:
+    from genshi._speedups import serialize as _speedups_serialize
+except ImportError:
+    _speedups_serialize = None
+
+__all__ = ['encode', 'get_serializer', 'DocType', 'SerializationCache',
+           'XMLSerializer', 'XHTMLSerializer', 'HTMLSerializer',
+           'TextSerializer']
 __docformat__ = 'restructuredtext en'
 
 
-def encode(iterator, method='xml', encoding=None, out=None):
+def encode(iterator, method='xml', encoding=None, out=None, buffer_size=16384,
+           queue_size=0):
     """Encode serializer output into a string.
     
+    If the iterator yields byte strings, such as the output of a serializer
+    created with an `encoding`, the output is not encoded again.
+    
     :param iterator: the iterator returned from serializing a stream (basically
                      any iterator that yields unicode objects)
     :param method: the serialization method; determines how characters not
@@ -37,14 +58,232 @@ def encode(iterator, method='xml', encoding=None, out=None):
     :param encoding: how the output string should be encoded; if set to `None`,
                      this method returns a `unicode` object
     :param out: a file-like object that the output should be written to
-                instead of being returned as one big string; note that if
-                this is a file or socket (or similar), the `encoding` must
-                not be `None` (that is, the output must be encoded)
+                instead of being returned as one big string, or the number of
+                a file descriptor; note that if this is a file or socket (or
+                similar), the `encoding` must not be `None` (that is, the
+                output must be encoded)
+    :param buffer_size: the number of characters of output that are collected
+                        before they are encoded and written to `out`; if `0`
+                        or `None`, every chunk of serializer output is written
+                        separately
+    :param queue_size: if not `0` or `None`, the iterator is consumed, and the
+                       output encoded, in a separate thread while the output
+                       is written to `out`; the thread stops when there are
+                       `queue_size` pieces of output waiting to be written
+    
+    Where the stream contains a `FLUSH` event, the output collected up to that
+    point is written to `out` right away, and the `flush()` method of `out`
+    is called if it has one.
     :return: a `str` or `unicode` object (depending on the `encoding`
              parameter), or `None` if the `out` parameter is provided
     
     :since: version 0.4.1
     :note: Changed in 0.5: added the `out` parameter
+    :note: Changed in 0.7: added the `buffer_size` and `queue_size`
+           parameters, and `out` can be a file descriptor
+    """
+    if out is None:
+        iterator, _encode, _join = _prepare_encode(iterator, method, encoding)
+        return _encode(_join(list(iterator)))
+
+    if isinstance(out, (int, long)):
+        _write = lambda strings: _write_fd(out, strings)
+        _flush = None
+    else:
+        def _write(strings):
+            for string in strings:
+                out.write(string)
+        _flush = getattr(out, 'flush', None)
+    if queue_size:
+        chunks = _produce(_iterbuffer(iterator, method, encoding, buffer_size),
+                          queue_size)
+    else:
+        iterator, _encode, _join = _prepare_encode(iterator, method, encoding)
+        if not buffer_size:
+            for chunk in iterator:
+                if chunk is _FLUSH or chunk is _FLUSH_ENCODED:
+                    if _flush is not None:
+                        _flush()
+                else:
+                    _write([_encode(chunk)])
+            return
+        chunks = _buffer(iterator, _encode, _join, buffer_size)
+
+    for strings in chunks:
+        if strings:
+            _write(strings)
+        elif _flush is not None:
+            _flush()
+
+
+def _iterencode(iterator, method='xml', encoding=None, chunk_size=16384,
+                queue_size=0):
+    """Encode serializer output into strings of about `chunk_size`
+    characters.
+    
+    :see: `encode`
+    """
+    chunks = _iterbuffer(iterator, method, encoding, chunk_size)
+    if queue_size:
+        chunks = _produce(chunks, queue_size)
+    for strings in chunks:
+        for string in strings:
+            yield string
+
+
+def _iterbuffer(iterator, method, encoding, size):
+    """Encode serializer output in pieces of at least `size` characters.
+    
+    Unlike `_buffer`, all of the work is done while iterating.
+    """
+    iterator, _encode, _join = _prepare_encode(iterator, method, encoding)
+    for strings in _buffer(iterator, _encode, _join, size or 1):
+        yield strings
+
+
+def _produce(iterator, size):
+    """Consume `iterator` in a separate thread, and yield the items it
+    produces, with up to `size` items waiting in a queue.
+    
+    An exception raised by `iterator` is raised again in the consuming thread.
+    If the consumer stops early, the thread stops after the next item.
+    """
+    queue = Queue(size)
+    stopped = []
+
+    def _run():
+        try:
+            for item in iterator:
+                queue.put((item, None))
+                if stopped:
+                    return
+            queue.put((None, None))
+        except Exception:
+            queue.put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=_run, name='genshi-render')
+    thread.daemon = True
+    thread.start()
+    try:
+        while 1:
+            item, error = queue.get()
+            if error is not None:
+                # Keep the traceback, so that it leads to the failing code
+                reraise(error)
+            if item is None:
+                break
+            yield item
+    finally:
+        if thread.is_alive():
+            # Make room in the queue until the thread sees that it should stop
+            stopped.append(True)
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.01)
+                except Empty:
+                    pass
+
+
+class _AsyncRender(object):
+    """Awaitable that writes serializer output to an asynchronous writer.
+    
+    Where the serializer output has a flush marker, the objects of the `AWAIT`
+    events that were turned into those flushes are awaited, and the result is
+    stored for the template to pick up.
+    
+    :see: `Stream.render_async`
+    """
+
+    def __init__(self, iterator, awaiting, out, method='xml', encoding=None,
+                 chunk_size=16384):
+        self.iterator = iterator
+        self.awaiting = awaiting
+        self.out = out
+        self.method = method
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+
+    def __await__(self):
+        for awaitable, pending in self._steps():
+            if awaitable is None:
+                # Let other tasks run
+                yield
+                continue
+            if hasattr(awaitable, '__await__'):
+                iterator = awaitable.__await__()
+            else:
+                # A generator-based coroutine
+                iterator = iter(awaitable)
+            value = error = None
+            while 1:
+                try:
+                    if error is not None:
+                        future = iterator.throw(error)
+                    else:
+                        future = iterator.send(value)
+                except StopIteration, e:
+                    if pending is not None:
+                        result = None
+                        if e.args:
+                            result = e.args[0]
+                        pending.set_result(result)
+                    break
+                except Exception, e:
+                    if pending is None:
+                        raise
+                    # The error is raised where the template uses the result
+                    pending.set_exception(e)
+                    break
+                try:
+                    value, error = (yield future), None
+                except Exception, e:
+                    value, error = None, e
+    __iter__ = __await__
+
+    def _steps(self):
+        # Yield ``(awaitable, pending)`` tuples for the objects that need to be
+        # awaited, where `pending` is the `AWAIT` event data the result goes
+        # to, if any
+        iterator, _encode, _join = _prepare_encode(self.iterator, self.method,
+                                                   self.encoding)
+        awaiting = self.awaiting
+        size = self.chunk_size
+        buf = []
+        buffered = 0
+        for chunk in iterator:
+            if chunk is _FLUSH or chunk is _FLUSH_ENCODED:
+                if awaiting:
+                    for pending in awaiting:
+                        yield pending.awaitable, pending
+                    del awaiting[:]
+                    continue
+            else:
+                buf.append(chunk)
+                buffered += len(chunk)
+                if buffered < size:
+                    continue
+            if buf:
+                for step in self._write(_encode(_join(buf))):
+                    yield step
+                del buf[:]
+                buffered = 0
+        if buf:
+            for step in self._write(_encode(_join(buf))):
+                yield step
+
+    def _write(self, string):
+        result = self.out.write(string)
+        if hasattr(result, '__await__'):
+            yield result, None
+        drain = getattr(self.out, 'drain', None)
+        if drain is not None:
+            yield drain(), None
+        yield None, None
+
+
+def _prepare_encode(iterator, method, encoding):
+    """Return the iterator over the serializer output, and the functions for
+    encoding and joining the output.
     """
     if encoding is not None:
         errors = 'replace'
@@ -53,10 +292,107 @@ def encode(iterator, method='xml', encoding=None, out=None):
         _encode = lambda string: string.encode(encoding, errors)
     else:
         _encode = lambda string: string
-    if out is None:
-        return _encode(''.join(list(iterator)))
+    _join = ''.join
+
+    iterator = iter(iterator)
+    for chunk in iterator:
+        if not isinstance(chunk, unicode):
+            # The serializer has already encoded the output
+            _encode = lambda string: string
+            _join = chunk[:0].join
+        iterator = chain([chunk], iterator)
+        break
+    return iterator, _encode, _join
+
+
+def _buffer(iterator, _encode, _join, size):
+    """Join and encode the serializer output in pieces of at least `size`
+    characters, and yield lists of the strings that are to be written at once.
+    
+    At a flush marker, the buffered output is yielded, followed by an empty
+    list.
+    """
+    buf = []
+    buffered = 0
     for chunk in iterator:
-        out.write(_encode(chunk))
+        if chunk is _FLUSH or chunk is _FLUSH_ENCODED:
+            if buf:
+                yield [_encode(_join(buf))]
+                del buf[:]
+                buffered = 0
+            yield []
+            continue
+        if len(chunk) >= size:
+            # Big chunks, such as pre-serialized static markup, are written
+            # along with the buffer instead of being copied into it
+            strings = buf and [_encode(_join(buf))] or []
+            strings.append(_encode(chunk))
+            yield strings
+            del buf[:]
+            buffered = 0
+            continue
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield [_encode(_join(buf))]
+            del buf[:]
+            buffered = 0
+    if buf:
+        yield [_encode(_join(buf))]
+
+
+def _encode_chunks(iterator, encoding, size=64):
+    """Encode serializer output, joining a number of chunks at a time so that
+    fewer strings need to be encoded.
+    """
+    buf = []
+    for chunk in iterator:
+        if chunk is _FLUSH:
+            if buf:
+                yield ''.join(buf).encode(encoding, 'xmlcharrefreplace')
+                del buf[:]
+            yield _FLUSH_ENCODED
+            continue
+        buf.append(chunk)
+        if len(buf) >= size:
+            yield ''.join(buf).encode(encoding, 'xmlcharrefreplace')
+            del buf[:]
+    if buf:
+        yield ''.join(buf).encode(encoding, 'xmlcharrefreplace')
+
+
+class _FlushMarker(unicode):
+    """The type of the empty string that the serializers produce for a `FLUSH`
+    event.
+    
+    As the marker is empty, it can be joined with the rest of the output.
+    """
+    __slots__ = []
+
+
+class _EncodedFlushMarker(bytes):
+    """The type of the flush marker in encoded serializer output."""
+    __slots__ = []
+
+_FLUSH = _FlushMarker()
+_FLUSH_ENCODED = _EncodedFlushMarker()
+
+
+def _write_fd(fd, strings, writev=getattr(os, 'writev', None)):
+    """Write a list of strings to a file descriptor, using a single vectored
+    write where the platform supports that.
+    """
+    if writev is None:
+        for string in strings:
+            while string:
+                string = string[os.write(fd, string):]
+        return
+    while strings:
+        written = writev(fd, strings)
+        while strings and written >= len(strings[0]):
+            written -= len(strings.pop(0))
+        if written:
+            strings[0] = strings[0][written:]
 
 
 def get_serializer(method='xml', **kwargs):
@@ -66,7 +402,11 @@ def get_serializer(method='xml', **kwargs):
                    "html", "text", or a custom serializer class
 
     Any additional keyword arguments are passed to the serializer, and thus
-    depend on the `method` parameter value.
+    depend on the `method` parameter value. For example, the serializers for
+    "xml", "xhtml" and "html" use a single loop for their filters and the
+    serialization if the `fused` argument is `True`:
+    
+    >>> serializer = get_serializer('xhtml', fused=True)
     
     :see: `XMLSerializer`, `XHTMLSerializer`, `HTMLSerializer`, `TextSerializer`
     :since: version 0.4.1
@@ -103,6 +443,155 @@ def _prepare_cache(use_cache=True):
     return _emit, _get, cache
 
 
+class _SharedCacheView(dict):
+    """The output cache of a single serialization that uses a shared
+    `SerializationCache` for the output of start and end tags.
+    
+    The output is kept in this dictionary for the duration of the
+    serialization, so that the shared cache is only consulted on the first
+    occurrence of each tag. The dictionary is emptied whenever it grows beyond
+    the capacity of the shared cache.
+    """
+
+    def __init__(self, cache, key):
+        """Create the view.
+        
+        :param cache: the `SerializationCache` instance
+        :param key: the key for the serializer configuration, which is added to
+                    the keys of the output in the shared cache
+        """
+        dict.__init__(self)
+        self.cache = cache
+        self.key = key
+
+    def __missing__(self, key):
+        kind = key[0]
+        if kind is START or kind is END or kind is EMPTY:
+            output = self.cache.get((self.key,) + key)
+            if output is not None:
+                self._store(key, output)
+            return output
+
+    def _store(self, key, output):
+        if len(self) >= self.cache.capacity:
+            self.clear()
+        self[key] = output
+
+    def emit(self, kind, input, output):
+        """Store the output for an event, and return it."""
+        if kind is START or kind is END or kind is EMPTY:
+            self.cache.set((self.key, kind, input), output)
+            self._store((kind, input), output)
+        return output
+
+
+class SerializationCache(object):
+    """A bounded cache for the serialized output of start tags, end tags and
+    empty elements, which can be shared by serializers across renders and
+    threads.
+    
+    By default, the XML, XHTML and HTML serializers cache their output only for
+    the duration of a single serialization. If an instance of this class is
+    passed to them as the `cache` option instead, the output for tags is kept
+    in this cache, and reused by any later serialization with a serializer of
+    the same class. When the cache is full, the least recently used entries
+    are discarded.
+    
+    >>> from genshi.builder import tag
+    >>> cache = SerializationCache(100)
+    >>> elem = tag.ul(tag.li('1', class_='item'), tag.li('2', class_='item'))
+    >>> print(elem.generate().render('html', cache=cache, encoding=None))
+    <ul><li class="item">1</li><li class="item">2</li></ul>
+    >>> print(elem.generate().render('html', cache=cache, encoding=None))
+    <ul><li class="item">1</li><li class="item">2</li></ul>
+    
+    Each serialization also keeps the output it uses in a private dictionary,
+    so the shared cache is only consulted on the first occurrence of a tag in
+    every serialization. The statistics on these lookups can be used to choose
+    the size of the cache:
+    
+    >>> cache.size, cache.hits, cache.misses
+    (4, 4, 4)
+    >>> print('%.2f' % cache.hit_rate)
+    0.50
+    
+    Text is not cached, as escaping it takes about as long as looking it up.
+    
+    :since: version 0.7
+    """
+
+    def __init__(self, capacity=10000):
+        """Create the cache.
+        
+        :param capacity: the maximum number of entries to keep
+        """
+        self.capacity = capacity
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+        self.hits = 0 #: the number of lookups that found an entry
+        self.misses = 0 #: the number of lookups that didn't find an entry
+
+    def __repr__(self):
+        return '<%s %d/%d entries, %d hits, %d misses>' % (
+            type(self).__name__, self.size, self.capacity, self.hits,
+            self.misses
+        )
+
+    @property
+    def size(self):
+        """The number of entries in the cache."""
+        return len(self._cache)
+
+    @property
+    def hit_rate(self):
+        """The ratio of lookups that found an entry, between 0 and 1."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def get(self, key):
+        """Return the cached output for the given key, or `None` if there is
+        no such entry.
+        
+        :param key: a tuple of the serializer configuration, the event kind,
+                    and the event data
+        """
+        self._lock.acquire()
+        try:
+            try:
+                output = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return output
+        finally:
+            self._lock.release()
+
+    def set(self, key, output):
+        """Store the output for the given key.
+        
+        :param key: a tuple of the serializer configuration, the event kind,
+                    and the event data
+        :param output: the serialized output
+        """
+        self._lock.acquire()
+        try:
+            self._cache[key] = output
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all entries from the cache, and reset the statistics."""
+        self._lock.acquire()
+        try:
+            self._cache = LRUCache(self.capacity)
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
 class DocType(object):
     """Defines a number of commonly used DOCTYPE declarations as constants."""
 
@@ -205,7 +694,8 @@ class XMLSerializer(object):
     _PRESERVE_SPACE = frozenset()
 
     def __init__(self, doctype=None, strip_whitespace=True,
-                 namespace_prefixes=None, cache=True):
+                 namespace_prefixes=None, cache=True, fused=False,
+                 encoding=None):
         """Initialize the XML serializer.
         
         :param doctype: a ``(name, pubid, sysid)`` tuple that represents the
@@ -215,11 +705,21 @@ class XMLSerializer(object):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; can also be
+                      a `SerializationCache` to share between serializations
+        :param fused: whether the work of the filters and of the serializer
+                      should be done in a single loop, instead of passing the
+                      stream through each filter in turn
+        :param encoding: if given, the output is produced as byte strings in
+                         this encoding instead of `Markup` objects
         :note: Changed in 0.4.2: The  `doctype` parameter can now be a string.
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.7: The `fused` and `encoding` parameters were
+               added, and the `cache` parameter accepts a `SerializationCache`
         """
-        self.filters = [EmptyTagFilter()]
+        self.filters = [StaticChunkFilter(self, strip_whitespace,
+                                          self._PRESERVE_SPACE,
+                                          prefixes=namespace_prefixes)]
         if strip_whitespace:
             self.filters.append(WhitespaceFilter(self._PRESERVE_SPACE))
         self.filters.append(NamespaceFlattener(prefixes=namespace_prefixes,
@@ -227,17 +727,73 @@ class XMLSerializer(object):
         if doctype:
             self.filters.append(DocTypeInserter(doctype))
         self.cache = cache
+        self.fused = fused
+        self.encoding = encoding
 
     def _prepare_cache(self):
+        if isinstance(self.cache, SerializationCache):
+            cache = _SharedCacheView(self.cache, type(self))
+            return cache.emit, cache.__getitem__
         return _prepare_cache(self.cache)[:2]
 
+    def _cache_key(self):
+        # Entries in a shared cache are keyed by the serializer class, which
+        # determines the output for tags
+        if isinstance(self.cache, SerializationCache):
+            return type(self)
+
+    def _encode(self, output):
+        if self.encoding is None:
+            return output
+        return _encode_chunks(output, self.encoding)
+
+    def _fuse(self, stream, method, *args, **kwargs):
+        """Serialize the stream using the fused loop, if the filters of the
+        serializer allow that.
+        
+        :param stream: the event stream to serialize
+        :param method: the serialization method
+        :return: an iterator over the serialized output, or `None` if the
+                 filters have been replaced or extended so that the stream
+                 needs to be passed through them
+        """
+        filters = list(self.filters)
+        if not filters or type(filters[0]) is not StaticChunkFilter:
+            return None
+        chunks = filters.pop(0)
+        whitespace = doctype = None
+        if filters and type(filters[0]) is WhitespaceFilter:
+            whitespace = filters.pop(0)
+        if not filters or type(filters[0]) is not NamespaceFlattener:
+            return None
+        flattener = filters.pop(0)
+        if filters and type(filters[0]) is DocTypeInserter:
+            doctype = filters.pop(0).doctype_event[1]
+        if filters:
+            return None
+        kwargs['encoding'] = self.encoding
+        return _serialize_fused(stream, method, chunks, whitespace, flattener,
+                                doctype, self.cache and flattener.cache,
+                                *args, **kwargs)
+
     def __call__(self, stream):
+        if self.fused:
+            output = self._fuse(stream, 'xml')
+            if output is not None:
+                return output
+        for filter_ in self.filters:
+            stream = filter_(stream)
+        if _speedups_serialize is not None:
+            return _speedups_serialize(stream, 'xml', self.cache,
+                                       cache_key=self._cache_key(),
+                                       encoding=self.encoding)
+        return self._encode(self._serialize(stream))
+
+    def _serialize(self, stream):
         have_decl = have_doctype = False
         in_cdata = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -301,6 +857,9 @@ class XMLSerializer(object):
             elif kind is PI:
                 yield _emit(kind, data, Markup('<?%s %s?>' % data))
 
+            elif kind is FLUSH:
+                yield _FLUSH
+
 
 class XHTMLSerializer(XMLSerializer):
     """Produces XHTML text from an event stream.
@@ -323,21 +882,43 @@ class XHTMLSerializer(XMLSerializer):
     ])
 
     def __init__(self, doctype=None, strip_whitespace=True,
-                 namespace_prefixes=None, drop_xml_decl=True, cache=True):
+                 namespace_prefixes=None, drop_xml_decl=True, cache=True,
+                 fused=False, encoding=None):
         super(XHTMLSerializer, self).__init__(doctype, False)
-        self.filters = [EmptyTagFilter()]
-        if strip_whitespace:
-            self.filters.append(WhitespaceFilter(self._PRESERVE_SPACE))
         namespace_prefixes = namespace_prefixes or {}
         namespace_prefixes['http://www.w3.org/1999/xhtml'] = ''
+        self.filters = [StaticChunkFilter(self, strip_whitespace,
+                                          self._PRESERVE_SPACE,
+                                          prefixes=namespace_prefixes)]
+        if strip_whitespace:
+            self.filters.append(WhitespaceFilter(self._PRESERVE_SPACE))
         self.filters.append(NamespaceFlattener(prefixes=namespace_prefixes,
                                                cache=cache))
         if doctype:
             self.filters.append(DocTypeInserter(doctype))
         self.drop_xml_decl = drop_xml_decl
         self.cache = cache
+        self.fused = fused
+        self.encoding = encoding
 
     def __call__(self, stream):
+        if self.fused:
+            output = self._fuse(stream, 'xhtml', self._BOOLEAN_ATTRS,
+                                self._EMPTY_ELEMS,
+                                drop_xml_decl=self.drop_xml_decl)
+            if output is not None:
+                return output
+        for filter_ in self.filters:
+            stream = filter_(stream)
+        if _speedups_serialize is not None:
+            return _speedups_serialize(stream, 'xhtml', self.cache,
+                                       self._BOOLEAN_ATTRS, self._EMPTY_ELEMS,
+                                       drop_xml_decl=self.drop_xml_decl,
+                                       cache_key=self._cache_key(),
+                                       encoding=self.encoding)
+        return self._encode(self._serialize(stream))
+
+    def _serialize(self, stream):
         boolean_attrs = self._BOOLEAN_ATTRS
         empty_elems = self._EMPTY_ELEMS
         drop_xml_decl = self.drop_xml_decl
@@ -345,8 +926,6 @@ class XHTMLSerializer(XMLSerializer):
         in_cdata = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, pos in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -423,6 +1002,9 @@ class XHTMLSerializer(XMLSerializer):
             elif kind is PI:
                 yield _emit(kind, data, Markup('<?%s %s?>' % data))
 
+            elif kind is FLUSH:
+                yield _FLUSH
+
 
 class HTMLSerializer(XHTMLSerializer):
     """Produces HTML text from an event stream.
@@ -438,7 +1020,8 @@ class HTMLSerializer(XHTMLSerializer):
         QName('style'), QName('http://www.w3.org/1999/xhtml}style')
     ])
 
-    def __init__(self, doctype=None, strip_whitespace=True, cache=True):
+    def __init__(self, doctype=None, strip_whitespace=True, cache=True,
+                 fused=False, encoding=None):
         """Initialize the HTML serializer.
         
         :param doctype: a ``(name, pubid, sysid)`` tuple that represents the
@@ -447,11 +1030,20 @@ class HTMLSerializer(XHTMLSerializer):
         :param strip_whitespace: whether extraneous whitespace should be
                                  stripped from the output
         :param cache: whether to cache the text output per event, which
-                      improves performance for repetitive markup
+                      improves performance for repetitive markup; can also be
+                      a `SerializationCache` to share between serializations
+        :param fused: whether the work of the filters and of the serializer
+                      should be done in a single loop
+        :param encoding: if given, the output is produced as byte strings in
+                         this encoding instead of `Markup` objects
         :note: Changed in 0.6: The `cache` parameter was added
+        :note: Changed in 0.7: The `fused` and `encoding` parameters were
+               added, and the `cache` parameter accepts a `SerializationCache`
         """
         super(HTMLSerializer, self).__init__(doctype, False)
-        self.filters = [EmptyTagFilter()]
+        self.filters = [StaticChunkFilter(self, strip_whitespace,
+                                          self._PRESERVE_SPACE,
+                                          self._NOESCAPE_ELEMS)]
         if strip_whitespace:
             self.filters.append(WhitespaceFilter(self._PRESERVE_SPACE,
                                                  self._NOESCAPE_ELEMS))
@@ -460,9 +1052,27 @@ class HTMLSerializer(XHTMLSerializer):
         }, cache=cache))
         if doctype:
             self.filters.append(DocTypeInserter(doctype))
-        self.cache = True
+        self.cache = cache
+        self.fused = fused
+        self.encoding = encoding
 
     def __call__(self, stream):
+        if self.fused:
+            output = self._fuse(stream, 'html', self._BOOLEAN_ATTRS,
+                                self._EMPTY_ELEMS, self._NOESCAPE_ELEMS)
+            if output is not None:
+                return output
+        for filter_ in self.filters:
+            stream = filter_(stream)
+        if _speedups_serialize is not None:
+            return _speedups_serialize(stream, 'html', self.cache,
+                                       self._BOOLEAN_ATTRS, self._EMPTY_ELEMS,
+                                       self._NOESCAPE_ELEMS,
+                                       cache_key=self._cache_key(),
+                                       encoding=self.encoding)
+        return self._encode(self._serialize(stream))
+
+    def _serialize(self, stream):
         boolean_attrs = self._BOOLEAN_ATTRS
         empty_elems = self._EMPTY_ELEMS
         noescape_elems = self._NOESCAPE_ELEMS
@@ -470,8 +1080,6 @@ class HTMLSerializer(XHTMLSerializer):
         noescape = False
         _emit, _get = self._prepare_cache()
 
-        for filter_ in self.filters:
-            stream = filter_(stream)
         for kind, data, _ in stream:
             if kind is TEXT and isinstance(data, Markup):
                 yield data
@@ -534,6 +1142,9 @@ class HTMLSerializer(XHTMLSerializer):
             elif kind is PI:
                 yield _emit(kind, data, Markup('<?%s %s?>' % data))
 
+            elif kind is FLUSH:
+                yield _FLUSH
+
 
 class TextSerializer(object):
     """Produces plain text from an event stream.
@@ -580,6 +1191,8 @@ class TextSerializer(object):
                 if strip_markup and type(data) is Markup:
                     data = data.striptags().stripentities()
                 yield unicode(data)
+            elif event[0] is FLUSH:
+                yield _FLUSH
 
 
 class EmptyTagFilter(object):
@@ -636,11 +1249,23 @@ class NamespaceFlattener(object):
     def __call__(self, stream):
         prefixes = dict([(v, [k]) for k, v in self.prefixes.items()])
         namespaces = {XML_NAMESPACE.uri: ['xml']}
-        _emit, _get, cache = _prepare_cache(self.cache)
+        use_cache = self.cache
+        scope_caches = {}
+        def _scope_cache():
+            # The output for an event only depends on the prefixes the
+            # namespace URIs are bound to, so there's a cache for every set of
+            # bindings, which is used again when the bindings are back in scope
+            scope = frozenset([(uri, uri_prefixes[-1]) for uri, uri_prefixes
+                               in namespaces.items()])
+            cache = scope_caches.get(scope)
+            if cache is None:
+                cache = scope_caches[scope] = {}
+            return cache
+        cache = _scope_cache()
+        _get = cache.get
         def _push_ns(prefix, uri):
             namespaces.setdefault(uri, []).append(prefix)
             prefixes.setdefault(prefix, []).append(uri)
-            cache.clear()
         def _pop_ns(prefix):
             uris = prefixes.get(prefix)
             uri = uris.pop()
@@ -651,7 +1276,6 @@ class NamespaceFlattener(object):
                 uri_prefixes.pop()
                 if not uri_prefixes:
                     del namespaces[uri]
-            cache.clear()
             return uri
 
         ns_attrs = []
@@ -670,12 +1294,15 @@ class NamespaceFlattener(object):
             if kind is TEXT and isinstance(data, Markup):
                 yield kind, data, pos
                 continue
-            output = _get((kind, data))
+            # The output for a start tag that declares namespaces includes
+            # the declarations, so it isn't cached
+            output = not ns_attrs and _get((kind, data)) or None
             if output is not None:
                 yield kind, output, pos
 
             elif kind is START or kind is EMPTY:
                 tag, attrs = data
+                declares = bool(ns_attrs) or not use_cache
 
                 tagname = tag.localname
                 tagns = tag.namespace
@@ -703,9 +1330,17 @@ class NamespaceFlattener(object):
                             attrname = '%s:%s' % (prefix, attrname)
                     new_attrs.append((attrname, value))
 
-                data = _emit(kind, data, (tagname, Attrs(ns_attrs + new_attrs)))
-                yield kind, data, pos
-                del ns_attrs[:]
+                output = tagname, Attrs(ns_attrs + new_attrs)
+                if declares or ns_attrs:
+                    # Undeclared namespaces used by the element have been
+                    # bound just now, which changes the scope
+                    del ns_attrs[:]
+                    if use_cache:
+                        cache = _scope_cache()
+                        _get = cache.get
+                else:
+                    cache[kind, data] = output
+                yield kind, output, pos
 
             elif kind is END:
                 tagname = data.localname
@@ -714,7 +1349,9 @@ class NamespaceFlattener(object):
                     prefix = namespaces[tagns][-1]
                     if prefix:
                         tagname = '%s:%s' % (prefix, tagname)
-                yield kind, _emit(kind, data, tagname), pos
+                if use_cache:
+                    cache[kind, data] = tagname
+                yield kind, tagname, pos
 
             elif kind is START_NS:
                 prefix, uri = data
@@ -722,6 +1359,9 @@ class NamespaceFlattener(object):
                     prefix = prefixes.get(uri, [prefix])[-1]
                     _push_ns_attr(_make_ns_attr(prefix, uri))
                 _push_ns(prefix, uri)
+                if use_cache:
+                    cache = _scope_cache()
+                    _get = cache.get
 
             elif kind is END_NS:
                 if data in prefixes:
@@ -730,6 +1370,9 @@ class NamespaceFlattener(object):
                         attr = _make_ns_attr(data, uri)
                         if attr in ns_attrs:
                             ns_attrs.remove(attr)
+                    if use_cache:
+                        cache = _scope_cache()
+                        _get = cache.get
 
             else:
                 yield kind, data, pos
@@ -811,6 +1454,233 @@ class WhitespaceFilter(object):
                     yield kind, data, pos
 
 
+class StaticChunk(object):
+    """A well-balanced sequence of static markup events, such as the literal
+    parts of a template, whose serialized form only needs to be computed once.
+    
+    Templates replace such sequences in their prepared stream by a single
+    `STATIC` event with a `StaticChunk` as data. Serializers that support it
+    (through the `StaticChunkFilter`) copy the pre-serialized markup to the
+    output, while other consumers simply get the original events.
+    
+    :since: version 0.7
+    """
+    __slots__ = ['events', 'namespaces', 'cache']
+
+    def __init__(self, events):
+        """Create the chunk.
+        
+        :param events: the list of events in the chunk
+        """
+        self.events = events #: the original events
+        self.cache = {} #: serialized output keyed by serializer state
+
+        # Determine the namespaces used, but not declared, inside the chunk
+        declared = set([XML_NAMESPACE.uri])
+        used = set()
+        for kind, data, pos in events:
+            if kind is START:
+                tag, attrs = data
+                used.add(QName(tag).namespace)
+                for name, value in attrs:
+                    used.add(QName(name).namespace)
+            elif kind is START_NS:
+                declared.add(data[1])
+        used.discard(None)
+        self.namespaces = frozenset(used - declared)
+
+    def __repr__(self):
+        return '<%s %d events>' % (type(self).__name__, len(self.events))
+
+
+class StaticChunkFilter(EmptyTagFilter):
+    """A filter that replaces `STATIC` events by their pre-serialized output,
+    if the state of the serialization pipeline allows it; otherwise, the
+    original events of the chunk are passed on.
+    
+    The output of a chunk is cached on the `StaticChunk` object itself, so that
+    it can be reused across serializations.
+    
+    To avoid an additional pass over the stream, this filter also combines
+    `START` and `END` events into `EMPTY` events, just like the
+    `EmptyTagFilter` it replaces in the serializers.
+    
+    :since: version 0.7
+    """
+
+    STATIC = StreamEventKind('STATIC')
+
+    def __init__(self, serializer, strip_whitespace=True, preserve=None,
+                 noescape=None, prefixes=None):
+        """Initialize the filter.
+        
+        :param serializer: the serializer the filter is used by
+        :param strip_whitespace: whether the serializer strips extraneous
+                                 white-space from the output
+        :param preserve: a set or sequence of tag names for which white-space
+                         is preserved
+        :param noescape: a set or sequence of tag names for which text content
+                         is not escaped
+        :param prefixes: the mapping of namespace URIs to prefixes the
+                         serializer was configured with
+        """
+        self.serializer = serializer
+        self.strip_whitespace = strip_whitespace
+        if preserve is None:
+            preserve = []
+        self.preserve = frozenset(preserve)
+        if noescape is None:
+            noescape = []
+        self.noescape = frozenset(noescape)
+        if prefixes:
+            prefixes = tuple(sorted(prefixes.items()))
+        self.key = (type(serializer), strip_whitespace, self.preserve,
+                    self.noescape, prefixes)
+
+    def __call__(self, stream, space=XML_NAMESPACE['space']):
+        key = self.key
+        strip = self.strip_whitespace
+        preserve_elems = self.preserve
+        noescape_elems = self.noescape
+        preserve = 0
+        noescape = pending = dirty = False
+        declared = []
+        namespaces = ()
+        uris = {None: 1, XML_NAMESPACE.uri: 1}
+
+        prev = None # pending start event, which may turn out to be empty
+        stack = []
+        stream = iter(stream)
+        while 1:
+            for event in stream:
+                kind = event[0]
+
+                if kind is START:
+                    tag, attrs = event[1]
+                    pending = False
+                    if tag.namespace not in uris:
+                        dirty = True
+                    if attrs:
+                        for attr, value in attrs:
+                            if attr.namespace not in uris:
+                                dirty = True
+                    if preserve:
+                        preserve += 1
+                    elif strip and (tag in preserve_elems or
+                                    attrs and attrs.get(space) == 'preserve'):
+                        preserve += 1
+                    if tag in noescape_elems:
+                        noescape = True
+                    if prev is not None:
+                        yield prev
+                    prev = event
+                    continue
+
+                elif kind is END:
+                    noescape = False
+                    if preserve:
+                        preserve -= 1
+                    if prev is not None:
+                        yield EMPTY, prev[1], prev[2]
+                        prev = None
+                        continue
+
+                elif kind is TEXT:
+                    pass
+
+                elif kind is STATIC:
+                    chunk = event[1]
+                    if not (noescape or pending or dirty):
+                        for uri in chunk.namespaces:
+                            if uri not in uris:
+                                break
+                        else:
+                            state = key, preserve > 0, namespaces
+                            output = chunk.cache.get(state)
+                            if output is None:
+                                output = self._render(chunk, preserve > 0,
+                                                      declared)
+                                chunk.cache[state] = output
+                            if output is not False:
+                                if prev is not None:
+                                    yield prev
+                                    prev = None
+                                yield TEXT, output, event[2]
+                                continue
+                    # The serializer needs to see the actual events
+                    stack.append(stream)
+                    stream = iter(chunk.events)
+                    break
+
+                elif kind is START_NS:
+                    declared.append(event[1])
+                    namespaces = tuple(declared)
+                    uri = event[1][1]
+                    uris[uri] = uris.get(uri, 0) + 1
+                    pending = True
+
+                elif kind is END_NS:
+                    for idx in range(len(declared) - 1, -1, -1):
+                        if declared[idx][0] == event[1]:
+                            uri = declared.pop(idx)[1]
+                            namespaces = tuple(declared)
+                            uris[uri] -= 1
+                            if not uris[uri]:
+                                del uris[uri]
+                            break
+
+                elif kind is START_CDATA:
+                    noescape = True
+
+                elif kind is END_CDATA:
+                    noescape = False
+
+                if prev is not None:
+                    yield prev
+                    prev = None
+                yield event
+
+            else:
+                if not stack:
+                    break
+                stream = stack.pop()
+
+    def _render(self, chunk, preserve, declared,
+                trim_trailing_space=re.compile('[ \t]+(?=\n)').sub,
+                collapse_lines=re.compile('\n{2,}').sub):
+        serializer = copy(self.serializer)
+        serializer.encoding = None
+        serializer.filters = [EmptyTagFilter()]
+        for filter_ in self.serializer.filters:
+            if not isinstance(filter_, (EmptyTagFilter, DocTypeInserter)):
+                serializer.filters.append(filter_)
+
+        # Wrap the events in a dummy element that reproduces the namespace and
+        # white-space handling state; the markup for the dummy element is then
+        # dropped from the output
+        pos = (None, -1, -1)
+        wrapper = QName('static')
+        attrs = []
+        if preserve:
+            attrs.append((XML_NAMESPACE['space'], 'preserve'))
+        events = [(START_NS, ns, pos) for ns in declared]
+        events.append((START, (wrapper, Attrs(attrs)), pos))
+        events.extend(chunk.events)
+        events.append((END, wrapper, pos))
+        events.extend([(END_NS, ns[0], pos) for ns in reversed(declared)])
+        output = Markup(''.join(list(serializer(iter(events)))[1:-1]))
+
+        if self.strip_whitespace and not preserve:
+            # The white-space filter will see the output as a single text
+            # event, so it must not be changed by that
+            if collapse_lines('\n', trim_trailing_space('', output)) != output:
+                return False
+        return output
+
+
+STATIC = StaticChunkFilter.STATIC
+
+
 class DocTypeInserter(object):
     """A filter that inserts the DOCTYPE declaration in the correct location,
     after the XML declaration.
@@ -839,3 +1709,447 @@ class DocTypeInserter(object):
 
         if not doctype_inserted:
             yield self.doctype_event
+
+
+def _serialize_fused(stream, method, chunks, whitespace, flattener, doctype,
+                     cache=True, boolean_attrs=frozenset(),
+                     empty_elems=frozenset(), noescape_elems=frozenset(),
+                     drop_xml_decl=True, encoding=None,
+                     space=XML_NAMESPACE['space'],
+                     trim_trailing_space=re.compile('[ \t]+(?=\n)').sub,
+                     collapse_lines=re.compile('\n{2,}').sub):
+    """Serialize a stream in a single loop that does the work of the
+    `StaticChunkFilter`, `WhitespaceFilter`, `NamespaceFlattener` and
+    `DocTypeInserter` along with that of the serializer itself.
+    
+    The output is the same as that of the separate filters and serializer, but
+    no intermediate events are created: tag names and text are processed as
+    plain strings, and the markup produced for a number of consecutive events
+    is only joined and wrapped in a `Markup` object when it is yielded.
+    
+    :param stream: the event stream to serialize
+    :param method: the serialization method; "xml", "xhtml", or "html"
+    :param chunks: the `StaticChunkFilter` of the serializer
+    :param whitespace: the `WhitespaceFilter` of the serializer, or `None`
+    :param flattener: the `NamespaceFlattener` of the serializer
+    :param doctype: the ``(name, pubid, sysid)`` tuple of the ``DOCTYPE`` to
+                    insert, or `None`
+    :param cache: whether to cache the output per event
+    :param encoding: the encoding of the output, or `None` to produce `Markup`
+    """
+    xhtml = method == 'xhtml'
+    html = method == 'html'
+
+    # State of the static chunk filter
+    key = chunks.key
+    declared = []
+    namespaces = ()
+    uris = {None: 1, XML_NAMESPACE.uri: 1}
+    pending = dirty = False
+    stack = []
+
+    # State of the white-space filter; the `noescape` flag is also needed to
+    # decide whether static chunks can be used
+    strip = whitespace is not None
+    if strip:
+        preserve_elems = whitespace.preserve
+        text_noescape_elems = whitespace.noescape
+    else:
+        preserve_elems = frozenset()
+        text_noescape_elems = chunks.noescape
+    preserve = 0
+    noescape = False
+    textbuf = []
+    push_text = textbuf.append
+
+    # State of the namespace flattener
+    prefixes = dict([(v, [k]) for k, v in flattener.prefixes.items()])
+    ns_uris = {XML_NAMESPACE.uri: ['xml']}
+    ns_attrs = []
+    scope_caches = {}
+    def _scope_cache():
+        # There's a cache for every set of namespace bindings, as in the
+        # namespace flattener
+        scope = frozenset([(uri, uri_prefixes[-1]) for uri, uri_prefixes
+                           in ns_uris.items()])
+        output_cache = scope_caches.get(scope)
+        if output_cache is None:
+            output_cache = scope_caches[scope] = {}
+        return output_cache
+    output_cache = _scope_cache()
+    _get = output_cache.get
+    def _push_ns(prefix, uri):
+        ns_uris.setdefault(uri, []).append(prefix)
+        prefixes.setdefault(prefix, []).append(uri)
+    def _pop_ns(prefix):
+        uris = prefixes.get(prefix)
+        uri = uris.pop()
+        if not uris:
+            del prefixes[prefix]
+        if uri not in uris or uri != uris[-1]:
+            uri_prefixes = ns_uris[uri]
+            uri_prefixes.pop()
+            if not uri_prefixes:
+                del ns_uris[uri]
+        return uri
+    def _make_ns_attr(prefix, uri):
+        return 'xmlns%s' % (prefix and ':%s' % prefix or ''), uri
+    def _gen_prefix():
+        val = 0
+        while 1:
+            val += 1
+            yield 'ns%d' % val
+    _gen_prefix = _gen_prefix().next
+
+    # State of the serializer
+    have_decl = have_doctype = in_cdata = raw = False
+    first = doctype is not None # whether the DOCTYPE is yet to be inserted
+    def _doctype(data):
+        name, pubid, sysid = data
+        buf = ['<!DOCTYPE %s']
+        if pubid:
+            buf.append(' PUBLIC "%s"')
+        elif sysid:
+            buf.append(' SYSTEM')
+        if sysid:
+            buf.append(' "%s"')
+        buf.append('>\n')
+        return ''.join(buf) % tuple([escape(p) for p in data if p])
+
+    if encoding is None:
+        _output = Markup
+        flush_marker = _FLUSH
+    else:
+        _output = lambda string: string.encode(encoding, 'xmlcharrefreplace')
+        flush_marker = _FLUSH_ENCODED
+
+    # The output for a start tag is only added once the next event shows
+    # whether the element is empty
+    start = empty = None
+    start_preserve = start_noescape = False
+
+    buf = []
+    append = buf.append
+    stream = iter(stream)
+    while 1:
+        for kind, data, pos in stream:
+
+            if start is not None:
+                if kind is END:
+                    append(empty)
+                    start = None
+                    continue
+                append(start)
+                start = None
+                if start_preserve:
+                    preserve += 1
+                if start_noescape:
+                    noescape = True
+
+            if kind is TEXT:
+                if strip:
+                    if noescape:
+                        push_text(data)
+                    else:
+                        push_text(escape(data, quotes=False))
+                    continue
+                if first:
+                    append(_doctype(doctype))
+                    first = False
+                    have_doctype = True
+                if in_cdata or raw or isinstance(data, Markup):
+                    append(data)
+                else:
+                    append(escape(data, quotes=False))
+
+            elif kind is STATIC:
+                output = None
+                if not (noescape or pending or dirty):
+                    for uri in data.namespaces:
+                        if uri not in uris:
+                            break
+                    else:
+                        state = key, preserve > 0, namespaces
+                        output = data.cache.get(state)
+                        if output is None:
+                            output = chunks._render(data, preserve > 0,
+                                                    declared)
+                            data.cache[state] = output
+                if not output:
+                    # The events of the chunk need to be serialized one by one
+                    if buf:
+                        yield _output(''.join(buf))
+                        del buf[:]
+                    stack.append(stream)
+                    stream = iter(data.events)
+                    break
+                if strip:
+                    push_text(output)
+                    continue
+                if first:
+                    append(_doctype(doctype))
+                    first = False
+                    have_doctype = True
+                if encoding is not None:
+                    # The encoded output of the chunk is cached along with its
+                    # markup, and passed on as it is
+                    encoded = data.cache.get((state, encoding))
+                    if encoded is None:
+                        encoded = data.cache[state, encoding] = _output(output)
+                    if buf:
+                        yield _output(''.join(buf))
+                        del buf[:]
+                    yield encoded
+                    continue
+                append(output)
+
+            else:
+                if textbuf:
+                    text = ''.join(textbuf)
+                    del textbuf[:]
+                    if not preserve and '\n' in text:
+                        text = collapse_lines('\n',
+                                              trim_trailing_space('', text))
+                    if first:
+                        append(_doctype(doctype))
+                        first = False
+                        have_doctype = True
+                    append(text)
+
+                if kind is START:
+                    pending = False
+                    if first:
+                        append(_doctype(doctype))
+                        first = False
+                        have_doctype = True
+                    tag, attrs = data
+                    if strip:
+                        start_preserve = preserve or tag in preserve_elems or \
+                                         attrs.get(space) == 'preserve'
+                    start_noescape = tag in text_noescape_elems
+
+                    output = not ns_attrs and _get(data) or None
+                    if output is None:
+                        declares = bool(ns_attrs) or not cache
+                        # Output that isn't cached may use namespaces that
+                        # haven't been declared, in which case static chunks
+                        # can no longer be used
+                        if tag.namespace not in uris:
+                            dirty = True
+                        tagname = tag.localname
+                        tagns = tag.namespace
+                        if tagns:
+                            if tagns in ns_uris:
+                                prefix = ns_uris[tagns][-1]
+                                if prefix:
+                                    tagname = '%s:%s' % (prefix, tagname)
+                            else:
+                                ns_attrs.append(('xmlns', tagns))
+                                _push_ns('', tagns)
+
+                        new_attrs = []
+                        for attr, value in attrs:
+                            attrname = attr.localname
+                            attrns = attr.namespace
+                            if attrns:
+                                if attrns not in uris:
+                                    dirty = True
+                                if attrns not in ns_uris:
+                                    prefix = _gen_prefix()
+                                    _push_ns(prefix, attrns)
+                                    ns_attrs.append(('xmlns:%s' % prefix,
+                                                     attrns))
+                                else:
+                                    prefix = ns_uris[attrns][-1]
+                                if prefix:
+                                    attrname = '%s:%s' % (prefix, attrname)
+                            new_attrs.append((attrname, value))
+                        attrib = ns_attrs + new_attrs
+
+                        parts = ['<', tagname]
+                        if html:
+                            for attr, value in attrib:
+                                if attr in boolean_attrs:
+                                    if value:
+                                        parts += [' ', attr]
+                                elif ':' in attr:
+                                    if attr == 'xml:lang' and 'lang' not in \
+                                            [name for name, _ in attrib]:
+                                        parts += [' lang="', escape(value),
+                                                  '"']
+                                elif attr != 'xmlns':
+                                    parts += [' ', attr, '="', escape(value),
+                                              '"']
+                        else:
+                            for attr, value in attrib:
+                                if xhtml:
+                                    if attr in boolean_attrs:
+                                        value = attr
+                                    elif attr == 'xml:lang' and 'lang' not in \
+                                            [name for name, _ in attrib]:
+                                        parts += [' lang="', escape(value),
+                                                  '"']
+                                    elif attr == 'xml:space':
+                                        continue
+                                parts += [' ', attr, '="', escape(value), '"']
+                        tag = ''.join(parts)
+                        if html:
+                            start = empty = tag + '>'
+                            if tagname not in empty_elems:
+                                empty = '%s></%s>' % (tag, tagname)
+                        elif xhtml:
+                            start = tag + '>'
+                            if tagname in empty_elems:
+                                empty = tag + ' />'
+                            else:
+                                empty = '%s></%s>' % (tag, tagname)
+                        else:
+                            start = tag + '>'
+                            empty = tag + '/>'
+                        output = start, empty, tagname in noescape_elems
+                        if declares or ns_attrs:
+                            del ns_attrs[:]
+                            if cache:
+                                output_cache = _scope_cache()
+                                _get = output_cache.get
+                        else:
+                            output_cache[data] = output
+                    start, empty, is_raw = output
+                    if is_raw:
+                        raw = True
+                    continue
+
+                elif kind is END:
+                    noescape = raw = False
+                    if preserve:
+                        preserve -= 1
+                    if first:
+                        append(_doctype(doctype))
+                        first = False
+                        have_doctype = True
+                    output = _get(data)
+                    if output is None:
+                        tagname = data.localname
+                        tagns = data.namespace
+                        if tagns:
+                            prefix = ns_uris[tagns][-1]
+                            if prefix:
+                                tagname = '%s:%s' % (prefix, tagname)
+                        output = '</%s>' % tagname
+                        if cache:
+                            output_cache[data] = output
+                    append(output)
+
+                elif kind is START_NS:
+                    declared.append(data)
+                    namespaces = tuple(declared)
+                    prefix, uri = data
+                    uris[uri] = uris.get(uri, 0) + 1
+                    pending = True
+                    if uri not in ns_uris:
+                        prefix = prefixes.get(uri, [prefix])[-1]
+                        ns_attrs.append(_make_ns_attr(prefix, uri))
+                    _push_ns(prefix, uri)
+                    if cache:
+                        output_cache = _scope_cache()
+                        _get = output_cache.get
+                    continue
+
+                elif kind is FLUSH:
+                    if buf:
+                        yield _output(''.join(buf))
+                        del buf[:]
+                    yield flush_marker
+                    continue
+
+                elif kind is END_NS:
+                    for idx in range(len(declared) - 1, -1, -1):
+                        if declared[idx][0] == data:
+                            uri = declared.pop(idx)[1]
+                            namespaces = tuple(declared)
+                            uris[uri] -= 1
+                            if not uris[uri]:
+                                del uris[uri]
+                            break
+                    if data in prefixes:
+                        uri = _pop_ns(data)
+                        if ns_attrs:
+                            attr = _make_ns_attr(data, uri)
+                            if attr in ns_attrs:
+                                ns_attrs.remove(attr)
+                        if cache:
+                            output_cache = _scope_cache()
+                            _get = output_cache.get
+                    continue
+
+                else:
+                    if first:
+                        # The DOCTYPE goes after an initial XML declaration
+                        if kind is not XML_DECL:
+                            append(_doctype(doctype))
+                            have_doctype = True
+                        first = False
+
+                    if kind is COMMENT:
+                        append('<!--%s-->' % data)
+
+                    elif kind is XML_DECL:
+                        if not (have_decl or html or
+                                xhtml and drop_xml_decl):
+                            version, decl_encoding, standalone = data
+                            parts = ['<?xml version="%s"' % version]
+                            if decl_encoding:
+                                parts.append(' encoding="%s"' % decl_encoding)
+                            if standalone != -1:
+                                standalone = standalone and 'yes' or 'no'
+                                parts.append(' standalone="%s"' % standalone)
+                            parts.append('?>\n')
+                            append(''.join(parts))
+                            have_decl = True
+                        if doctype is not None and not have_doctype:
+                            append(_doctype(doctype))
+                            have_doctype = True
+
+                    elif kind is DOCTYPE:
+                        if not have_doctype:
+                            append(_doctype(data))
+                            have_doctype = True
+
+                    elif kind is START_CDATA:
+                        noescape = True
+                        if not html:
+                            append('<![CDATA[')
+                            in_cdata = True
+
+                    elif kind is END_CDATA:
+                        noescape = False
+                        if not html:
+                            append(']]>')
+                            in_cdata = False
+
+                    elif kind is PI:
+                        append('<?%s %s?>' % data)
+
+            # Output is yielded in batches of several events, so that fewer
+            # strings need to be joined and wrapped, or encoded
+            if len(buf) > 64:
+                yield _output(''.join(buf))
+                del buf[:]
+
+        else:
+            if not stack:
+                break
+            stream = stack.pop()
+
+    if textbuf:
+        text = ''.join(textbuf)
+        if not preserve and '\n' in text:
+            text = collapse_lines('\n', trim_trailing_space('', text))
+        if first:
+            append(_doctype(doctype))
+            first = False
+        append(text)
+    if first:
+        append(_doctype(doctype))
+    if buf:
+        yield _output(''.join(buf))
@@ -18,8 +18,18 @@ import os
 import sys
 
 from genshi.compat import StringIO, BytesIO
-from genshi.core import Attrs, Stream, StreamEventKind, START, TEXT, _ensure
+from genshi.core import Attrs, Stream, StreamEventKind, START, END, TEXT, \
+                        START_NS, END_NS, START_CDATA, END_CDATA, PI, \
+                        COMMENT, AWAIT, _ensure
 from genshi.input import ParseError
+from genshi.output import STATIC, StaticChunk, StaticChunkFilter, \
+                          get_serializer
+from genshi.template.compact import CompactStream, EventTable
+
+try:
+    from genshi._speedups import flatten as _speedups_flatten
+except ImportError:
+    _speedups_flatten = None
 
 __all__ = ['Context', 'DirectiveFactory', 'Template', 'TemplateError',
            'TemplateRuntimeError', 'TemplateSyntaxError', 'BadDirectiveError']
@@ -117,17 +127,46 @@ class Context(object):
     {'one': 'frost'}
     >>> ctxt.get('one')
     'foo'
+    
+    In addition to the stack of scopes, which is available as the ``frames``
+    attribute, the context keeps a single dictionary with the visible value of
+    every variable, so that looking up a variable takes constant time no matter
+    how deeply the scopes are nested. Every scope pushed on the stack records
+    the values it hides, which are restored when it is popped off again. For
+    that reason, variables should be set using the context itself rather than
+    by modifying the dictionaries in ``frames`` directly:
+    
+    >>> ctxt.push({})
+    >>> ctxt['one'] = 'bar'
+    >>> ctxt.get('one')
+    'bar'
+    >>> ctxt.pop()
+    {'one': 'bar'}
+    >>> ctxt.get('one')
+    'foo'
     """
 
     def __init__(self, **data):
         """Initialize the template context with the given keyword arguments as
         data.
         """
-        self.frames = deque([data])
-        self.pop = self.frames.popleft
-        self.push = self.frames.appendleft
+        self.frames = deque()
+        self._undo = deque()
+        self._vars = {}
+        if type(self).get == Context.get:
+            # Skip the method call for lookups, unless a subclass overrides it
+            self.get = self._vars.get
+        # Globals for executing code against this context, by lookup class,
+        # and the most recently used view with directive variables on top
+        self._globals = {}
+        self._overlay = None
         self._match_templates = []
+        # Number of match templates the index was built for, the index, and
+        # the number of match templates that have been used up
+        self._match_index = [0, {}, 0]
         self._choice_stack = []
+        # Whether the template is generated by `Template.generate_async()`
+        self._async = False
 
         # Helper functions for use in expressions
         def defined(name):
@@ -140,6 +179,8 @@ class Context(object):
             return self.get(name, default)
         data.setdefault('defined', defined)
         data.setdefault('value_of', value_of)
+        self._helpers = {'defined': defined, 'value_of': value_of}
+        self.push(data)
 
     def __repr__(self):
         return repr(list(self.frames))
@@ -149,7 +190,7 @@ class Context(object):
         
         :param key: the name of the variable
         """
-        return self._find(key)[1] is not None
+        return key in self._vars
     has_key = __contains__
 
     def __delitem__(self, key):
@@ -160,6 +201,11 @@ class Context(object):
         for frame in self.frames:
             if key in frame:
                 del frame[key]
+        for undo in self._undo:
+            for idx, (name, value) in enumerate(undo):
+                if name == key:
+                    undo[idx] = (name, _MISSING)
+        self._vars.pop(key, None)
 
     def __getitem__(self, key):
         """Get a variables's value, starting at the current scope and going
@@ -169,17 +215,14 @@ class Context(object):
         :return: the variable value
         :raises KeyError: if the requested variable wasn't found in any scope
         """
-        value, frame = self._find(key)
-        if frame is None:
-            raise KeyError(key)
-        return value
+        return self._vars[key]
 
     def __len__(self):
         """Return the number of distinctly named variables in the context.
         
         :return: the number of variables in the context
         """
-        return len(self.items())
+        return len(self._vars)
 
     def __setitem__(self, key, value):
         """Set a variable in the current scope.
@@ -187,7 +230,11 @@ class Context(object):
         :param key: the name of the variable
         :param value: the variable value
         """
-        self.frames[0][key] = value
+        frame = self.frames[0]
+        if key not in frame:
+            self._undo[0].append((key, self._vars.get(key, _MISSING)))
+        frame[key] = value
+        self._vars[key] = value
 
     def _find(self, key, default=None):
         """Retrieve a given variable's value and the frame it was found in.
@@ -198,11 +245,32 @@ class Context(object):
         :param default: the default value to return when the variable is not
                         found
         """
-        for frame in self.frames:
-            if key in frame:
-                return frame[key], frame
+        if key in self._vars:
+            for frame in self.frames:
+                if key in frame:
+                    return frame[key], frame
         return default, None
 
+    def _set_global(self, key, value):
+        """Set a variable in the bottom-most scope, so that it remains available
+        until processing the template has finished.
+        
+        :param key: the name of the variable
+        :param value: the variable value
+        """
+        self.frames[-1][key] = value
+        # If the variable is hidden by another scope, it becomes visible again
+        # once the lowest of those scopes is popped off
+        for idx in range(len(self.frames) - 2, -1, -1):
+            if key in self.frames[idx]:
+                undo = self._undo[idx]
+                for pos, (name, old) in enumerate(undo):
+                    if name == key:
+                        undo[pos] = (name, value)
+                break
+        else:
+            self._vars[key] = value
+
     def get(self, key, default=None):
         """Get a variable's value, starting at the current scope and going
         upward.
@@ -211,10 +279,7 @@ class Context(object):
         :param default: the default value to return when the variable is not
                         found
         """
-        for frame in self.frames:
-            if key in frame:
-                return frame[key]
-        return default
+        return self._vars.get(key, default)
 
     def keys(self):
         """Return the name of all variables in the context.
@@ -236,16 +301,29 @@ class Context(object):
 
     def update(self, mapping):
         """Update the context from the mapping provided."""
-        self.frames[0].update(mapping)
+        for key, value in dict(mapping).items():
+            self[key] = value
 
     def push(self, data):
         """Push a new scope on the stack.
         
         :param data: the data dictionary to push on the context stack.
         """
+        get = self._vars.get
+        self._undo.appendleft([(key, get(key, _MISSING)) for key in data])
+        self._vars.update(data)
+        self.frames.appendleft(data)
 
     def pop(self):
         """Pop the top-most scope from the stack."""
+        vars = self._vars
+        # The oldest entry for a variable is the one that needs to be restored
+        for key, value in reversed(self._undo.popleft()):
+            if value is _MISSING:
+                vars.pop(key, None)
+            else:
+                vars[key] = value
+        return self.frames.popleft()
 
     def copy(self):
         """Create a copy of this Context object."""
@@ -253,12 +331,77 @@ class Context(object):
         # See http://genshi.edgewall.org/ticket/249 for
         # example use case in Twisted tracebacks
         ctxt = Context()
-        ctxt.frames.pop()  # pop empty dummy context
-        ctxt.frames.extend(self.frames)
+        ctxt.pop()  # pop empty dummy context
+        for frame in reversed(self.frames):
+            ctxt.push(frame)
         ctxt._match_templates.extend(self._match_templates)
+        ctxt._match_index[2] = self._match_index[2]
         ctxt._choice_stack.extend(self._choice_stack)
+        ctxt._async = self._async
         return ctxt
 
+_MISSING = object()
+
+
+class _Overlay(object):
+    """View of a `Context` with the additional variables supplied by directives
+    on top of its scopes, so that code can be executed with those variables
+    without pushing them on the context stack. Variables set through the view
+    are set in the context.
+    """
+    __slots__ = ['ctxt', 'vars', '_globals']
+
+    def __init__(self, ctxt, vars):
+        self.ctxt = ctxt
+        self.vars = vars
+        self._globals = {}
+
+    def __contains__(self, key):
+        return key in self.vars or key in self.ctxt
+
+    def __delitem__(self, key):
+        del self.ctxt[key]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.ctxt[key] = value
+
+    def get(self, key, default=None):
+        vars = self.vars
+        if key in vars:
+            return vars[key]
+        value = self.ctxt.get(key, default)
+        # The helper functions of the context only know about its scopes, so
+        # unless they have been replaced, use ones that also see the variables
+        helpers = self.ctxt._helpers
+        if key in helpers and value is helpers[key]:
+            return getattr(self, key)
+        return value
+
+    def defined(self, name):
+        return name in self
+
+    def value_of(self, name, default=None):
+        return self.get(name, default)
+
+    def update(self, mapping):
+        self.ctxt.update(mapping)
+
+
+def _overlay(ctxt, vars):
+    """Return an `_Overlay` of the given variables on the context, reusing
+    the previous one if it was created for the same dictionary.
+    """
+    overlay = ctxt._overlay
+    if overlay is None or overlay.vars is not vars:
+        overlay = ctxt._overlay = _Overlay(ctxt, vars)
+    return overlay
+
 
 def _apply_directives(stream, directives, ctxt, vars):
     """Apply the given directives to the stream.
@@ -275,6 +418,154 @@ def _apply_directives(stream, directives, ctxt, vars):
     return stream
 
 
+def _expand_static(stream, condition=True):
+    """Replace any `STATIC` events in the stream by the events of the
+    corresponding chunk.
+    
+    :param stream: the event stream
+    :param condition: an object that is checked for truth whenever a chunk is
+                      encountered, and that determines whether the chunk
+                      should be expanded
+    :return: the stream with static chunks expanded
+    """
+    for event in stream:
+        if event[0] is STATIC and condition:
+            for subevent in event[1].events:
+                yield subevent
+        else:
+            yield event
+
+
+_STATIC_KINDS = frozenset([START, END, TEXT, START_NS, END_NS, START_CDATA,
+                           END_CDATA, PI, COMMENT])
+
+def _group_static(stream):
+    """Replace well-balanced runs of static events in a prepared template
+    stream by `STATIC` events, so that the serializers can output them as a
+    whole.
+    
+    :param stream: the prepared event stream
+    :return: a list of events with static chunks
+    """
+    from genshi.template.directives import AttrsDirective, ChooseDirective, \
+                                           ContentDirective, DefDirective, \
+                                           FlushDirective, ForDirective, \
+                                           IfDirective, MatchDirective, \
+                                           OtherwiseDirective, \
+                                           ReplaceDirective, StripDirective, \
+                                           WhenDirective, WithDirective
+    # Directives that don't care about the events in their substream, and
+    # directives that only look at the first and last event
+    transparent = set([ChooseDirective, DefDirective, FlushDirective,
+                       ForDirective, IfDirective, MatchDirective,
+                       OtherwiseDirective, WhenDirective, WithDirective])
+    enclosing = transparent | set([AttrsDirective, ContentDirective,
+                                   ReplaceDirective, StripDirective])
+
+    retval = []
+    run = []
+    for event in stream:
+        kind, data, pos = event
+        if kind in _STATIC_KINDS and not (kind is START and
+                [1 for _, value in data[1] if type(value) is list]):
+            run.append(event)
+            continue
+
+        retval.extend(_group_static_run(run))
+        run = []
+        if kind is SUB:
+            directives, substream = data
+            types = set([type(directive) for directive in directives])
+            if types <= transparent:
+                substream = _group_static(substream)
+            elif types <= enclosing and len(substream) > 2 and \
+                    substream[0][0] is START and substream[-1][0] is END:
+                substream = substream[:1] + \
+                            _group_static(substream[1:-1]) + \
+                            substream[-1:]
+            event = kind, (directives, substream), pos
+        retval.append(event)
+    retval.extend(_group_static_run(run))
+    return retval
+
+
+def _group_static_run(run):
+    # Find the balanced spans of events, dropping any that are nested inside a
+    # larger span
+    opened = []
+    spans = []
+    for idx, (kind, data, pos) in enumerate(run):
+        if kind is START or kind is START_NS or kind is START_CDATA:
+            opened.append(idx)
+        elif kind is END or kind is END_NS or kind is END_CDATA:
+            if opened:
+                start = opened.pop()
+                while spans and spans[-1][0] > start:
+                    spans.pop()
+                spans.append([start, idx])
+    if not spans:
+        return run
+
+    # Merge sibling spans that are only separated by text, comments, and
+    # processing instructions
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        for kind, data, pos in run[merged[-1][1] + 1:start]:
+            if kind is not TEXT and kind is not COMMENT and kind is not PI:
+                merged.append([start, end])
+                break
+        else:
+            merged[-1][1] = end
+
+    retval = []
+    idx = 0
+    for start, end in merged:
+        retval.extend(run[idx:start])
+        retval.append((STATIC, StaticChunk(run[start:end + 1]), run[start][2]))
+        idx = end + 1
+    retval.extend(run[idx:])
+    return retval
+
+
+def _compact(stream, table=None):
+    """Store a prepared template stream, and the streams nested in its
+    events, as `CompactStream` objects.
+    
+    :param stream: the prepared event stream
+    :param table: the `EventTable` to store the event data in; if omitted, a
+                  new table is used for the stream and the nested streams
+    :return: the `CompactStream`, or a list of the events if the stream
+             contains positions that can't be stored in a compact stream
+    """
+    if table is None:
+        table = EventTable()
+    try:
+        return _compact_stream(stream, table)
+    finally:
+        table.pack()
+
+def _compact_stream(stream, table):
+    if type(stream) is CompactStream and stream.table is table:
+        return stream
+
+    events = []
+    for kind, data, pos in stream:
+        if kind is SUB:
+            directives, substream = data
+            data = directives, _compact_stream(substream, table)
+        elif kind is STATIC:
+            data.events = _compact_stream(data.events, table)
+        elif kind is INCLUDE:
+            href, cls, fallback = data
+            if fallback:
+                data = href, cls, _compact_stream(fallback, table)
+        events.append((kind, data, pos))
+    try:
+        return CompactStream(events, table)
+    except (TypeError, ValueError):
+        return events
+
+
 def _eval_expr(expr, ctxt, vars=None):
     """Evaluate the given `Expression` object.
     
@@ -285,11 +576,45 @@ def _eval_expr(expr, ctxt, vars=None):
     :return: the result of the evaluation
     """
     if vars:
-        ctxt.push(vars)
-    retval = expr.evaluate(ctxt)
-    if vars:
-        ctxt.pop()
-    return retval
+        return expr.evaluate(_overlay(ctxt, vars))
+    return expr.evaluate(ctxt)
+
+
+class _Awaiting(object):
+    """An awaitable produced by an expression in a template generated with
+    `Template.generate_async()`, along with the outcome of awaiting it.
+    
+    The template yields an `AWAIT` event with this object as data, and then
+    evaluates the object like an expression to get the result.
+    """
+    __slots__ = ['awaitable', 'outcome', 'pos']
+
+    def __init__(self, awaitable, pos):
+        self.awaitable = awaitable
+        self.outcome = None
+        self.pos = pos
+
+    def set_result(self, result):
+        self.outcome = (result, None)
+
+    def set_exception(self, error):
+        self.outcome = (None, error)
+
+    def evaluate(self, data):
+        return self.get()
+
+    def get(self):
+        if self.outcome is None:
+            raise TemplateRuntimeError('Expression result was used before it '
+                                       'was awaited; awaitables can not be '
+                                       'used in buffered content such as '
+                                       'attribute values, and the template '
+                                       'must be rendered with '
+                                       'Stream.render_async()', *self.pos)
+        result, error = self.outcome
+        if error is not None:
+            raise error
+        return result
 
 
 def _exec_suite(suite, ctxt, vars=None):
@@ -301,13 +626,8 @@ def _exec_suite(suite, ctxt, vars=None):
                  code
     """
     if vars:
-        ctxt.push(vars)
-        ctxt.push({})
+        ctxt = _overlay(ctxt, vars)
     suite.execute(ctxt)
-    if vars:
-        top = ctxt.pop()
-        ctxt.pop()
-        ctxt.frames[0].update(top)
 
 
 class DirectiveFactoryMeta(type):
@@ -357,6 +677,32 @@ class DirectiveFactory(object):
         return len(self._dir_order)
 
 
+class TemplateStream(Stream):
+    """The stream returned by `Template.generate()`.
+    
+    The events produced by a template may contain pre-serialized `STATIC`
+    chunks. These are passed directly to serializers that know how to handle
+    them, whereas iterating over the stream, or applying filters to it, yields
+    the original events.
+    
+    :since: version 0.7
+    """
+    __slots__ = []
+
+    def __iter__(self):
+        return _expand_static(self.events)
+
+    def serialize(self, method='xml', **kwargs):
+        if method is None:
+            method = self.serializer or 'xml'
+        serializer = get_serializer(method, **kwargs)
+        for filter_ in getattr(serializer, 'filters', []):
+            if isinstance(filter_, StaticChunkFilter):
+                return serializer(iter(self.events))
+        return serializer(_ensure(self))
+    serialize.__doc__ = Stream.serialize.__doc__
+
+
 class Template(DirectiveFactory):
     """Abstract template base class.
     
@@ -380,9 +726,12 @@ class Template(DirectiveFactory):
 
     serializer = None
     _number_conv = unicode # function used to convert numbers to event data
+    _compiled = None # generator function produced by `compile()`
+    _static_stream = None # prepared stream with static chunks
 
     def __init__(self, source, filepath=None, filename=None, loader=None,
-                 encoding=None, lookup='strict', allow_exec=True):
+                 encoding=None, lookup='strict', allow_exec=True,
+                 keep_ast=True):
         """Initialize a template from either a string, a file-like object, or
         an already parsed markup stream.
         
@@ -398,14 +747,20 @@ class Template(DirectiveFactory):
                        default), "lenient", or a custom lookup class
         :param allow_exec: whether Python code blocks in templates should be
                            allowed
+        :param keep_ast: whether the expressions and code blocks in the
+                         template should keep their AST after compilation;
+                         if `False`, the AST is parsed again from the source
+                         code when it is needed
         
         :note: Changed in 0.5: Added the `allow_exec` argument
+        :note: Changed in 0.7: Added the `keep_ast` argument
         """
         self.filepath = filepath or filename
         self.filename = filename
         self.loader = loader
         self.lookup = lookup
         self.allow_exec = allow_exec
+        self.keep_ast = keep_ast
         self._init_filters()
         self._init_loader()
         self._prepared = False
@@ -423,6 +778,11 @@ class Template(DirectiveFactory):
     def __getstate__(self):
         state = self.__dict__.copy()
         state['filters'] = []
+        state.pop('_static_stream', None)
+        if state.get('_compiled') is not None:
+            # Generated code can't be pickled, so just remember that the
+            # template needs to be compiled again
+            state['_compiled'] = True
         return state
 
     def __setstate__(self, state):
@@ -452,7 +812,7 @@ class Template(DirectiveFactory):
     @property
     def stream(self):
         if not self._prepared:
-            self._stream = list(self._prepare(self._stream))
+            self._stream = _compact(self._prepare(self._stream))
             self._prepared = True
         return self._stream
 
@@ -470,13 +830,15 @@ class Template(DirectiveFactory):
         """
         raise NotImplementedError
 
-    def _prepare(self, stream):
+    def _prepare(self, stream, inlined=True):
         """Call the `attach` method of every directive found in the template.
         
         :param stream: the event stream of the template
+        :param inlined: whether templates included using a static path should
+                        be inlined into the stream; if `False`, the include
+                        events are left in place, and `_inline()` can be used
+                        to inline them later
         """
-        from genshi.template.loader import TemplateNotFound
-
         for kind, data, pos in stream:
             if kind is SUB:
                 directives = []
@@ -486,7 +848,7 @@ class Template(DirectiveFactory):
                                                       namespaces, pos)
                     if directive:
                         directives.append(directive)
-                substream = self._prepare(substream)
+                substream = self._prepare(substream, inlined)
                 if directives:
                     yield kind, (directives, list(substream)), pos
                 else:
@@ -495,28 +857,97 @@ class Template(DirectiveFactory):
             else:
                 if kind is INCLUDE:
                     href, cls, fallback = data
-                    if isinstance(href, basestring) and \
-                            not getattr(self.loader, 'auto_reload', True):
-                        # If the path to the included template is static, and
-                        # auto-reloading is disabled on the template loader,
-                        # the template is inlined into the stream
-                        try:
-                            tmpl = self.loader.load(href, relative_to=pos[0],
-                                                    cls=cls or self.__class__)
-                            for event in tmpl.stream:
-                                yield event
-                        except TemplateNotFound:
-                            if fallback is None:
-                                raise
-                            for event in self._prepare(fallback):
-                                yield event
+                    if inlined and self._is_static_include(href):
+                        if fallback is not None:
+                            fallback = self._prepare(fallback)
+                        for event in self._include_static(href, cls, fallback,
+                                                          pos):
+                            yield event
                         continue
                     elif fallback:
                         # Otherwise the include is performed at run time
-                        data = href, cls, list(self._prepare(fallback))
+                        data = href, cls, list(self._prepare(fallback,
+                                                             inlined))
 
                 yield kind, data, pos
 
+    def _inline(self, stream):
+        """Inline the templates included using a static path into a stream
+        that was prepared without inlining them.
+        
+        :param stream: the prepared event stream of the template
+        """
+        for event in stream:
+            kind, data, pos = event
+            if kind is SUB:
+                directives, substream = data
+                event = kind, (directives, list(self._inline(substream))), pos
+            elif kind is INCLUDE:
+                href, cls, fallback = data
+                if self._is_static_include(href):
+                    if fallback is not None:
+                        fallback = self._inline(fallback)
+                    for event in self._include_static(href, cls, fallback,
+                                                      pos):
+                        yield event
+                    continue
+                elif fallback:
+                    event = kind, (href, cls, list(self._inline(fallback))), pos
+            yield event
+
+    def _is_static_include(self, href):
+        # If the path to the included template is static, and auto-reloading
+        # is disabled on the template loader, the template is inlined into the
+        # stream
+        return isinstance(href, basestring) and \
+               not getattr(self.loader, 'auto_reload', True)
+
+    def _include_static(self, href, cls, fallback, pos):
+        from genshi.template.loader import TemplateNotFound
+        try:
+            tmpl = self.loader.load(href, relative_to=pos[0],
+                                    cls=cls or self.__class__)
+            for event in tmpl.stream:
+                yield event
+        except TemplateNotFound:
+            if fallback is None:
+                raise
+            for event in fallback:
+                yield event
+
+    def compile(self):
+        """Compile the template into a native Python generator function.
+        
+        The prepared template stream is translated into Python source code, so
+        that subsequent calls to `generate()` no longer need to interpret the
+        stream event by event. The output of the template is not affected.
+        
+        This method should only be called after any custom directives have
+        been added to the template, as it causes the template to be prepared.
+        
+        >>> from genshi.template import MarkupTemplate
+        >>> tmpl = MarkupTemplate('<p>Hello, $name!</p>').compile()
+        >>> print(tmpl.generate(name='world'))
+        <p>Hello, world!</p>
+        
+        :return: the template itself
+        :see: `genshi.template.compiler`
+        :since: version 0.7
+        """
+        from genshi.template.compiler import compile_stream
+        self._compiled = compile_stream(self, self._prepare_static())
+        return self
+
+    def _prepare_static(self):
+        """Return the prepared stream of the template, with runs of static
+        events grouped into pre-serializable chunks.
+        """
+        if self._static_stream is None:
+            stream = self.stream
+            self._static_stream = _compact(_group_static(stream),
+                                           getattr(stream, 'table', None))
+        return self._static_stream
+
     def generate(self, *args, **kwargs):
         """Apply the template to the given context data.
         
@@ -543,12 +974,67 @@ class Template(DirectiveFactory):
             ctxt = Context(**kwargs)
 
         stream = self.stream
-        for filter_ in self.filters:
+        filters = self.filters
+        if filters[0] == self._flatten:
+            stream = self._prepare_static()
+            if self._compiled is not None and not ctxt._async:
+                if self._compiled is True:
+                    self.compile()
+                stream = self._compiled(ctxt, vars)
+                filters = filters[1:]
+
+        # Only the built-in filters know how to deal with static chunks, so
+        # other filters get the chunks expanded
+        builtin = [self._flatten, self._include]
+        if hasattr(self, '_match'):
+            builtin.append(self._match)
+        static = False
+        for filter_ in filters:
+            if filter_ in builtin:
+                static = True
+            elif static:
+                stream = _expand_static(stream)
+                static = False
             stream = filter_(iter(stream), ctxt, **vars)
-        return Stream(stream, self.serializer)
+        return TemplateStream(stream, self.serializer)
+
+    def generate_async(self, *args, **kwargs):
+        """Apply the template to the given context data, with support for
+        asynchronous data.
+        
+        The arguments are the same as for `generate()`. In the resulting stream,
+        expressions that evaluate to an awaitable object, such as a coroutine,
+        are replaced by the result of awaiting it, and the ``py:for`` directive
+        can iterate over asynchronous iterables. The stream must be rendered
+        using `Stream.render_async()`, which does the awaiting::
+        
+            async def handle(writer):
+                stream = tmpl.generate_async(entries=fetch_entries())
+                await stream.render_async(writer)
+        
+        Awaitables are not supported where the template needs all the output
+        of an expression at once, such as in attribute values.
+        
+        :return: a markup event stream representing the result of applying
+                 the template to the context data.
+        :since: version 0.7
+        """
+        if args and args[0] is not None:
+            assert len(args) == 1
+            ctxt = args[0]
+        else:
+            ctxt, kwargs = Context(**kwargs), {}
+        ctxt._async = True
+        return self.generate(ctxt, **kwargs)
 
     def _flatten(self, stream, ctxt, **vars):
+        if _speedups_flatten is not None and not ctxt._async:
+            return _speedups_flatten(stream, ctxt, vars, self._number_conv)
+        return self._flatten_events(stream, ctxt, vars)
+
+    def _flatten_events(self, stream, ctxt, vars):
         number_conv = self._number_conv
+        asynchronous = ctxt._async
         stack = []
         push = stack.append
         pop = stack.pop
@@ -584,6 +1070,14 @@ class Template(DirectiveFactory):
                             yield TEXT, result, pos
                         elif isinstance(result, (int, float, long)):
                             yield TEXT, number_conv(result), pos
+                        elif asynchronous and hasattr(result, '__await__'):
+                            # The result is evaluated again after the renderer
+                            # has awaited it
+                            pending = _Awaiting(result, pos)
+                            yield AWAIT, pending, pos
+                            push(stream)
+                            stream = iter([(EXPR, pending, pos)])
+                            break
                         elif hasattr(result, '__iter__'):
                             push(stream)
                             stream = _ensure(result)
@@ -628,7 +1122,7 @@ class Template(DirectiveFactory):
                 try:
                     tmpl = self.loader.load(href, relative_to=event[2][0],
                                             cls=cls or self.__class__)
-                    for event in tmpl.generate(ctxt, **vars):
+                    for event in tmpl.generate(ctxt, **vars).events:
                         yield event
                 except TemplateNotFound:
                     if fallback is None:
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Rendering of many documents using a pool of processes.
+
+Rendering templates is bound by the CPU, so a single process only ever uses one
+core. For bulk jobs, such as generating emails or reports from the same few
+templates, the `render_batch()` function distributes the rendering over a pool
+of worker processes::
+
+  from genshi.template import TemplateLoader
+  from genshi.template.batch import render_batch
+
+  loader = TemplateLoader([templates_dir])
+  jobs = (('mail.txt', dict(user=user)) for user in users)
+  for output in render_batch(loader, jobs, preload=['mail.txt']):
+      send(output)
+
+Every worker process gets a copy of the template loader, which keeps the
+templates it has loaded for all the jobs the worker renders. The jobs are sent
+to the workers in chunks, so that the cost of passing data between processes
+is paid once for a number of jobs rather than for every job.
+
+The template data of the jobs and the rendered output are passed between the
+processes by pickling them, so the data must be picklable. The loader is also
+pickled on platforms where new processes are not forked.
+"""
+
+from itertools import islice
+import multiprocessing
+from Queue import Empty, Queue
+import traceback
+
+from genshi.template.base import TemplateError
+
+__all__ = ['BatchError', 'render_batch']
+__docformat__ = 'restructuredtext en'
+
+
+class BatchError(TemplateError):
+    """Exception raised when a job of a batch could not be rendered."""
+
+    def __init__(self, index, name, details):
+        """Create the exception.
+
+        :param index: the position of the job in the batch
+        :param name: the name of the template of the job
+        :param details: the traceback of the error in the worker process
+        """
+        TemplateError.__init__(self, 'Rendering job %d with template "%s" '
+                               'failed:\n%s' % (index, name, details))
+        self.index = index #: the position of the job in the batch
+        self.name = name #: the name of the template of the job
+        self.details = details #: the traceback of the error
+
+
+def render_batch(loader, jobs, method=None, encoding='utf-8', processes=None,
+                 ordered=True, chunk_size=16, preload=(), **kwargs):
+    """Render the given jobs in a pool of worker processes, and return an
+    iterator over the output.
+
+    Every job is a ``(name, data)`` tuple, where ``name`` is the name of the
+    template to load, and ``data`` is a dictionary with the data to generate
+    the template with. If `ordered` is true, the iterator produces the output
+    of the jobs in the order of the jobs. Otherwise, it produces ``(index,
+    output)`` tuples as soon as the output is available, where ``index`` is the
+    position of the job in `jobs`.
+
+    Only a limited number of chunks of jobs are handed to the pool at any time,
+    so `jobs` can be a generator producing any number of jobs without all of
+    them being held in memory. The pool is shut down when the iteration is
+    done or stopped.
+
+    Any additional keyword arguments are passed to the serializer, and thus
+    depend on the `method` parameter value.
+
+    :param loader: the `TemplateLoader` to load the templates with
+    :param jobs: an iterable over ``(name, data)`` tuples
+    :param method: the serialization method; if `None`, the default
+                   serialization method of the template is used
+    :param encoding: how the output should be encoded; if set to `None`, the
+                     output is produced as `unicode` objects
+    :param processes: the number of worker processes; defaults to the number
+                      of CPUs
+    :param ordered: whether the output should be produced in the order of the
+                    jobs
+    :param chunk_size: the number of jobs sent to a worker at once
+    :param preload: the names of templates that every worker should load
+                    before rendering any job
+    :return: an iterator over the output of the jobs
+    :raises BatchError: when a job could not be rendered
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (loader, preload, method, encoding, kwargs))
+    done = Queue() # numbers of the rendered chunks, if not ordered
+    try:
+        jobs = enumerate(jobs)
+        # Two chunks for every worker, so that workers don't have to wait for
+        # their next chunk
+        window = 2 * processes
+        submitted = 0
+        exhausted = False
+        pending = {} # chunk number => (AsyncResult, first job of the chunk)
+        next_number = 0
+        while 1:
+            while not exhausted and len(pending) < window:
+                chunk = list(islice(jobs, chunk_size))
+                if not chunk:
+                    exhausted = True
+                    break
+                callback = None
+                if not ordered:
+                    callback = lambda result: done.put(result[0])
+                result = pool.apply_async(_render_chunk, (submitted, chunk),
+                                          callback=callback)
+                pending[submitted] = result, chunk[0]
+                submitted += 1
+            if not pending:
+                break
+
+            if ordered:
+                number = next_number
+                next_number += 1
+            else:
+                number = _next_done(pending, done)
+            result, (index, (name, data)) = pending.pop(number)
+            try:
+                number, outputs, error = result.get()
+            except Exception:
+                # The chunk never made it through _render_chunk(), for example
+                # because the job data could not be pickled
+                raise BatchError(index, name, traceback.format_exc())
+            for output in outputs:
+                if ordered:
+                    output = output[1]
+                yield output
+            if error is not None:
+                raise BatchError(*error)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+
+def _next_done(pending, done):
+    """Return the number of a pending chunk that is done."""
+    while 1:
+        try:
+            number = done.get(timeout=0.1)
+            if number in pending:
+                return number
+        except Empty:
+            # Chunks that failed before reaching the worker don't invoke the
+            # callback, so check for them every now and then
+            for number, (result, job) in pending.items():
+                if result.ready():
+                    return number
+
+
+_worker = None # the loader and the rendering options of the worker process
+
+
+def _init_worker(loader, preload, method, encoding, kwargs):
+    global _worker
+    error = None
+    for name in preload:
+        try:
+            loader.load(name)
+        except Exception:
+            # The error is reported for the first job of the worker, as an
+            # error here would make the pool start a new worker
+            error = name, traceback.format_exc()
+            break
+    _worker = loader, method, encoding, kwargs, error
+
+
+def _render_chunk(number, chunk):
+    loader, method, encoding, kwargs, error = _worker
+    outputs = []
+    if error is not None:
+        return number, outputs, (chunk[0][0],) + error
+    for index, (name, data) in chunk:
+        try:
+            stream = loader.load(name).generate(**data)
+            outputs.append((index, stream.render(method, encoding=encoding,
+                                                 **kwargs)))
+        except Exception:
+            return number, outputs, (index, name, traceback.format_exc())
+    return number, outputs, None
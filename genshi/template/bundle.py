@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Bundles of prepared templates for deployment.
+
+A bundle is a single file containing the prepared streams of all templates
+found on a search path. Applications can load templates from a bundle using the
+`bundle()` load function of the template loader, which maps the file into
+memory, and only deserializes a template when it is first requested. Loading
+templates this way requires neither parsing the templates, nor opening the
+individual template files, and the memory pages of the bundle are shared
+between processes.
+
+Bundles are created using the `write_bundle()` function, or by running this
+module as a script::
+
+  $ python -m genshi.template.bundle templates.bundle templates/
+
+The templates are stored in the format also used by the `TemplateCache`, so
+the same restrictions apply. A bundle can only be used with the version of
+Genshi and of Python it was created with.
+"""
+
+from fnmatch import fnmatch
+from imp import get_magic
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+from genshi import __version__
+from genshi.template.base import TemplateError
+from genshi.template.cache import _dumps, _loads
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+__all__ = ['TemplateBundle', 'write_bundle']
+__docformat__ = 'restructuredtext en'
+
+FORMAT = 2
+"""The version of the bundle file format."""
+
+DEFAULT_PATTERNS = [('*.html', MarkupTemplate), ('*.xhtml', MarkupTemplate),
+                    ('*.xml', MarkupTemplate), ('*.txt', NewTextTemplate)]
+"""The default file name patterns of templates to include in a bundle, and
+the template classes to use for them."""
+
+_HEADER = '<I'
+
+
+class TemplateBundle(object):
+    """A bundle of prepared templates, mapped into memory.
+
+    >>> import shutil, tempfile
+    >>> dirname = tempfile.mkdtemp(prefix='genshi')
+    >>> fd = os.open(os.path.join(dirname, 'index.html'),
+    ...              os.O_WRONLY | os.O_CREAT)
+    >>> os.write(fd, u'<p>Hello, $name!</p>'.encode('utf-8'))
+    20
+    >>> os.close(fd)
+    >>> path = os.path.join(dirname, 'templates.bundle')
+    >>> write_bundle(path, [dirname])
+    ['index.html']
+
+    The bundle is normally used through the `bundle()` load function:
+
+    >>> from genshi.template.loader import bundle
+    >>> loader = TemplateLoader([bundle(path)])
+    >>> print(loader.load('index.html').generate(name='world'))
+    <p>Hello, world!</p>
+
+    >>> shutil.rmtree(dirname)
+    """
+
+    def __init__(self, path):
+        """Open the bundle.
+
+        :param path: the path to the bundle file
+        :raise TemplateError: if the file is not a bundle, or if it was
+                              created with a different version of Genshi or
+                              Python
+        """
+        self.path = path
+        fileobj = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fileobj.close()
+        try:
+            size = struct.calcsize(_HEADER)
+            length, = struct.unpack(_HEADER, self._map[:size])
+            header = marshal.loads(self._map[size:size + length])
+            name, format, version, magic, self._index = header
+            self._offset = size + length
+        except (struct.error, EOFError, ValueError, TypeError):
+            raise TemplateError('"%s" is not a template bundle' % path)
+        if name != 'genshi-bundle' or format != FORMAT or \
+                version != __version__ or magic != get_magic():
+            raise TemplateError('Template bundle "%s" was created with a '
+                                'different version of Genshi or Python' % path)
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, filename):
+        """Return the entry for the template with the given file name.
+
+        :param filename: the path to the template relative to the search path
+                         the bundle was created from
+        :return: the `BundleEntry` object
+        :raise IOError: if the bundle contains no such template
+        """
+        try:
+            info = self._index[filename.replace(os.sep, '/')]
+        except KeyError:
+            raise IOError('Template "%s" not found in bundle "%s"' %
+                          (filename, self.path))
+        return BundleEntry(self, filename, *info)
+
+    def _read(self, offset, length):
+        offset += self._offset
+        return self._map[offset:offset + length]
+
+
+class BundleEntry(object):
+    """A template in a `TemplateBundle`.
+
+    This object is returned as the file object by the `bundle()` load
+    function; the `TemplateLoader` recognizes it by its `prepared()` method.
+    """
+    __slots__ = ['bundle', 'filename', 'filepath', 'cls', 'offset', 'length']
+
+    def __init__(self, bundle, filename, cls, offset, length):
+        self.bundle = bundle
+        self.filename = filename
+        self.filepath = os.path.join(bundle.path, filename)
+        self.cls = cls
+        self.offset = offset
+        self.length = length
+
+    def prepared(self, cls=None):
+        """Deserialize the template.
+
+        :param cls: the template class requested by the loader; the class the
+                    template was bundled with must be the same class or a
+                    subclass
+        :return: a ``(cls, state, stream)`` tuple
+        :raise TemplateError: if the template was bundled with a different
+                              class
+        """
+        module, name = self.cls
+        bundled = getattr(__import__(module, {}, {}, [name]), name)
+        if cls is not None and not issubclass(bundled, cls):
+            raise TemplateError('Template "%s" was bundled as %s, not %s' %
+                                (self.filename, bundled.__name__,
+                                 cls.__name__))
+        state, stream = _loads(self.bundle._read(self.offset, self.length))
+        return bundled, state, stream
+
+
+def write_bundle(path, search_path, patterns=None, callback=None, **options):
+    """Create a bundle of the templates found in the given directories.
+
+    The templates are prepared as the `TemplateLoader` would prepare them, but
+    included templates are not inlined, so that every template in the bundle
+    can be loaded independently.
+
+    :param path: the path of the bundle file to write
+    :param search_path: a list of directories containing templates; if a
+                        template with the same relative path exists in more
+                        than one directory, the first one is used
+    :param patterns: a list of ``(pattern, cls)`` tuples, where ``pattern`` is
+                     a file name pattern, and ``cls`` is the template class to
+                     use for matching files; defaults to `DEFAULT_PATTERNS`
+    :param callback: a function that is passed each template before it is
+                     prepared, which should add any custom directives; this
+                     is usually the same callback as the one passed to the
+                     loader using the bundle
+    :param options: any additional keyword arguments are passed to the
+                    `TemplateLoader` used to instantiate the templates, for
+                    example ``default_encoding`` or ``variable_lookup``
+    :return: the list of template file names in the bundle
+    :raise TemplateError: if a template can not be stored in the bundle
+    """
+    if patterns is None:
+        patterns = DEFAULT_PATTERNS
+    if isinstance(search_path, basestring):
+        search_path = [search_path]
+    loader = TemplateLoader(search_path, callback=callback, **options)
+
+    found = {}
+    for dirname in search_path:
+        for dirpath, dirnames, filenames in os.walk(dirname):
+            dirnames.sort()
+            for name in filenames:
+                filepath = os.path.join(dirpath, name)
+                filename = os.path.relpath(filepath, dirname)
+                filename = filename.replace(os.sep, '/')
+                if filename in found:
+                    continue
+                for pattern, cls in patterns:
+                    if fnmatch(name, pattern):
+                        found[filename] = filepath, cls
+                        break
+
+    index = {}
+    chunks = []
+    offset = 0
+    filenames = sorted(found)
+    for filename in filenames:
+        filepath, cls = found[filename]
+        fileobj = open(filepath, 'rbU')
+        try:
+            tmpl = loader._instantiate(cls, fileobj, filepath, filename)
+        finally:
+            fileobj.close()
+        if callback:
+            callback(tmpl)
+        stream = list(tmpl._prepare(tmpl._stream, inlined=False))
+        try:
+            data = _dumps(tmpl, stream)
+        except (TypeError, ValueError), e:
+            raise TemplateError('Template "%s" can not be bundled: %s' %
+                                (filename, e))
+        index[filename] = (cls.__module__, cls.__name__), offset, len(data)
+        chunks.append(data)
+        offset += len(data)
+
+    header = marshal.dumps(('genshi-bundle', FORMAT, __version__, get_magic(),
+                            index))
+    fileobj = open(path, 'wb')
+    try:
+        fileobj.write(struct.pack(_HEADER, len(header)))
+        fileobj.write(header)
+        for data in chunks:
+            fileobj.write(data)
+    finally:
+        fileobj.close()
+    return filenames
+
+
+def main(args=None):
+    """Command-line interface for creating template bundles."""
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] BUNDLE DIR...',
+                          description='Create a bundle of the prepared '
+                                      'templates found in the given '
+                                      'directories.')
+    parser.add_option('-m', '--markup', action='append', dest='markup',
+                      metavar='PATTERN', default=[],
+                      help='file name pattern of markup templates '
+                           '(default: *.html, *.xhtml and *.xml)')
+    parser.add_option('-t', '--text', action='append', dest='text',
+                      metavar='PATTERN', default=[],
+                      help='file name pattern of text templates '
+                           '(default: *.txt)')
+    parser.add_option('-e', '--encoding', dest='encoding',
+                      help='the encoding of the templates (default: UTF-8)')
+    parser.add_option('-l', '--lenient', action='store_const',
+                      dest='variable_lookup', const='lenient',
+                      default='strict', help='use lenient variable lookup')
+    parser.add_option('--no-exec', action='store_false', dest='allow_exec',
+                      default=True,
+                      help='do not allow Python code blocks in templates')
+    parser.add_option('-c', '--callback', dest='callback',
+                      metavar='MODULE:FUNCTION',
+                      help='function to call with each template before it is '
+                           'prepared')
+    parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
+                      help='do not list the bundled templates')
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error('a bundle file and at least one directory are required')
+
+    patterns = None
+    if options.markup or options.text:
+        patterns = [(pattern, MarkupTemplate) for pattern in options.markup] + \
+                   [(pattern, NewTextTemplate) for pattern in options.text]
+    callback = None
+    if options.callback:
+        module, name = options.callback.split(':', 1)
+        callback = getattr(__import__(module, {}, {}, [name]), name)
+
+    try:
+        filenames = write_bundle(args[0], args[1:], patterns=patterns,
+                                 callback=callback,
+                                 default_encoding=options.encoding,
+                                 variable_lookup=options.variable_lookup,
+                                 allow_exec=options.allow_exec)
+    except TemplateError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    if not options.quiet:
+        for filename in filenames:
+            sys.stdout.write('%s\n' % filename)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
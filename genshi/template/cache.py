@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Persistent on-disk caching of prepared templates.
+
+Parsing a template, and compiling the Python expressions and code blocks it
+contains, is relatively expensive. A `TemplateCache` stores the prepared event
+stream of templates in a directory, so that other processes loading the same
+templates can skip parsing altogether. This cache is normally used through the
+``cache_dir`` option of the `TemplateLoader`.
+
+Cache entries are written in the `marshal` format: compiled expressions are
+stored as Python code objects, and directives, paths and the other objects
+found in prepared streams are reduced to the data they are made of. The
+abstract syntax trees of expressions are not stored; the ``ast`` property of
+expressions loaded from the cache parses the expression source again whenever
+it is accessed.
+
+Every entry records the modification time, size and SHA-1 hash of the template
+source, as well as the versions of Genshi, of the cache format, and of the
+Python bytecode. Entries that do not match are ignored, and replaced when the
+template has been parsed again.
+"""
+
+from imp import get_magic
+import marshal
+import os
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import tempfile
+from types import FunctionType
+
+from genshi import __version__
+from genshi.core import Attrs, Markup, QName, StreamEventKind
+from genshi.path import Path
+from genshi.template.compact import CompactStream
+from genshi.template.directives import Directive, _assigner
+from genshi.template.eval import Code
+
+__all__ = ['TemplateCache']
+__docformat__ = 'restructuredtext en'
+
+FORMAT = 2
+"""The version of the cache entry format."""
+
+_ATOMS = frozenset([type(None), bool, int, long, float, str, unicode])
+_ASSIGN_CODE = _assigner(None).func_code
+
+# Template attributes that are not part of the cached template state
+_TRANSIENT = frozenset(['loader', 'filters', '_stream', '_prepared',
+                        '_compiled', '_static_stream'])
+
+
+class TemplateCache(object):
+    """Cache of prepared templates in a directory on the local file system.
+
+    >>> import shutil
+    >>> from genshi.template import MarkupTemplate
+    >>> path = tempfile.mkdtemp(prefix='genshi')
+    >>> cache = TemplateCache(path)
+
+    The cache is keyed by an arbitrary tuple identifying the template and the
+    options used to load it, and is passed the source of the template to
+    validate entries against:
+
+    >>> source = '<p xmlns:py="http://genshi.edgewall.org/" py:if="x">$x</p>'
+    >>> tmpl = MarkupTemplate(source)
+    >>> cache.set(('test.html',), source, tmpl, tmpl.stream)
+    True
+    >>> state, stream = cache.get(('test.html',), source)
+    >>> print(stream[0][1][0])
+    [<IfDirective "x">]
+
+    If the source has changed, the entry is not used:
+
+    >>> print(cache.get(('test.html',), source.replace('$x', '${x}')))
+    None
+
+    >>> shutil.rmtree(path)
+    """
+
+    def __init__(self, path):
+        """Create the cache.
+
+        :param path: the path to the cache directory, which is created as
+                     needed
+        """
+        self.path = path
+
+    def _filepath(self, key):
+        return os.path.join(self.path, sha1(repr(key).encode('utf-8'))
+                                       .hexdigest() + '.cache')
+
+    def _header(self, source, mtime):
+        return (FORMAT, __version__, get_magic(), mtime, len(source),
+                _digest(source))
+
+    def get(self, key, source, mtime=None):
+        """Return the cached state and prepared stream of a template.
+
+        :param key: the key identifying the template
+        :param source: the source of the template as a byte string
+        :param mtime: the modification time of the template file, if known
+        :return: a ``(state, stream)`` tuple, where ``state`` is a dictionary
+                 of template attributes, or `None` if there is no valid entry
+                 for the template
+        """
+        try:
+            fileobj = open(self._filepath(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                header = marshal.load(fileobj)
+                if type(header) is not tuple or len(header) != 6:
+                    return None
+                format, version, magic, cached_mtime, size, digest = header
+                if format != FORMAT or version != __version__ or \
+                        magic != get_magic() or mtime != cached_mtime or \
+                        size != len(source) or digest != _digest(source):
+                    return None
+                data = fileobj.read()
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            fileobj.close()
+        try:
+            return _loads(data)
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def set(self, key, source, template, stream, mtime=None):
+        """Store the prepared stream of a template in the cache.
+
+        :param key: the key identifying the template
+        :param source: the source of the template as a byte string
+        :param template: the `Template` object
+        :param stream: the prepared stream of the template
+        :param mtime: the modification time of the template file, if known
+        :return: whether the entry was written; templates containing objects
+                 that can't be stored in the cache are skipped
+        """
+        try:
+            data = _dumps(template, stream)
+        except (TypeError, ValueError):
+            return False
+
+        filepath = self._filepath(key)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(self._header(source, mtime), fileobj)
+                fileobj.write(data)
+            finally:
+                fileobj.close()
+            try:
+                os.rename(tmppath, filepath)
+            except OSError:
+                # On Windows the destination must not exist
+                os.remove(filepath)
+                os.rename(tmppath, filepath)
+        except (IOError, OSError):
+            return False
+        return True
+
+
+def _dumps(template, stream):
+    """Serialize the state and the prepared stream of a template.
+
+    :raise TypeError: if the stream contains objects that can't be stored
+    """
+    state = []
+    for name, value in template.__dict__.items():
+        if name not in _TRANSIENT:
+            try:
+                state.append((name, _encode(value)))
+            except TypeError:
+                # Attributes only used for parsing, such as the regular
+                # expressions of text templates, don't need to be kept
+                pass
+    return marshal.dumps((state, _encode(stream)))
+
+def _loads(data):
+    """Restore the ``(state, stream)`` tuple serialized by `_dumps()`."""
+    state, stream = marshal.loads(data)
+    state = dict([(name, _decode(value)) for name, value in state])
+    return state, _decode(stream)
+
+def _digest(source):
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    return sha1(source).hexdigest()
+
+def _classref(cls):
+    return cls.__module__, cls.__name__
+
+def _import(module, name):
+    return getattr(__import__(module, {}, {}, [name]), name)
+
+def _encode(obj):
+    """Reduce an object found in a prepared template stream to a value that
+    can be stored using `marshal`.
+
+    Lists and the atomic types are kept as they are, everything else is turned
+    into a tuple starting with a tag identifying the type.
+    """
+    cls = type(obj)
+    if cls in _ATOMS:
+        return obj
+    elif cls is list or cls is CompactStream:
+        return [_encode(item) for item in obj]
+    elif cls is tuple:
+        return ('t',) + tuple([_encode(item) for item in obj])
+    elif cls is dict:
+        return ('d', [(_encode(k), _encode(v)) for k, v in obj.items()])
+    elif cls is frozenset:
+        return ('f', [_encode(item) for item in obj])
+    elif cls is StreamEventKind:
+        return ('k', str(obj))
+    elif cls is QName:
+        return ('q', unicode(obj))
+    elif cls is Markup:
+        return ('m', unicode(obj))
+    elif cls is Attrs:
+        return ('a', [(_encode(name), _encode(value)) for name, value in obj])
+    elif cls is Path:
+        return ('p', obj.source)
+    elif isinstance(obj, type):
+        return ('c',) + _classref(obj)
+    elif isinstance(obj, Code):
+        return ('e', _classref(cls), obj.source, obj.code,
+                _classref(obj._globals.im_self))
+    elif isinstance(obj, Directive):
+        slots = []
+        for base in cls.__mro__:
+            for name in base.__dict__.get('__slots__', ()):
+                if hasattr(obj, name):
+                    slots.append((name, _encode(getattr(obj, name))))
+        return ('o', _classref(cls), slots)
+    elif cls is FunctionType and obj.func_code is _ASSIGN_CODE:
+        # Assignment function of a `py:for` or `py:with` directive
+        return ('n', _encode(obj.func_defaults[0]))
+    raise TypeError('Can not cache object of type %r' % cls)
+
+def _decode_code(cls, source, code, lookup):
+    cls = _import(*cls)
+    obj = cls.__new__(cls)
+    obj.source = source
+    obj.code = code
+    obj._ast = None
+    obj._globals = _import(*lookup).globals
+    return obj
+
+def _decode_directive(cls, slots):
+    cls = _import(*cls)
+    obj = cls.__new__(cls)
+    for name, value in slots:
+        setattr(obj, name, _decode(value))
+    return obj
+
+_DECODERS = {
+    't': lambda *items: tuple([_decode(item) for item in items]),
+    'd': lambda items: dict([(_decode(k), _decode(v)) for k, v in items]),
+    'f': lambda items: frozenset([_decode(item) for item in items]),
+    'k': StreamEventKind,
+    'q': QName,
+    'm': Markup,
+    'a': lambda items: Attrs([(_decode(k), _decode(v)) for k, v in items]),
+    'p': Path,
+    'c': _import,
+    'e': _decode_code,
+    'o': _decode_directive,
+    'n': lambda names: _assigner(_decode(names))
+}
+
+def _decode(obj):
+    """Restore an object reduced by `_encode()`."""
+    cls = type(obj)
+    if cls is list:
+        return [_decode(item) for item in obj]
+    elif cls is tuple:
+        return _DECODERS[obj[0]](*obj[1:])
+    return obj
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Compact storage of prepared template streams.
+
+A prepared template stream kept as a list of ``(kind, data, pos)`` tuples
+costs two tuples and a list slot for every event, on top of the event data
+itself, and equal data such as white-space or end tags is stored over and over
+again. Instead, the events of all the streams of a template can be stored in an
+`EventTable`: a set of parallel arrays of small integers, holding the codes of
+the event kinds, indexes into a table of the distinct event data, and the file
+names, line numbers and column offsets of the positions. A `CompactStream` is
+the range of a table holding the events of one stream.
+
+Iterating over a compact stream produces the same event tuples as the list it
+was created from:
+
+>>> from genshi.input import XML
+>>> events = list(XML('<ul><li>1</li><li>2</li></ul>'))
+>>> stream = CompactStream(events)
+>>> list(stream) == events
+True
+>>> len(stream), stream[1]
+(8, ('START', (QName('li'), Attrs()), (None, 1, 4)))
+>>> len(stream.table.values)
+6
+"""
+
+from array import array
+from itertools import izip
+
+from genshi.core import Attrs, Markup, QName
+
+__all__ = ['CompactStream', 'EventTable']
+__docformat__ = 'restructuredtext en'
+
+_STRINGS = frozenset([str, unicode, Markup, QName])
+_TYPECODES = 'BbHhIiLl'
+
+
+class EventTable(object):
+    """The events of one or more `CompactStream` objects, stored in parallel
+    arrays, and the tables of the distinct event kinds, event data, and file
+    names they reference.
+
+    Event data is shared between the events of a table when it is of the same
+    type and equal, for strings and for start tags with string attribute
+    values, or when it is the same object otherwise. Start tags also share the
+    tag name with other tags of the same name.
+    """
+    __slots__ = ['kinds', 'values', 'files', 'kind_codes', 'value_codes',
+                 'file_codes', 'lines', 'offsets', '_index']
+
+    def __init__(self):
+        self.kinds = [] #: the distinct event kinds
+        self.values = [] #: the distinct event data
+        self.files = [] #: the distinct file names of the positions
+        self.kind_codes = array('B') #: the index of the kind of every event
+        self.value_codes = array('B') #: the index of the data of every event
+        self.file_codes = array('B') #: the index of the file of every event
+        self.lines = array('B') #: the line number of every event
+        self.offsets = array('B') #: the column offset of every event
+        self._index = None
+
+    def __getstate__(self):
+        return self.kinds, self.values, self.files, self.kind_codes, \
+               self.value_codes, self.file_codes, self.lines, self.offsets
+
+    def __setstate__(self, state):
+        self.kinds, self.values, self.files, self.kind_codes, \
+            self.value_codes, self.file_codes, self.lines, \
+            self.offsets = state
+        self._index = None
+
+    def __len__(self):
+        return len(self.kind_codes)
+
+    def __repr__(self):
+        return '<%s %d events, %d values>' % (type(self).__name__, len(self),
+                                              len(self.values))
+
+    def add(self, events):
+        """Append the given events to the table.
+
+        :param events: an iterable of ``(kind, data, pos)`` event tuples, where
+                       ``pos`` is a ``(filename, lineno, offset)`` tuple of
+                       the file name and two integers
+        :return: a ``(start, stop)`` tuple of the range of the table holding
+                 the events
+        :raise TypeError: if an event has a position that is not a tuple of a
+                          file name and two integers
+        """
+        index = self._get_index()
+        kinds, values, files, lines, offsets = [], [], [], [], []
+        for kind, data, pos in events:
+            filename, lineno, offset = pos
+            if type(lineno) not in (int, long) or \
+                    type(offset) not in (int, long):
+                raise TypeError('Invalid position %r' % (pos,))
+
+            code = index.get((0, kind))
+            if code is None:
+                code = index[0, kind] = len(self.kinds)
+                self.kinds.append(kind)
+            kinds.append(code)
+
+            if type(data) is tuple and len(data) == 2 and \
+                    type(data[0]) is QName and type(data[1]) is Attrs:
+                # Start tag: the tag name is also stored on its own, so that
+                # it can be shared with other start and end tags
+                tag = data[0]
+                code = index.get((QName, tag))
+                if code is None:
+                    index[QName, tag] = len(self.values)
+                    self.values.append(tag)
+                elif self.values[code] is not tag:
+                    data = self.values[code], data[1]
+
+            key = _key(data)
+            code = index.get(key)
+            if code is None:
+                code = index[key] = len(self.values)
+                self.values.append(data)
+            values.append(code)
+
+            code = index.get((1, filename))
+            if code is None:
+                code = index[1, filename] = len(self.files)
+                self.files.append(filename)
+            files.append(code)
+
+            lines.append(lineno)
+            offsets.append(offset)
+
+        start = len(self)
+        self.kind_codes = _extend(self.kind_codes, kinds)
+        self.value_codes = _extend(self.value_codes, values)
+        self.file_codes = _extend(self.file_codes, files)
+        self.lines = _extend(self.lines, lines)
+        self.offsets = _extend(self.offsets, offsets)
+        return start, len(self)
+
+    def pack(self):
+        """Discard the index used for looking up the entries of the tables while
+        events are added; it is rebuilt when more events are added.
+        """
+        self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            index = {}
+            for code, kind in enumerate(self.kinds):
+                index[0, kind] = code
+            for code, value in enumerate(self.values):
+                index[_key(value)] = code
+            for code, filename in enumerate(self.files):
+                index[1, filename] = code
+            self._index = index
+        return self._index
+
+
+def _key(value):
+    """Return the key under which the given event data is looked up in the
+    index of an `EventTable`.
+    """
+    cls = type(value)
+    if cls in _STRINGS:
+        return cls, value
+    elif cls is tuple and len(value) == 2 and type(value[1]) is Attrs and \
+            type(value[0]) is QName:
+        key = [cls, value[0]]
+        for name, attr in value[1]:
+            if type(attr) not in _STRINGS:
+                return id(value)
+            key.extend((type(name), name, type(attr), attr))
+        return tuple(key)
+    return id(value)
+
+def _fits(typecode, low, high):
+    bits = array(typecode).itemsize * 8
+    if typecode.isupper():
+        return 0 <= low and high < (1 << bits)
+    return -(1 << (bits - 1)) <= low and high < (1 << (bits - 1))
+
+def _extend(arr, codes):
+    """Append the given integers to an array, replacing the array by one of a
+    larger item type if they don't fit.
+
+    :return: the array the integers were appended to
+    """
+    if codes:
+        low, high = min(codes), max(codes)
+        if not _fits(arr.typecode, low, high):
+            if arr:
+                low, high = min(low, min(arr)), max(high, max(arr))
+            for typecode in _TYPECODES:
+                if _fits(typecode, low, high):
+                    break
+            arr = array(typecode, arr)
+        arr.extend(codes)
+    return arr
+
+
+class CompactStream(object):
+    """A sequence of markup events stored in an `EventTable`.
+
+    Besides iteration, the stream supports `len()`, and indexing and slicing
+    (which return event tuples and lists of event tuples, respectively), so
+    that it can be used in place of a list of events that is not modified.
+    """
+    __slots__ = ['table', 'start', 'stop']
+
+    def __init__(self, events, table=None):
+        """Create the stream.
+
+        :param events: an iterable of ``(kind, data, pos)`` event tuples
+        :param table: the `EventTable` to store the events in; if omitted, the
+                      stream gets a table of its own
+        :raise TypeError: if an event has a position that is not a tuple of a
+                          file name and two integers
+        :see: `EventTable.add`
+        """
+        if table is None:
+            table = EventTable()
+        self.table = table
+        self.start, self.stop = table.add(events)
+
+    def __getstate__(self):
+        return self.table, self.start, self.stop
+
+    def __setstate__(self, state):
+        self.table, self.start, self.stop = state
+
+    def __iter__(self):
+        table = self.table
+        start, stop = self.start, self.stop
+        kinds, values, files = table.kinds, table.values, table.files
+        for kind, value, filename, lineno, offset in izip(
+                table.kind_codes[start:stop], table.value_codes[start:stop],
+                table.file_codes[start:stop], table.lines[start:stop],
+                table.offsets[start:stop]):
+            yield kinds[kind], values[value], (files[filename], lineno, offset)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('stream index out of range')
+        idx += self.start
+        table = self.table
+        return table.kinds[table.kind_codes[idx]], \
+               table.values[table.value_codes[idx]], \
+               (table.files[table.file_codes[idx]], table.lines[idx],
+                table.offsets[idx])
+
+    def __repr__(self):
+        return '<%s %d events>' % (type(self).__name__, len(self))
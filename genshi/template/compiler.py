@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+"""Compilation of prepared template streams into Python generator functions.
+
+When a template is rendered, the prepared event stream is normally walked by
+`Template._flatten`, which applies directives through a chain of nested
+generators. This module provides an alternative: the prepared stream is
+translated into the source code of a single Python generator function, in
+which static events are yielded directly, expressions and code blocks are
+evaluated inline, and the common control flow directives (``py:if``,
+``py:for``, ``py:with``, ``py:choose`` and ``py:strip``) are turned into
+native Python conditionals and loops.
+
+Any directive the compiler does not know how to translate is applied at
+runtime exactly as the interpreter would apply it, so the compiled function
+produces the same event stream as `Template._flatten`.
+
+>>> from genshi.template import MarkupTemplate
+>>> tmpl = MarkupTemplate('''<ul xmlns:py="http://genshi.edgewall.org/">
+...   <li py:for="item in items" py:if="item % 2">${item}</li>
+... </ul>''')
+>>> print(tmpl.compile().generate(items=[1, 2, 3]))
+<ul>
+  <li>1</li><li>3</li>
+</ul>
+"""
+
+from genshi.core import Attrs, START, TEXT, _ensure
+from genshi.template.base import EXEC, EXPR, SUB, _apply_directives, \
+                                 _eval_expr, _exec_suite
+from genshi.template.directives import ChooseDirective, ForDirective, \
+                                       IfDirective, StripDirective, \
+                                       WithDirective
+
+__all__ = ['TemplateCompiler', 'compile_stream']
+__docformat__ = 'restructuredtext en'
+
+
+class TemplateCompiler(object):
+    """Translates a prepared template stream into the source code of a Python
+    generator function.
+
+    The generated function takes the context and a dictionary of additional
+    variables as arguments, and yields the same events that
+    `Template._flatten` would produce for the stream.
+    """
+
+    MAX_NESTING = 16
+    """The maximum number of nested loops in generated code; the Python
+    compiler refuses more than 20 statically nested blocks, so directives
+    nested deeper than this are applied at runtime instead."""
+
+    def __init__(self, template):
+        """Create the compiler.
+
+        :param template: the `Template` object the stream belongs to
+        """
+        self.template = template
+        self.consts = []
+        self.lines = []
+        self.counter = 0
+
+    def compile(self, stream):
+        """Compile the given prepared stream.
+
+        :param stream: the prepared event stream of the template
+        :return: the generator function
+        """
+        self._line(0, 'def _generate(ctxt, vars):')
+        self._stream(list(stream), 0, 1)
+        self._line(1, 'if 0: yield None')
+
+        template = self.template
+        filename = '<compiled %s>' % (template.filepath or 'template')
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8', 'replace')
+        code = compile('\n'.join(self.lines) + '\n', filename, 'exec')
+        namespace = {
+            '_c': self.consts,
+            '_flatten': template._flatten,
+            '_number_conv': template._number_conv,
+            '_start': _start,
+            '_apply_directives': _apply_directives,
+            '_eval_expr': _eval_expr,
+            '_exec_suite': _exec_suite,
+            '_ensure': _ensure,
+            '_basestring': basestring,
+            '_numbers': (int, float, long),
+            '_unicode': unicode,
+            'START': START,
+            'TEXT': TEXT
+        }
+        exec code in namespace
+        return namespace['_generate']
+
+    def _const(self, value):
+        self.consts.append(value)
+        return '_c[%d]' % (len(self.consts) - 1)
+
+    def _line(self, depth, code):
+        self.lines.append('    ' * depth + code)
+
+    def _name(self, prefix):
+        self.counter += 1
+        return '%s%d' % (prefix, self.counter)
+
+    def _block(self, func, depth, *args):
+        # Make sure the block has a body, even if nothing was emitted
+        count = len(self.lines)
+        func(*(args + (depth,)))
+        if len(self.lines) == count:
+            self._line(depth, 'pass')
+
+    def _stream(self, stream, loops, depth):
+        static = []
+        def _flush():
+            if len(static) == 1:
+                self._line(depth, 'yield %s' % self._const(static[0]))
+            elif static:
+                self._line(depth, 'for _ev in %s: yield _ev' %
+                           self._const(tuple(static)))
+            del static[:]
+
+        for event in stream:
+            kind, data, pos = event
+            if kind is SUB:
+                _flush()
+                self._directives(data[0], data[1], loops, depth)
+            elif kind is EXPR:
+                _flush()
+                self._expr(data, pos, depth)
+            elif kind is EXEC:
+                _flush()
+                self._line(depth, '_exec_suite(%s, ctxt, vars)' %
+                           self._const(data))
+            elif kind is START and [1 for _, value in data[1]
+                                    if type(value) is list]:
+                _flush()
+                self._line(depth, 'yield _start(_flatten, %s, ctxt, vars)' %
+                           self._const(event))
+            else:
+                static.append(event)
+        _flush()
+
+    def _expr(self, expr, pos, depth):
+        pos = self._const(pos)
+        self._line(depth, '_r = _eval_expr(%s, ctxt, vars)' %
+                   self._const(expr))
+        self._line(depth, 'if _r is not None:')
+        depth += 1
+        self._line(depth, 'if isinstance(_r, _basestring):')
+        self._line(depth + 1, 'yield TEXT, _r, %s' % pos)
+        self._line(depth, 'elif isinstance(_r, _numbers):')
+        self._line(depth + 1, 'yield TEXT, _number_conv(_r), %s' % pos)
+        self._line(depth, "elif hasattr(_r, '__iter__'):")
+        self._line(depth + 1, 'for _ev in _flatten(_ensure(_r), ctxt, '
+                              '**vars): yield _ev')
+        self._line(depth, 'else:')
+        self._line(depth + 1, 'yield TEXT, _unicode(_r), %s' % pos)
+
+    def _directives(self, directives, stream, loops, depth):
+        if not directives:
+            self._stream(stream, loops, depth)
+            return
+
+        directive, rest = directives[0], directives[1:]
+        cls = type(directive)
+
+        if loops >= self.MAX_NESTING:
+            cls = None
+
+        if cls is IfDirective:
+            self._line(depth, 'if _eval_expr(%s, ctxt, vars):' %
+                       self._const(directive.expr))
+            self._block(self._directives, depth + 1, rest, stream, loops)
+
+        elif cls is ForDirective:
+            iterable = self._name('_it')
+            scope = self._name('_scope')
+            assign = self._name('_assign')
+            bind = self._name('_bind')
+            item = self._name('_item')
+            self._line(depth, '%s = _eval_expr(%s, ctxt, vars)' %
+                       (iterable, self._const(directive.expr)))
+            self._line(depth, 'if %s is not None:' % iterable)
+            self._line(depth + 1, '%s = {}' % scope)
+            self._line(depth + 1, '%s = %s' % (assign,
+                                              self._const(directive.assign)))
+            self._line(depth + 1, '%s = None' % bind)
+            self._line(depth + 1, 'for %s in %s:' % (item, iterable))
+            self._line(depth + 2, '%s(%s, %s)' % (assign, scope, item))
+            self._line(depth + 2, 'if %s is None:' % bind)
+            self._line(depth + 3, 'ctxt.push(%s)' % scope)
+            self._line(depth + 3, '%s = ctxt._vars.update' % bind)
+            self._line(depth + 2, 'else: %s(%s)' % (bind, scope))
+            self._directives(rest, stream, loops + 1, depth + 2)
+            self._line(depth + 1, 'if %s is not None: ctxt.pop()' % bind)
+
+        elif cls is WithDirective:
+            self._line(depth, 'ctxt.push({})')
+            self._line(depth, 'for _targets, _expr in %s:' %
+                       self._const(directive.vars))
+            self._line(depth + 1, '_r = _eval_expr(_expr, ctxt, vars)')
+            self._line(depth + 1, 'for _assign in _targets: _assign(ctxt, _r)')
+            self._directives(rest, stream, loops, depth)
+            self._line(depth, 'ctxt.pop()')
+
+        elif cls is ChooseDirective:
+            info = self._name('_info')
+            self._line(depth, '%s = [False, %r, None]' %
+                       (info, bool(directive.expr)))
+            if directive.expr:
+                self._line(depth, '%s[2] = _eval_expr(%s, ctxt, vars)' %
+                           (info, self._const(directive.expr)))
+            self._line(depth, 'ctxt._choice_stack.append(%s)' % info)
+            self._directives(rest, stream, loops, depth)
+            self._line(depth, 'ctxt._choice_stack.pop()')
+
+        elif cls is StripDirective and len(stream) >= 2 and \
+                stream[0][0] is START and (not directive.expr or not rest):
+            inner = stream[1:-1]
+            if directive.expr:
+                strip = self._name('_strip')
+                self._line(depth, '%s = _eval_expr(%s, ctxt, vars)' %
+                           (strip, self._const(directive.expr)))
+                self._line(depth, 'if not %s:' % strip)
+                self._stream(stream[:1], loops, depth + 1)
+                self._stream(inner, loops, depth)
+                self._line(depth, 'if not %s:' % strip)
+                self._block(self._stream, depth + 1, stream[-1:], loops)
+            else:
+                self._directives(rest, inner, loops, depth)
+
+        else:
+            # Not something we know how to translate, so apply the remaining
+            # directives at runtime and flatten the result
+            self._line(depth, 'for _ev in _flatten(_apply_directives(%s, %s, '
+                              'ctxt, vars), ctxt, **vars): yield _ev' %
+                       (self._const(stream), self._const(directives)))
+
+
+def _start(flatten, event, ctxt, vars):
+    """Evaluate the interpolated attributes of a start tag event; this is the
+    same processing `Template._flatten` applies to ``START`` events.
+    """
+    kind, (tag, attrs), pos = event
+    new_attrs = []
+    for name, value in attrs:
+        if type(value) is list: # this is an interpolated string
+            values = [event[1] for event in flatten(value, ctxt, **vars)
+                      if event[0] is TEXT and event[1] is not None]
+            if not values:
+                continue
+            value = ''.join(values)
+        new_attrs.append((name, value))
+    return kind, (tag, Attrs(new_attrs)), pos
+
+
+def compile_stream(template, stream):
+    """Compile the prepared event stream of a template into a generator
+    function.
+
+    :param template: the `Template` object the stream belongs to
+    :param stream: the prepared event stream
+    :return: a generator function that takes the `Context` and a dictionary of
+             additional variables, and yields the flattened events
+    """
+    return TemplateCompiler(template).compile(stream)
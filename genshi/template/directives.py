@@ -13,17 +13,22 @@
 
 """Implementation of the various template directives."""
 
-from genshi.core import QName, Stream
-from genshi.path import Path
+import re
+
+from genshi.compat import StopAsyncIteration
+from genshi.core import QName, Stream, AWAIT, FLUSH, START
+from genshi.path import ATTRIBUTE, CHILD, LocalNameTest, Path, \
+                        QualifiedNameTest
 from genshi.template.base import TemplateRuntimeError, TemplateSyntaxError, \
-                                 EXPR, _apply_directives, _eval_expr
+                                 EXEC, EXPR, INCLUDE, SUB, _apply_directives, \
+                                 _eval_expr, _Awaiting
 from genshi.template.eval import Expression, ExpressionASTTransformer, \
                                  _ast, _parse
 
 __all__ = ['AttrsDirective', 'ChooseDirective', 'ContentDirective',
-           'DefDirective', 'ForDirective', 'IfDirective', 'MatchDirective',
-           'OtherwiseDirective', 'ReplaceDirective', 'StripDirective',
-           'WhenDirective', 'WithDirective']
+           'DefDirective', 'FlushDirective', 'ForDirective', 'IfDirective',
+           'MatchDirective', 'OtherwiseDirective', 'ReplaceDirective',
+           'StripDirective', 'WhenDirective', 'WithDirective']
 __docformat__ = 'restructuredtext en'
 
 
@@ -107,7 +112,8 @@ class Directive(object):
         """
         try:
             return expr and Expression(expr, template.filepath, lineno,
-                                       lookup=template.lookup) or None
+                                       lookup=template.lookup,
+                                       keep_ast=template.keep_ast) or None
         except SyntaxError, err:
             err.msg += ' in expression "%s" of "%s" directive' % (expr,
                                                                   cls.tagname)
@@ -124,7 +130,15 @@ def _assignment(ast):
             return tuple([_names(child) for child in node.elts])
         elif isinstance(node, _ast.Name):
             return node.id
-    def _assign(data, value, names=_names(ast)):
+    return _assigner(_names(ast))
+
+
+def _assigner(names):
+    """Returns a function that applies the assignment of a given value to a
+    dictionary, where `names` is either a single name, or a (possibly nested)
+    tuple of names the value is unpacked into.
+    """
+    def _assign(data, value, names=names):
         if type(names) is tuple:
             for idx in range(len(names)):
                 _assign(data, value[idx], names[idx])
@@ -315,7 +329,7 @@ class DefDirective(Directive):
         # Store the function reference in the bottom context frame so that it
         # doesn't get popped off before processing the template has finished
         # FIXME: this makes context data mutable as a side-effect
-        ctxt.frames[-1][self.name] = function
+        ctxt._set_global(self.name, function)
 
         return []
 
@@ -357,24 +371,75 @@ class ForDirective(Directive):
                                                namespaces, pos)
 
     def __call__(self, stream, directives, ctxt, **vars):
-        iterable = _eval_expr(self.expr, ctxt, vars)
+        if ctxt._async:
+            iterable = _eval_expr(self.expr, ctxt, dict(vars, iter=_aiter))
+            if hasattr(iterable, '__anext__'):
+                for event in self._iterate_async(iterable, stream, directives,
+                                                 ctxt, vars):
+                    yield event
+                return
+        else:
+            iterable = _eval_expr(self.expr, ctxt, vars)
         if iterable is None:
             return
 
         assign = self.assign
         scope = {}
         stream = list(stream)
+        bind = None
         for item in iterable:
             assign(scope, item)
-            ctxt.push(scope)
+            if bind is None:
+                # The scope is only pushed once, and the loop variables are
+                # rebound on later iterations
+                ctxt.push(scope)
+                bind = ctxt._vars.update
+            else:
+                bind(scope)
+            for event in _apply_directives(stream, directives, ctxt, vars):
+                yield event
+        if bind is not None:
+            ctxt.pop()
+
+    def _iterate_async(self, iterator, stream, directives, ctxt, vars):
+        # The renderer awaits the next item and stores it in the `AWAIT` event
+        # data, which is checked when the renderer asks for the next event
+        assign = self.assign
+        scope = {}
+        stream = list(stream)
+        bind = None
+        pos = (self.filename, -1, -1)
+        while 1:
+            pending = _Awaiting(iterator.__anext__(), pos)
+            yield AWAIT, pending, pos
+            try:
+                item = pending.get()
+            except StopAsyncIteration:
+                break
+            assign(scope, item)
+            if bind is None:
+                ctxt.push(scope)
+                bind = ctxt._vars.update
+            else:
+                bind(scope)
             for event in _apply_directives(stream, directives, ctxt, vars):
                 yield event
+        if bind is not None:
             ctxt.pop()
 
     def __repr__(self):
         return '<%s>' % type(self).__name__
 
 
+def _aiter(obj):
+    """Return an asynchronous iterator for objects that support asynchronous
+    iteration, and a normal iterator otherwise.
+    """
+    if hasattr(obj, '__aiter__'):
+        return obj.__aiter__()
+    return iter(obj)
+
+
 class IfDirective(Directive):
     """Implementation of the ``py:if`` template directive for conditionally
     excluding elements from being output.
@@ -421,7 +486,7 @@ class MatchDirective(Directive):
       </span>
     </div>
     """
-    __slots__ = ['path', 'namespaces', 'hints']
+    __slots__ = ['path', 'namespaces', 'hints', 'inferred']
 
     def __init__(self, value, template, hints=None, namespaces=None,
                  lineno=-1, offset=-1):
@@ -429,10 +494,12 @@ class MatchDirective(Directive):
         self.path = Path(value, template.filepath, lineno)
         self.namespaces = namespaces or {}
         self.hints = hints or ()
+        self.inferred = frozenset()
 
     @classmethod
     def attach(cls, template, stream, value, namespaces, pos):
         hints = []
+        given = ()
         if type(value) is dict:
             if value.get('buffer', '').lower() == 'false':
                 hints.append('not_buffered')
@@ -440,20 +507,178 @@ class MatchDirective(Directive):
                 hints.append('match_once')
             if value.get('recursive', '').lower() == 'false':
                 hints.append('not_recursive')
+            given = value
             value = value.get('path')
-        return cls(value, template, frozenset(hints), namespaces, *pos[1:]), \
-               stream
+        directive = cls(value, template, frozenset(hints), namespaces,
+                        *pos[1:])
+
+        # Hints that were not given explicitly are inferred from the path and
+        # the body of the match template where that is safe
+        directive.inferred = frozenset([
+            hint for hint in _infer_hints(directive.path, stream,
+                                          namespaces or {})
+            if _HINT_ATTRS[hint] not in given
+        ])
+        directive.hints = directive.inferred.union(directive.hints)
+        return directive, stream
 
     def __call__(self, stream, directives, ctxt, **vars):
+        hints = self.hints
+        if directives and 'not_buffered' in self.inferred:
+            # Other directives on the element may evaluate the body more than
+            # once, or in a different scope than the matched content
+            hints = hints - _NOT_BUFFERED
         ctxt._match_templates.append((self.path.test(ignore_context=True),
-                                      self.path, list(stream), self.hints,
-                                      self.namespaces, directives))
+                                      self.path, list(stream), hints,
+                                      self.namespaces, directives,
+                                      _element_names(self.path)))
         return []
 
     def __repr__(self):
         return '<%s "%s">' % (type(self).__name__, self.path.source)
 
 
+def _element_names(path):
+    """Return the local names of all elements a match template path can
+    match, or `None` if the path may match elements with any name.
+    
+    Names are only returned for paths consisting of a single step with a
+    name test, such as ``body`` or ``html:head[@class]``. The test functions
+    of these paths don't keep any state for elements with other names, so
+    those elements don't need to be tested at all.
+    """
+    names = set()
+    for steps in path.paths:
+        if len(steps) != 1:
+            return None
+        axis, nodetest, predicates = steps[0]
+        if axis is ATTRIBUTE or \
+                not isinstance(nodetest, (LocalNameTest, QualifiedNameTest)):
+            return None
+        names.add(nodetest.name)
+    return frozenset(names)
+
+
+_HINT_ATTRS = {'not_buffered': 'buffer', 'match_once': 'once',
+               'not_recursive': 'recursive'}
+_NOT_BUFFERED = frozenset(['not_buffered'])
+_SELECT_RE = re.compile(r'\bselect\b')
+_XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+# Paths of XHTML elements that occur only once in a document
+_UNIQUE_PATHS = frozenset([('html',), ('html', 'head'), ('html', 'body')])
+
+# HTML elements that can not contain other elements
+_LEAF_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+                            'input', 'link', 'meta', 'option', 'param',
+                            'script', 'source', 'style', 'textarea', 'track',
+                            'wbr'])
+
+def _infer_hints(path, stream, namespaces):
+    """Return the optimization hints that can be applied to a match template
+    without changing its output.
+    
+    :param path: the `Path` of the match template
+    :param stream: the body of the match template, before its directives have
+                   been attached
+    :param namespaces: the namespace prefixes in scope
+    """
+    hints = []
+    if _is_streamable(stream):
+        hints.append('not_buffered')
+    if _is_unique_path(path, namespaces):
+        hints.append('match_once')
+    else:
+        names = _html_names(path, namespaces)
+        if names and names <= _LEAF_ELEMENTS:
+            hints.append('not_recursive')
+    return hints
+
+def _html_names(path, namespaces):
+    """Return the names of the XHTML elements a match template path selects,
+    or `None` if the path may select other elements.
+    
+    Elements in no namespace don't qualify, as plain XML documents may use the
+    names of HTML elements for anything.
+    """
+    names = set()
+    for steps in path.paths:
+        axis, nodetest, predicates = steps[-1]
+        if axis is ATTRIBUTE:
+            return None
+        if _step_namespace(nodetest, namespaces) != _XHTML_NAMESPACE:
+            return None
+        names.add(nodetest.name)
+    return frozenset(names)
+
+def _is_unique_path(path, namespaces):
+    """Return whether a match template path selects an element that occurs
+    only once in a document.
+    
+    Only the ``html`` document element and its ``head`` and ``body`` children
+    in the XHTML namespace qualify, and the path must lead to them from the
+    document element. Other XML documents may well contain any number of
+    elements with those names.
+    """
+    if len(path.paths) != 1:
+        return False
+    names = []
+    for axis, nodetest, predicates in path.paths[0]:
+        if axis is not CHILD or \
+                _step_namespace(nodetest, namespaces) != _XHTML_NAMESPACE:
+            return False
+        names.append(nodetest.name)
+    return tuple(names) in _UNIQUE_PATHS
+
+def _step_namespace(nodetest, namespaces):
+    if isinstance(nodetest, LocalNameTest):
+        return namespaces.get('')
+    elif isinstance(nodetest, QualifiedNameTest):
+        return namespaces.get(nodetest.prefix)
+    return False
+
+def _is_streamable(stream):
+    """Return whether the body of a match template can consume the matched
+    content while it is being generated, instead of buffering it.
+    
+    That is the case if the body references the ``select()`` function exactly
+    once, in an expression that is not nested inside another directive, so
+    that the content is consumed at most once, in document order. The body
+    must also not contain code blocks, includes, or macro and match template
+    definitions, which could change the context before the content has been
+    consumed.
+    """
+    refs = 0
+    for depth, kind, data in _walk(stream):
+        if kind is EXEC or kind is INCLUDE:
+            return False
+        elif kind is SUB:
+            for directive in data[0]:
+                if isinstance(directive, Directive) or \
+                        directive[1] in (DefDirective, MatchDirective) or \
+                        _SELECT_RE.search(repr(directive[2])):
+                    return False
+        elif kind is START:
+            # Attribute values have not been interpolated yet at this point,
+            # so expressions are still embedded in the raw strings
+            for name, value in data[1]:
+                if _SELECT_RE.search(unicode(value)):
+                    return False
+        elif kind is EXPR:
+            count = len(_SELECT_RE.findall(data.source))
+            if count and depth:
+                return False
+            refs += count
+    return refs == 1
+
+def _walk(stream, depth=0):
+    for kind, data, pos in stream:
+        yield depth, kind, data
+        if kind is SUB:
+            for event in _walk(data[1], depth + 1):
+                yield event
+
+
 class ReplaceDirective(Directive):
     """Implementation of the ``py:replace`` template directive.
     
@@ -540,6 +765,64 @@ class StripDirective(Directive):
         return _apply_directives(_generate(), directives, ctxt, vars)
 
 
+class FlushDirective(Directive):
+    """Implementation of the ``py:flush`` template directive.
+    
+    This directive adds a `FLUSH` event to the stream after the element, so
+    that the output up to that point is written out right away when the
+    template is rendered to a file or iterated over in chunks, instead of
+    being held back in a buffer. For example, browsers can start fetching the
+    stylesheets and scripts referenced in the ``<head>`` of a page while the
+    rest of the page is still being generated:
+    
+    >>> from genshi.template import MarkupTemplate
+    >>> tmpl = MarkupTemplate('''<html xmlns:py="http://genshi.edgewall.org/">
+    ...   <head py:flush=""><title>Foo</title></head>
+    ...   <body>${body}</body>
+    ... </html>''')
+    >>> for chunk in tmpl.generate(body='Bar').render_iter():
+    ...     print(repr(chunk))
+    '<html>\\n  <head><title>Foo</title></head>'
+    '\\n  <body>Bar</body>\\n</html>'
+    
+    If the attribute value is not empty, the output is only flushed if the
+    value evaluates to a truth value. The directive can also be used as an
+    element, in which case the expression goes in the ``test`` attribute, and
+    the output is flushed after the content of the element. The serialized
+    output itself is not affected by the directive:
+    
+    >>> tmpl = MarkupTemplate('''<div xmlns:py="http://genshi.edgewall.org/">
+    ...   <p>Foo</p><py:flush/>
+    ... </div>''')
+    >>> print(tmpl.generate())
+    <div>
+      <p>Foo</p>
+    </div>
+    
+    Flushes inside content that is buffered by a match template are deferred
+    until the output of the match template is complete.
+    """
+    __slots__ = ['pos']
+
+    def __init__(self, value, template=None, namespaces=None, lineno=-1,
+                 offset=-1):
+        Directive.__init__(self, value, template, namespaces, lineno, offset)
+        self.pos = (template and template.filepath, lineno, offset)
+
+    @classmethod
+    def attach(cls, template, stream, value, namespaces, pos):
+        if type(value) is dict:
+            value = value.get('test')
+        return super(FlushDirective, cls).attach(template, stream, value,
+                                                 namespaces, pos)
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        for event in _apply_directives(stream, directives, ctxt, vars):
+            yield event
+        if not self.expr or _eval_expr(self.expr, ctxt, vars):
+            yield FLUSH, None, self.pos
+
+
 class ChooseDirective(Directive):
     """Implementation of the ``py:choose`` directive for conditionally selecting
     one of several body elements to display.
@@ -712,12 +995,11 @@ class WithDirective(Directive):
                                                 namespaces, pos)
 
     def __call__(self, stream, directives, ctxt, **vars):
-        frame = {}
-        ctxt.push(frame)
+        ctxt.push({})
         for targets, expr in self.vars:
             value = _eval_expr(expr, ctxt, vars)
             for assign in targets:
-                assign(frame, value)
+                assign(ctxt, value)
         for event in _apply_directives(stream, directives, ctxt, vars):
             yield event
         ctxt.pop()
@@ -16,13 +16,17 @@
 import __builtin__
 
 from textwrap import dedent
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 from types import CodeType
 
 from genshi.core import Markup
 from genshi.template.astutil import ASTTransformer, ASTCodeGenerator, \
                                     _ast, parse
 from genshi.template.base import TemplateRuntimeError
-from genshi.util import flatten
+from genshi.util import LRUCache, flatten
 
 from genshi.compat import get_code_params, build_code_chunk, IS_PYTHON2
 
@@ -56,10 +60,10 @@ def _star_import_patch(mapping, modname):
 
 class Code(object):
     """Abstract base class for the `Expression` and `Suite` classes."""
-    __slots__ = ['source', 'code', 'ast', '_globals']
+    __slots__ = ['source', 'code', '_ast', '_globals']
 
     def __init__(self, source, filename=None, lineno=-1, lookup='strict',
-                 xform=None):
+                 xform=None, keep_ast=True):
         """Create the code object, either from a string, or from an AST node.
         
         :param source: either a string containing the source code, or an AST
@@ -73,10 +77,16 @@ class Code(object):
         :param xform: the AST transformer that should be applied to the code;
                       if `None`, the appropriate transformation is chosen
                       depending on the mode
+        :param keep_ast: whether the AST parsed from a source string should be
+                         kept after compilation; if `False`, it is discarded,
+                         and parsed again from the source when it is needed
+        
+        :note: Changed in 0.7: Added the `keep_ast` argument
         """
         if isinstance(source, basestring):
             self.source = source
-            node = _parse(source, mode=self.mode)
+            self._ast, self.code = _compile_source(source, self.mode, filename,
+                                                   lineno, xform, keep_ast)
         else:
             assert isinstance(source, _ast.AST), \
                 'Expected string or AST node, but got %r' % source
@@ -87,10 +97,9 @@ class Code(object):
             else:
                 node = _ast.Module()
                 node.body = [source]
-
-        self.ast = node
-        self.code = _compile(node, self.source, mode=self.mode,
-                             filename=filename, lineno=lineno, xform=xform)
+            self._ast = node
+            self.code = _compile(node, self.source, mode=self.mode,
+                                 filename=filename, lineno=lineno, xform=xform)
         if lookup is None:
             lookup = LenientLookup
         elif isinstance(lookup, basestring):
@@ -98,14 +107,14 @@ class Code(object):
         self._globals = lookup.globals
 
     def __getstate__(self):
-        state = {'source': self.source, 'ast': self.ast,
+        state = {'source': self.source, 'ast': self._ast,
                  'lookup': self._globals.im_self}
         state['code'] = get_code_params(self.code)
         return state
 
     def __setstate__(self, state):
         self.source = state['source']
-        self.ast = state['ast']
+        self._ast = state['ast']
         self.code = CodeType(0, *state['code'])
         self._globals = state['lookup'].globals
 
@@ -121,6 +130,39 @@ class Code(object):
     def __repr__(self):
         return '%s(%r)' % (type(self).__name__, self.source)
 
+    def _get_ast(self):
+        node = self._ast
+        if node is None and self.source != '?':
+            node = _parse(self.source, mode=self.mode)
+        return node
+    def _set_ast(self, node):
+        self._ast = node
+    ast = property(_get_ast, _set_ast, """\
+    The AST of the code.
+    
+    If the AST was discarded after compilation, it is parsed again from the
+    source every time this property is accessed.
+    """)
+
+    def _get_globals(self, data):
+        """Return the globals dictionary for executing the code against the
+        given data.
+        
+        If the data object has a ``_globals`` dictionary, as the template
+        `Context` does, the globals are only constructed once for every lookup
+        class, and stored in that dictionary for reuse.
+        
+        :param data: the mapping the code is executed against
+        """
+        cache = getattr(data, '_globals', None)
+        if cache is None:
+            return self._globals(data)
+        try:
+            return cache[self._globals]
+        except KeyError:
+            _globals = cache[self._globals] = self._globals(data)
+            return _globals
+
 
 class Expression(Code):
     """Evaluates Python expressions used in templates.
@@ -173,8 +215,7 @@ class Expression(Code):
         :return: the result of the evaluation
         """
         __traceback_hide__ = 'before_and_this'
-        _globals = self._globals(data)
-        return eval(self.code, _globals, {'__data__': data})
+        return eval(self.code, self._get_globals(data))
 
 
 class Suite(Code):
@@ -194,8 +235,7 @@ class Suite(Code):
         :param data: a mapping containing the data to execute in
         """
         __traceback_hide__ = 'before_and_this'
-        _globals = self._globals(data)
-        exec self.code in _globals, data
+        exec self.code in self._get_globals(data), data
 
 
 UNDEFINED = object()
@@ -283,6 +323,29 @@ class Undefined(object):
     __length_hint__ = None
 
 
+_ITEM_ATTRS = {}
+"""The names for which attribute access in expressions has been found to
+resolve to item access, by type, so that the item can be used directly without
+trying (and failing) to get the attribute first."""
+
+def _has_fixed_attrs(cls):
+    """Return whether the attributes of all instances of the given type are
+    defined by the type alone, so that an attribute access that failed on one
+    instance fails on every other instance.
+    
+    This is only assumed for dictionaries, unless their instances have a
+    ``__dict__``, or their class customizes attribute access.
+    """
+    if not issubclass(cls, dict) or cls.__dictoffset__:
+        return False
+    for base in cls.__mro__:
+        if base is dict:
+            return True
+        if '__getattr__' in base.__dict__ or \
+                '__getattribute__' in base.__dict__:
+            return False
+
+
 class LookupBase(object):
     """Abstract base class for variable lookup implementations."""
 
@@ -291,10 +354,16 @@ class LookupBase(object):
         """Construct the globals dictionary to use as the execution context for
         the expression or suite.
         """
+        lookup_attrs = cls.lookup_attrs
+        if cls.lookup_attr.im_func is not LookupBase.lookup_attr.im_func and \
+                cls.lookup_attrs.im_func is LookupBase.lookup_attrs.im_func:
+            # Attribute chains must go through the custom lookup
+            lookup_attrs = cls._lookup_attrs
         return {
             '__data__': data,
             '_lookup_name': cls.lookup_name,
             '_lookup_attr': cls.lookup_attr,
+            '_lookup_attrs': lookup_attrs,
             '_lookup_item': cls.lookup_item,
             '_star_import_patch': _star_import_patch,
             'UndefinedError': UndefinedError,
@@ -313,16 +382,60 @@ class LookupBase(object):
     @classmethod
     def lookup_attr(cls, obj, key):
         __traceback_hide__ = True
+        if key in _ITEM_ATTRS.get(type(obj), ()):
+            try:
+                return obj[key]
+            except (KeyError, TypeError):
+                return cls.undefined(key, owner=obj)
         try:
-            val = getattr(obj, key)
+            return getattr(obj, key)
         except AttributeError:
             if hasattr(obj.__class__, key):
                 raise
-            else:
+        return cls._lookup_attr_item(obj, key)
+
+    @classmethod
+    def lookup_attrs(cls, obj, keys):
+        """Look up a chain of attributes such as ``a.b.c``, as if
+        `lookup_attr()` was called for every name in turn.
+        
+        :param obj: the object to start the lookup from
+        :param keys: a sequence of attribute names
+        """
+        __traceback_hide__ = True
+        item_attrs = _ITEM_ATTRS.get
+        for key in keys:
+            if key in item_attrs(type(obj), ()):
                 try:
-                    val = obj[key]
+                    obj = obj[key]
+                    continue
                 except (KeyError, TypeError):
-                    val = cls.undefined(key, owner=obj)
+                    return cls.undefined(key, owner=obj)
+            try:
+                obj = getattr(obj, key)
+                continue
+            except AttributeError:
+                if hasattr(obj.__class__, key):
+                    raise
+            obj = cls._lookup_attr_item(obj, key)
+        return obj
+
+    @classmethod
+    def _lookup_attrs(cls, obj, keys):
+        __traceback_hide__ = True
+        for key in keys:
+            obj = cls.lookup_attr(obj, key)
+        return obj
+
+    @classmethod
+    def _lookup_attr_item(cls, obj, key):
+        __traceback_hide__ = True
+        try:
+            val = obj[key]
+        except (KeyError, TypeError):
+            return cls.undefined(key, owner=obj)
+        if _has_fixed_attrs(type(obj)):
+            _ITEM_ATTRS.setdefault(type(obj), set()).add(key)
         return val
 
     @classmethod
@@ -428,8 +541,7 @@ def _parse(source, mode='eval'):
     return parse(source, mode)
 
 
-def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
-             xform=None):
+def _filename(filename):
     if not filename:
         filename = '<string>'
     if IS_PYTHON2:
@@ -440,9 +552,72 @@ def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
         # Python 3 requires unicode filenames
         if not isinstance(filename, unicode):
             filename = filename.decode('utf-8', 'replace')
+    return filename
+
+
+def _rebase(code, filename, name, lineno):
     if lineno <= 0:
         lineno = 1
+    try:
+        # We'd like to just set co_firstlineno, but it's readonly. So we need
+        # to clone the code object while adjusting the line number
+        return build_code_chunk(code, _filename(filename), name, lineno)
+    except RuntimeError:
+        return code
+
+
+_code_cache = LRUCache(2000)
+_code_cache_lock = threading.Lock()
+
+def _compile_source(source, mode, filename=None, lineno=-1, xform=None,
+                    keep_ast=True):
+    """Parse and compile the given source code, reusing the result of an
+    earlier compilation of the same code if possible.
+    
+    Templates tend to contain the same expressions over and over again, so the
+    code objects compiled from a string are kept in a cache shared by all
+    templates, and only need to be cloned with the right file name and line
+    number. The cache does not hold on to the parsed ASTs.
+    
+    :return: a ``(node, code)`` tuple of the parsed AST and the code object;
+             the node is `None` if `keep_ast` is false
+    """
+    key = (type(source), source, mode, xform)
+    _code_cache_lock.acquire()
+    try:
+        code = None
+        if key in _code_cache:
+            code = _code_cache[key]
+    finally:
+        _code_cache_lock.release()
+    if code is not None:
+        node = None
+        if keep_ast:
+            node = _parse(source, mode=mode)
+        return node, _rebase(code, filename, code.co_name, lineno)
+
+    node = _parse(source, mode=mode)
+    code = _compile(node, source, mode=mode, filename=filename, lineno=lineno,
+                    xform=xform)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            # Nested code objects (for lambdas, generator expressions and the
+            # like) keep the file name they were compiled with
+            break
+    else:
+        _code_cache_lock.acquire()
+        try:
+            _code_cache[key] = code
+        finally:
+            _code_cache_lock.release()
+    if not keep_ast:
+        node = None
+    return node, code
 
+
+def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
+             xform=None):
+    filename = _filename(filename)
     if xform is None:
         xform = {
             'eval': ExpressionASTTransformer
@@ -460,15 +635,20 @@ def _compile(node, source=None, mode='eval', filename=None, lineno=-1,
         if len(lines) > 1:
             extract += ' ...'
         name = '<Suite %r>' % (extract)
-    new_source = ASTCodeGenerator(tree).code
-    code = compile(new_source, filename, mode)
 
-    try:
-        # We'd like to just set co_firstlineno, but it's readonly. So we need
-        # to clone the code object while adjusting the line number
-        return build_code_chunk(code, filename, name, lineno)
-    except RuntimeError:
-        return code
+    code = None
+    if xform in (ExpressionASTTransformer, TemplateASTTransformer):
+        # The built-in transformations produce trees that can be compiled
+        # directly; for other transformations, generating the source code and
+        # compiling that is safer, as some versions of Python don't check the
+        # tree thoroughly
+        try:
+            code = compile(tree, filename, mode)
+        except (TypeError, ValueError):
+            pass
+    if code is None:
+        code = compile(ASTCodeGenerator(tree).code, filename, mode)
+    return _rebase(code, filename, name, lineno)
 
 
 def _new(class_, *args, **kwargs):
@@ -477,11 +657,28 @@ def _new(class_, *args, **kwargs):
         if attr in kwargs:
             raise ValueError('Field set both in args and kwargs')
         setattr(ret, attr, value)
-    for attr, value in kwargs:
+    for attr, value in kwargs.items():
         setattr(ret, attr, value)
     return ret
 
 
+def _locate(node, *nodes):
+    """Give nodes created to replace the given node the location of that node,
+    so that the transformed tree can be compiled directly.
+    
+    :param node: the original node
+    :param nodes: the new nodes
+    :return: the last of the new nodes
+    """
+    lineno = getattr(node, 'lineno', None)
+    if lineno is not None:
+        col_offset = node.col_offset
+        for new in nodes:
+            new.lineno = lineno
+            new.col_offset = col_offset
+    return nodes[-1]
+
+
 BUILTINS = __builtin__.__dict__.copy()
 BUILTINS.update({'Markup': Markup, 'Undefined': Undefined})
 CONSTANTS = frozenset(['False', 'True', 'None', 'NotImplemented', 'Ellipsis'])
@@ -524,7 +721,7 @@ class TemplateASTTransformer(ASTTransformer):
             try: # If the string is ASCII, return a `str` object
                 node.s.decode('ascii')
             except ValueError: # Otherwise return a `unicode` object
-                return _new(_ast.Str, node.s.decode('utf-8'))
+                return _locate(node, _new(_ast.Str, node.s.decode('utf-8')))
         return node
 
     def visit_ClassDef(self, node):
@@ -574,14 +771,15 @@ class TemplateASTTransformer(ASTTransformer):
             self.locals.append(set())
             gen = _new(_ast.comprehension, self.visit(generator.target),
                        self.visit(generator.iter),
-                       [self.visit(if_) for if_ in generator.ifs])
+                       [self.visit(if_) for if_ in generator.ifs],
+                       getattr(generator, 'is_async', 0))
             gens.append(gen)
 
         # use node.__class__ to make it reusable as ListComp
         ret = _new(node.__class__, self.visit(node.elt), gens)
         #delete inserted locals
         del self.locals[-len(node.generators):]
-        return ret
+        return _locate(node, ret)
 
     # ListComp(expr elt, comprehension* generators)
     visit_ListComp = visit_GeneratorExp
@@ -602,7 +800,8 @@ class TemplateASTTransformer(ASTTransformer):
             name = _new(_ast.Name, '_lookup_name', _ast.Load())
             namearg = _new(_ast.Name, '__data__', _ast.Load())
             strarg = _new(_ast.Str, node.id)
-            node = _new(_ast.Call, name, [namearg, strarg], [])
+            node = _locate(node, name, namearg, strarg,
+                           _new(_ast.Call, name, [namearg, strarg], []))
         elif isinstance(node.ctx, _ast.Store):
             if len(self.locals) > 1:
                 self.locals[-1].add(node.id)
@@ -619,9 +818,25 @@ class ExpressionASTTransformer(TemplateASTTransformer):
         if not isinstance(node.ctx, _ast.Load):
             return ASTTransformer.visit_Attribute(self, node)
 
-        func = _new(_ast.Name, '_lookup_attr', _ast.Load())
-        args = [self.visit(node.value), _new(_ast.Str, node.attr)]
-        return _new(_ast.Call, func, args, [])
+        # Chains of attribute accesses such as ``a.b.c`` are looked up using a
+        # single call
+        keys = [node.attr]
+        value = node.value
+        while isinstance(value, _ast.Attribute) and \
+                isinstance(value.ctx, _ast.Load):
+            keys.insert(0, value.attr)
+            value = value.value
+        if len(keys) == 1:
+            func = _new(_ast.Name, '_lookup_attr', _ast.Load())
+            arg = _new(_ast.Str, keys[0])
+            new = [arg]
+        else:
+            func = _new(_ast.Name, '_lookup_attrs', _ast.Load())
+            new = [_new(_ast.Str, key) for key in keys]
+            arg = _new(_ast.Tuple, new[:], _ast.Load())
+            new.append(arg)
+        new.append(_new(_ast.Call, func, [self.visit(value), arg], []))
+        return _locate(node, func, *new)
 
     def visit_Subscript(self, node):
         if not isinstance(node.ctx, _ast.Load) or \
@@ -629,8 +844,7 @@ class ExpressionASTTransformer(TemplateASTTransformer):
             return ASTTransformer.visit_Subscript(self, node)
 
         func = _new(_ast.Name, '_lookup_item', _ast.Load())
-        args = [
-            self.visit(node.value),
-            _new(_ast.Tuple, (self.visit(node.slice.value),), _ast.Load())
-        ]
-        return _new(_ast.Call, func, args, [])
+        value = self.visit(node.value)
+        key = _new(_ast.Tuple, [self.visit(node.slice.value)], _ast.Load())
+        return _locate(node, func, key,
+                       _new(_ast.Call, func, [value, key], []))
@@ -37,7 +37,8 @@ token_re = re.compile('%s|%s(?s)' % (
 ))
 
 
-def interpolate(text, filepath=None, lineno=-1, offset=0, lookup='strict'):
+def interpolate(text, filepath=None, lineno=-1, offset=0, lookup='strict',
+                keep_ast=True):
     """Parse the given string and extract expressions.
     
     This function is a generator that yields `TEXT` events for literal strings,
@@ -58,6 +59,8 @@ def interpolate(text, filepath=None, lineno=-1, offset=0, lookup='strict'):
                    (optional)
     :param lookup: the variable lookup mechanism; either "lenient" (the
                    default), "strict", or a custom lookup class
+    :param keep_ast: whether the expressions should keep their AST after
+                     compilation
     :return: a list of `TEXT` and `EXPR` events
     :raise TemplateSyntaxError: when a syntax error in an expression is
                                 encountered
@@ -75,7 +78,7 @@ def interpolate(text, filepath=None, lineno=-1, offset=0, lookup='strict'):
             if chunk:
                 try:
                     expr = Expression(chunk.strip(), pos[0], pos[1],
-                                      lookup=lookup)
+                                      lookup=lookup, keep_ast=keep_ast)
                     yield EXPR, expr, tuple(pos)
                 except SyntaxError, err:
                     raise TemplateSyntaxError(err, filepath, pos[1],
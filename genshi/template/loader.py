@@ -13,17 +13,22 @@
 
 """Template loading and caching."""
 
+from fnmatch import fnmatch
+import gc
 import os
+from Queue import Empty, Queue
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
+import time
 
-from genshi.template.base import TemplateError
+from genshi.compat import BytesIO
+from genshi.template.base import TemplateError, _compact
 from genshi.util import LRUCache
 
-__all__ = ['TemplateLoader', 'TemplateNotFound', 'directory', 'package',
-           'prefixed']
+__all__ = ['TemplateLoader', 'TemplateNotFound', 'bundle', 'directory',
+           'package', 'prefixed']
 __docformat__ = 'restructuredtext en'
 
 
@@ -78,7 +83,8 @@ class TemplateLoader(object):
     """
     def __init__(self, search_path=None, auto_reload=False,
                  default_encoding=None, max_cache_size=25, default_class=None,
-                 variable_lookup='strict', allow_exec=True, callback=None):
+                 variable_lookup='strict', allow_exec=True, callback=None,
+                 cache_dir=None, keep_ast=False):
         """Create the template laoder.
         
         :param search_path: a list of absolute path names that should be
@@ -104,9 +110,18 @@ class TemplateLoader(object):
                          is passed the template object as only argument. This
                          callback can be used for example to add any desired
                          filters to the template
-        :see: `LenientLookup`, `StrictLookup`
+        :param cache_dir: (optional) the path to a directory in which prepared
+                          templates are stored, so that they can be loaded
+                          without being parsed again, also by other processes
+        :param keep_ast: whether the expressions and code blocks of loaded
+                         templates should keep their AST after compilation; by
+                         default the AST is discarded to save memory, and
+                         parsed again from the source code when it is needed,
+                         for example for message extraction
+        :see: `LenientLookup`, `StrictLookup`, `TemplateCache`
         
         :note: Changed in 0.5: Added the `allow_exec` argument
+        :note: Changed in 0.7: Added the `cache_dir` and `keep_ast` arguments
         """
         from genshi.template.markup import MarkupTemplate
 
@@ -124,11 +139,17 @@ class TemplateLoader(object):
         self.default_class = default_class or MarkupTemplate
         self.variable_lookup = variable_lookup
         self.allow_exec = allow_exec
+        self.keep_ast = keep_ast
         if callback is not None and not hasattr(callback, '__call__'):
             raise TypeError('The "callback" parameter needs to be callable')
         self.callback = callback
         self._cache = LRUCache(max_cache_size)
         self._uptodate = {}
+        self.cache_dir = cache_dir
+        self._diskcache = None
+        if cache_dir is not None:
+            from genshi.template.cache import TemplateCache
+            self._diskcache = TemplateCache(cache_dir)
         self._lock = threading.RLock()
 
     def __getstate__(self):
@@ -173,12 +194,12 @@ class TemplateLoader(object):
         """
         if cls is None:
             cls = self.default_class
-        search_path = self.search_path
 
         # Make the filename relative to the template file its being loaded
         # from, but only if that file is specified as a relative path, or no
         # search path has been set up
-        if relative_to and (not search_path or not os.path.isabs(relative_to)):
+        if relative_to and (not self.search_path or
+                            not os.path.isabs(relative_to)):
             filename = os.path.join(os.path.dirname(relative_to), filename)
 
         filename = os.path.normpath(filename)
@@ -197,57 +218,210 @@ class TemplateLoader(object):
             except (KeyError, OSError):
                 pass
 
-            isabs = False
+            tmpl, uptodate = self._find(filename, relative_to, cls, encoding)
+            self._cache[cachekey] = tmpl
+            self._uptodate[cachekey] = uptodate
+            return tmpl
+
+        finally:
+            self._lock.release()
+
+    def _find(self, filename, relative_to, cls, encoding):
+        """Search for the template with the given normalized file name, and
+        instantiate it.
+        
+        :return: a tuple of the template and the function that checks whether
+                 it is up to date
+        :raises TemplateNotFound: if the template could not be found
+        """
+        search_path = self.search_path
+        isabs = False
 
-            if os.path.isabs(filename):
-                # Bypass the search path if the requested filename is absolute
-                search_path = [os.path.dirname(filename)]
-                isabs = True
+        if os.path.isabs(filename):
+            # Bypass the search path if the requested filename is absolute
+            search_path = [os.path.dirname(filename)]
+            isabs = True
 
-            elif relative_to and os.path.isabs(relative_to):
-                # Make sure that the directory containing the including
-                # template is on the search path
-                dirname = os.path.dirname(relative_to)
-                if dirname not in search_path:
-                    search_path = list(search_path) + [dirname]
-                isabs = True
+        elif relative_to and os.path.isabs(relative_to):
+            # Make sure that the directory containing the including
+            # template is on the search path
+            dirname = os.path.dirname(relative_to)
+            if dirname not in search_path:
+                search_path = list(search_path) + [dirname]
+            isabs = True
 
-            elif not search_path:
-                # Uh oh, don't know where to look for the template
-                raise TemplateError('Search path for templates not configured')
+        elif not search_path:
+            # Uh oh, don't know where to look for the template
+            raise TemplateError('Search path for templates not configured')
 
-            for loadfunc in search_path:
-                if isinstance(loadfunc, basestring):
-                    loadfunc = directory(loadfunc)
+        for loadfunc in search_path:
+            if isinstance(loadfunc, basestring):
+                loadfunc = directory(loadfunc)
+            try:
+                filepath, filename, fileobj, uptodate = loadfunc(filename)
+            except IOError:
+                continue
+            else:
                 try:
-                    filepath, filename, fileobj, uptodate = loadfunc(filename)
-                except IOError:
-                    continue
-                else:
-                    try:
-                        if isabs:
-                            # If the filename of either the included or the 
-                            # including template is absolute, make sure the
-                            # included template gets an absolute path, too,
-                            # so that nested includes work properly without a
-                            # search path
-                            filename = filepath
+                    if isabs:
+                        # If the filename of either the included or the 
+                        # including template is absolute, make sure the
+                        # included template gets an absolute path, too,
+                        # so that nested includes work properly without a
+                        # search path
+                        filename = filepath
+                    if hasattr(fileobj, 'prepared'):
+                        # The load function provides an already prepared
+                        # template, for example from a bundle
+                        tmpl = self._restore(fileobj.prepared(cls),
+                                             filepath, filename)
+                    elif self._diskcache is not None:
+                        tmpl = self._load_cached(cls, fileobj, filepath,
+                                                 filename, encoding)
+                    else:
                         tmpl = self._instantiate(cls, fileobj, filepath,
                                                  filename, encoding=encoding)
                         if self.callback:
                             self.callback(tmpl)
-                        self._cache[cachekey] = tmpl
-                        self._uptodate[cachekey] = uptodate
-                    finally:
-                        if hasattr(fileobj, 'close'):
-                            fileobj.close()
-                    return tmpl
+                finally:
+                    if hasattr(fileobj, 'close'):
+                        fileobj.close()
+                return tmpl, uptodate
+
+        raise TemplateNotFound(filename, search_path)
 
-            raise TemplateNotFound(filename, search_path)
+    def preload(self, patterns=None, threads=0, freeze=True):
+        """Load and prepare all the templates found in the directories on the
+        search path, so that the first request for a template does not have
+        to wait for it.
+        
+        The templates are prepared completely, including the inlining of
+        templates that they include using a static path. All templates found
+        are kept in the cache of the loader, which grows if needed. Preloading
+        the templates before the worker processes of a server are forked lets
+        the processes share the memory holding them.
+        
+        Load functions on the search path, such as those of bundles, are
+        skipped, as the templates they provide can not be listed.
+        
+        :param patterns: a list of file name patterns of the templates to load,
+                         or of ``(pattern, cls)`` tuples, where ``cls`` is the
+                         template class to use for matching files; defaults to
+                         the patterns used for bundles
+        :param threads: the number of threads to load the templates in; if `0`,
+                        the templates are loaded one after the other; only
+                        reading and parsing the template files is done in
+                        parallel, while preparing the parsed templates is not;
+                        the loader callback may be called from several threads
+                        at once
+        :param freeze: whether to run the garbage collector when done, and,
+                       where supported (Python 3.7 and later), exclude all
+                       existing objects from future collections using
+                       ``gc.freeze()``, so that the collector does not write
+                       to their memory pages
+        :return: a list of ``(filename, seconds)`` tuples with the time it took
+                 to load and prepare each template
+        :raises TemplateError: if a template can not be loaded
+        :since: version 0.7
+        """
+        if patterns is None:
+            from genshi.template.bundle import DEFAULT_PATTERNS
+            patterns = DEFAULT_PATTERNS
+
+        found = {}
+        for dirname in self.search_path:
+            if not isinstance(dirname, basestring):
+                continue
+            for dirpath, dirnames, filenames in os.walk(dirname):
+                dirnames.sort()
+                for name in filenames:
+                    filename = os.path.relpath(os.path.join(dirpath, name),
+                                               dirname)
+                    filename = os.path.normpath(filename)
+                    if filename in found:
+                        continue
+                    for pattern in patterns:
+                        cls = None
+                        if not isinstance(pattern, basestring):
+                            pattern, cls = pattern
+                        if fnmatch(name, pattern):
+                            found[filename] = cls or self.default_class
+                            break
+        filenames = sorted(found)
 
+        self._lock.acquire()
+        try:
+            self._cache.capacity = max(self._cache.capacity,
+                                       len(self._cache) + len(filenames))
         finally:
             self._lock.release()
 
+        times = {}
+        def _preload(filename):
+            start = time.time()
+            tmpl = None
+            self._lock.acquire()
+            try:
+                if filename in self._cache:
+                    tmpl = self._cache[filename]
+            finally:
+                self._lock.release()
+            if tmpl is None:
+                # The template is instantiated without holding the lock, so
+                # that other threads can load templates in the meantime
+                tmpl, uptodate = self._find(filename, None, found[filename],
+                                            None)
+                self._lock.acquire()
+                try:
+                    if filename in self._cache:
+                        tmpl = self._cache[filename]
+                    else:
+                        self._cache[filename] = tmpl
+                        self._uptodate[filename] = uptodate
+                finally:
+                    self._lock.release()
+            # Preparing a template is not thread-safe, and also prepares the
+            # templates it includes, which may be shared with other templates
+            self._lock.acquire()
+            try:
+                tmpl.stream
+                tmpl._prepare_static()
+            finally:
+                self._lock.release()
+            times[filename] = time.time() - start
+
+        if threads:
+            queue = Queue()
+            for filename in filenames:
+                queue.put(filename)
+            errors = []
+            def _run():
+                while not errors:
+                    try:
+                        filename = queue.get_nowait()
+                    except Empty:
+                        break
+                    try:
+                        _preload(filename)
+                    except Exception, e:
+                        errors.append(e)
+            workers = [threading.Thread(target=_run) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if errors:
+                raise errors[0]
+        else:
+            for filename in filenames:
+                _preload(filename)
+
+        if freeze:
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+        return [(filename, times[filename]) for filename in filenames]
+
     def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
         """Instantiate and return the `Template` object based on the given
         class and parameters.
@@ -271,7 +445,71 @@ class TemplateLoader(object):
             encoding = self.default_encoding
         return cls(fileobj, filepath=filepath, filename=filename, loader=self,
                    encoding=encoding, lookup=self.variable_lookup,
-                   allow_exec=self.allow_exec)
+                   allow_exec=self.allow_exec, keep_ast=self.keep_ast)
+
+    def _load_cached(self, cls, fileobj, filepath, filename, encoding=None):
+        """Instantiate a template using the on-disk cache, parsing the
+        template source only if no valid cache entry exists.
+        
+        The template is prepared by this method, so any custom directives
+        need to be added by the loader callback.
+        """
+        lookup = self.variable_lookup
+        if isinstance(lookup, type):
+            lookup = '%s.%s' % (lookup.__module__, lookup.__name__)
+        key = ('%s.%s' % (cls.__module__, cls.__name__), filepath, filename,
+               encoding or self.default_encoding, lookup, self.allow_exec)
+        source = fileobj.read()
+        mtime = None
+        if os.path.isfile(filepath):
+            mtime = os.path.getmtime(filepath)
+
+        entry = self._diskcache.get(key, source, mtime)
+        if entry is not None:
+            state, stream = entry
+            return self._restore((cls, state, stream), filepath, filename)
+
+        tmpl = self._instantiate(cls, BytesIO(source), filepath, filename,
+                                 encoding=encoding)
+        if self.callback:
+            self.callback(tmpl)
+        stream = list(tmpl._prepare(tmpl._stream, inlined=False))
+        self._diskcache.set(key, source, tmpl, stream, mtime)
+
+        # Includes are inlined only now, so that cache entries never contain
+        # other templates
+        tmpl._stream = _compact(tmpl._inline(stream))
+        tmpl._prepared = True
+        return tmpl
+
+    def _restore(self, prepared, filepath, filename):
+        """Create a `Template` object from a template that was prepared
+        earlier, without parsing it.
+        
+        :param prepared: a ``(cls, state, stream)`` tuple of the template class,
+                         the dictionary of template attributes, and the
+                         prepared stream, with included templates not inlined
+        :param filepath: the absolute path to the template file
+        :param filename: the path to the template file relative to the search
+                         path
+        :return: the loaded `Template` instance
+        """
+        cls, state, stream = prepared
+        tmpl = cls.__new__(cls)
+        tmpl.__dict__.update(state)
+        tmpl.filepath = filepath
+        tmpl.filename = filename
+        tmpl.loader = self
+        tmpl._init_filters()
+        # The callback may add directives, which requires an unprepared
+        # template; the stream already has them attached, though
+        tmpl._stream = []
+        tmpl._prepared = False
+        if self.callback:
+            self.callback(tmpl)
+        tmpl._stream = _compact(tmpl._inline(stream))
+        tmpl._prepared = True
+        return tmpl
 
     @staticmethod
     def directory(path):
@@ -305,6 +543,27 @@ class TemplateLoader(object):
             return filepath, filename, resource_stream(name, filepath), None
         return _load_from_package
 
+    @staticmethod
+    def bundle(path):
+        """Loader factory for loading prepared templates from a bundle file.
+        
+        The bundle is mapped into memory when this function is called, and
+        each template is only deserialized when it is requested. Bundles are
+        created using the `genshi.template.bundle` module, which can also be
+        run as a script.
+        
+        :param path: the path to the bundle file
+        :return: the loader function to load templates from the given bundle
+        :rtype: ``function``
+        :since: version 0.7
+        """
+        from genshi.template.bundle import TemplateBundle
+        bundle = TemplateBundle(path)
+        def _load_from_bundle(filename):
+            entry = bundle.get(filename)
+            return entry.filepath, filename, entry, None
+        return _load_from_bundle
+
     @staticmethod
     def prefixed(**delegates):
         """Factory for a load function that delegates to other loaders
@@ -339,6 +598,7 @@ class TemplateLoader(object):
         return _dispatch_by_prefix
 
 
+bundle = TemplateLoader.bundle
 directory = TemplateLoader.directory
 package = TemplateLoader.package
 prefixed = TemplateLoader.prefixed
@@ -16,11 +16,13 @@
 from itertools import chain
 
 from genshi.core import Attrs, Markup, Namespace, Stream, StreamEventKind
-from genshi.core import START, END, START_NS, END_NS, TEXT, PI, COMMENT
+from genshi.core import START, END, START_NS, END_NS, TEXT, PI, COMMENT, \
+                        AWAIT, FLUSH
 from genshi.input import XMLParser
+from genshi.output import STATIC
 from genshi.template.base import BadDirectiveError, Template, \
-                                 TemplateSyntaxError, _apply_directives, \
-                                 EXEC, INCLUDE, SUB
+                                 TemplateStream, TemplateSyntaxError, \
+                                 _apply_directives, EXEC, INCLUDE, SUB
 from genshi.template.eval import Suite
 from genshi.template.interpolation import interpolate
 from genshi.template.directives import *
@@ -53,6 +55,7 @@ class MarkupTemplate(Template):
                   ('if', IfDirective),
                   ('choose', ChooseDirective),
                   ('with', WithDirective),
+                  ('flush', FlushDirective),
                   ('replace', ReplaceDirective),
                   ('content', ContentDirective),
                   ('attrs', AttrsDirective),
@@ -61,10 +64,11 @@ class MarkupTemplate(Template):
     _number_conv = Markup
 
     def __init__(self, source, filepath=None, filename=None, loader=None,
-                 encoding=None, lookup='strict', allow_exec=True):
+                 encoding=None, lookup='strict', allow_exec=True,
+                 keep_ast=True):
         Template.__init__(self, source, filepath=filepath, filename=filename,
                           loader=loader, encoding=encoding, lookup=lookup,
-                          allow_exec=allow_exec)
+                          allow_exec=allow_exec, keep_ast=keep_ast)
         self.add_directives(self.DIRECTIVE_NAMESPACE, self)
 
     def _init_filters(self):
@@ -83,7 +87,8 @@ class MarkupTemplate(Template):
 
             if kind is TEXT:
                 for kind, data, pos in interpolate(data, self.filepath, pos[1],
-                                                   pos[2], lookup=self.lookup):
+                                                   pos[2], lookup=self.lookup,
+                                                   keep_ast=self.keep_ast):
                     stream.append((kind, data, pos))
 
             elif kind is PI and data[0] == 'python':
@@ -92,7 +97,7 @@ class MarkupTemplate(Template):
                                               self.filepath, *pos[1:])
                 try:
                     suite = Suite(data[1], self.filepath, pos[1],
-                                  lookup=self.lookup)
+                                  lookup=self.lookup, keep_ast=self.keep_ast)
                 except SyntaxError, err:
                     raise TemplateSyntaxError(err, self.filepath,
                                               pos[1] + (err.lineno or 1) - 1,
@@ -275,7 +280,8 @@ class MarkupTemplate(Template):
                 for name, value in attrs:
                     if value:
                         value = list(interpolate(value, self.filepath, pos[1],
-                                                 pos[2], lookup=self.lookup))
+                                                 pos[2], lookup=self.lookup,
+                                                 keep_ast=self.keep_ast))
                         if len(value) == 1 and value[0][0] is TEXT:
                             value = value[0][1]
                     new_attrs.append((name, value))
@@ -283,9 +289,9 @@ class MarkupTemplate(Template):
 
             yield kind, data, pos
 
-    def _prepare(self, stream):
+    def _prepare(self, stream, inlined=True):
         return Template._prepare(self,
-            self._extract_includes(self._interpolate_attrs(stream))
+            self._extract_includes(self._interpolate_attrs(stream)), inlined
         )
 
     def add_directives(self, namespace, factory):
@@ -307,6 +313,34 @@ class MarkupTemplate(Template):
         to the stream.
         """
         match_templates = ctxt._match_templates
+        match_index = ctxt._match_index
+
+        def _candidates(event):
+            # Return the indices of the match templates that need to test the
+            # event: templates that only match elements with specific names
+            # are only interested in start events of those elements
+            if event[0] is START:
+                name = event[1][0].localname
+            else:
+                name = None
+            if match_index[0] != len(match_templates):
+                match_index[0] = len(match_templates)
+                match_index[1].clear()
+            candidates = match_index[1].get(name)
+            if candidates is None:
+                candidates = match_index[1][name] = [
+                    idx for idx, match_template in enumerate(match_templates)
+                    if match_template is not None and
+                    (match_template[6] is None or name in match_template[6])
+                ]
+            return candidates
+
+        def _defer_flushes(stream, append):
+            for event in stream:
+                if event[0] is FLUSH:
+                    append(event)
+                else:
+                    yield event
 
         def _strip(stream, append):
             depth = 1
@@ -327,30 +361,43 @@ class MarkupTemplate(Template):
 
             # We (currently) only care about start and end events for matching
             # We might care about namespace events in the future, though
-            if not match_templates or (event[0] is not START and
-                                       event[0] is not END):
+            active = len(match_templates) > match_index[2]
+            if not active or (event[0] is not START and event[0] is not END):
+                if event[0] is STATIC and active:
+                    # Match templates may apply to elements inside a static
+                    # chunk, so its events need to be processed individually
+                    for event in self._match(iter(event[1].events), ctxt,
+                                             start=start, end=end, **vars):
+                        yield event
+                    continue
                 yield event
                 continue
 
-            for idx, (test, path, template, hints, namespaces, directives) \
-                    in enumerate(match_templates):
+            for idx in _candidates(event):
                 if idx < start or end is not None and idx >= end:
                     continue
 
+                test, path, template, hints, namespaces, directives, names = \
+                        match_templates[idx]
                 if test(event, namespaces, ctxt) is True:
                     if 'match_once' in hints:
-                        del match_templates[idx]
-                        idx -= 1
+                        # Replace the template instead of removing it, so that
+                        # the ranges of templates applied by the enclosing
+                        # filters still refer to the same templates
+                        match_templates[idx] = None
+                        match_index[0] = -1
+                        match_index[2] += 1
 
                     # Let the remaining match templates know about the event so
                     # they get a chance to update their internal state
-                    for test in [mt[0] for mt in match_templates[idx + 1:]]:
+                    for test in [mt[0] for mt in match_templates[idx + 1:]
+                                 if mt is not None]:
                         test(event, namespaces, ctxt, updateonly=True)
 
                     # Consume and store all events until an end event
                     # corresponding to this start event is encountered
                     pre_end = idx + 1
-                    if 'match_once' not in hints and 'not_recursive' in hints:
+                    if 'match_once' in hints or 'not_recursive' in hints:
                         pre_end -= 1
                     tail = []
                     inner = _strip(stream, tail.append)
@@ -358,9 +405,26 @@ class MarkupTemplate(Template):
                         inner = self._match(inner, ctxt, start=start,
                                             end=pre_end, **vars)
                     content = self._include(chain([event], inner, tail), ctxt)
-                    if 'not_buffered' not in hints:
+                    # A flush in the matched content would output part of the
+                    # match template early, or get lost when the content is
+                    # selected, so flushes are deferred until the match
+                    # template is done
+                    flushes = []
+                    content = _defer_flushes(content, flushes.append)
+                    if ctxt._async:
+                        # Awaitables in the matched content are passed on to
+                        # the renderer while the content is buffered, as the
+                        # match template can not await them itself
+                        buffered = []
+                        for event in content:
+                            if event[0] is AWAIT:
+                                yield event
+                            else:
+                                buffered.append(event)
+                        content = buffered
+                    elif 'not_buffered' not in hints:
                         content = list(content)
-                    content = Stream(content)
+                    content = TemplateStream(content)
 
                     # Make the select() function available in the body of the
                     # match template
@@ -389,9 +453,12 @@ class MarkupTemplate(Template):
                     # templates know about the last event in the
                     # matched content, so they can update their
                     # internal state accordingly
-                    for test in [mt[0] for mt in match_templates[idx:]]:
+                    for test in [mt[0] for mt in match_templates[idx:]
+                                 if mt is not None]:
                         test(tail[0], namespaces, ctxt, updateonly=True)
 
+                    if flushes:
+                        yield flushes[-1]
                     break
 
             else: # no matches
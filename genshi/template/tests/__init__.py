@@ -15,10 +15,17 @@ import doctest
 import unittest
 
 def suite():
-    from genshi.template.tests import base, directives, eval, interpolation, \
-                                      loader, markup, plugin, text
+    from genshi.template.tests import base, batch, bundle, cache, compact, \
+                                      compiler, directives, eval, \
+                                      interpolation, loader, markup, plugin, \
+                                      text
     suite = unittest.TestSuite()
     suite.addTest(base.suite())
+    suite.addTest(batch.suite())
+    suite.addTest(bundle.suite())
+    suite.addTest(cache.suite())
+    suite.addTest(compact.suite())
+    suite.addTest(compiler.suite())
     suite.addTest(directives.suite())
     suite.addTest(eval.suite())
     suite.addTest(interpolation.suite())
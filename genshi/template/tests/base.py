@@ -14,7 +14,17 @@
 import doctest
 import unittest
 
-from genshi.template.base import Template, Context
+try:
+    from genshi._speedups import flatten
+except ImportError:
+    flatten = None
+from genshi.compat import StopAsyncIteration
+from genshi.core import Markup
+from genshi.template import base
+from genshi.template.base import Template, Context, TemplateRuntimeError, \
+                                 _eval_expr, _exec_suite
+from genshi.template.eval import Expression, Suite
+from genshi.template.markup import MarkupTemplate
 
 
 class ContextTestCase(unittest.TestCase):
@@ -30,12 +40,311 @@ class ContextTestCase(unittest.TestCase):
         self.assertEqual(repr(orig_ctxt), repr(ctxt))
         self.assertEqual(orig_ctxt._match_templates, ctxt._match_templates)
         self.assertEqual(orig_ctxt._choice_stack, ctxt._choice_stack)
+        ctxt['d'] = 8
+        ctxt.pop()
+        self.assertEqual(7, orig_ctxt['c'])
+        self.assertEqual(None, ctxt.get('c'))
+        self.assertFalse('d' in orig_ctxt)
+
+    def test_push_pop(self):
+        ctxt = Context(a=1, b=2)
+        frame = {'a': 3, 'c': 4}
+        ctxt.push(frame)
+        self.assertEqual((3, 2, 4), (ctxt['a'], ctxt['b'], ctxt['c']))
+        self.assertEqual(frame, ctxt.frames[0])
+        self.assertTrue(ctxt.pop() is frame)
+        self.assertEqual((1, 2), (ctxt['a'], ctxt['b']))
+        self.assertFalse('c' in ctxt)
+        self.assertRaises(KeyError, ctxt.__getitem__, 'c')
+
+    def test_get(self):
+        ctxt = Context(a=1)
+        ctxt.push({'b': 2})
+        self.assertEqual(1, Context.get(ctxt, 'a'))
+        self.assertEqual(2, Context.get(ctxt, 'b'))
+        self.assertEqual(3, Context.get(ctxt, 'c', 3))
+
+    def test_get_overridden(self):
+        class UpperContext(Context):
+            def get(self, key, default=None):
+                return Context.get(self, key.lower(), default)
+        ctxt = UpperContext(a=1)
+        self.assertEqual(1, ctxt.get('A'))
+        self.assertEqual(None, ctxt.get('B'))
+
+    def test_set_in_scope(self):
+        ctxt = Context(a=1)
+        ctxt.push({})
+        ctxt['a'] = 2
+        ctxt['b'] = 3
+        ctxt.update([('a', 4), ('c', 5)])
+        self.assertEqual({'a': 4, 'b': 3, 'c': 5}, ctxt.pop())
+        self.assertEqual(1, ctxt['a'])
+        self.assertFalse('b' in ctxt or 'c' in ctxt)
+
+    def test_del(self):
+        ctxt = Context(a=1)
+        ctxt.push({'a': 2})
+        del ctxt['a']
+        self.assertFalse('a' in ctxt)
+        ctxt['a'] = 3
+        ctxt.pop()
+        self.assertFalse('a' in ctxt)
+
+    def test_set_global(self):
+        ctxt = Context(a=1)
+        ctxt.push({'a': 2})
+        ctxt.push({'b': 3})
+        ctxt._set_global('a', 4)
+        ctxt._set_global('c', 5)
+        self.assertEqual((2, 5), (ctxt['a'], ctxt['c']))
+        ctxt.pop()
+        ctxt.pop()
+        self.assertEqual((4, 5), (ctxt['a'], ctxt['c']))
+        self.assertEqual(4, ctxt.frames[-1]['a'])
+
+    def test_keys_and_len(self):
+        ctxt = Context(a=1, b=2)
+        ctxt.push({'b': 3, 'c': 4})
+        self.assertEqual(['b', 'c'], sorted(ctxt.frames[0]))
+        self.assertEqual(['a', 'b', 'c', 'defined', 'value_of'],
+                         sorted(ctxt.keys()))
+        self.assertEqual(5, len(ctxt))
+        self.assertEqual(3, dict(ctxt.items())['b'])
+
+    def test_eval_with_vars(self):
+        ctxt = Context(a=1, b=2, depth=lambda: len(ctxt.frames))
+        expr = Expression('(a, b, depth(), defined("b"), value_of("b"))')
+        self.assertEqual((1, 3, 1, 1, 3), _eval_expr(expr, ctxt, {'b': 3}))
+        self.assertEqual((1, 2, 1, 1, 2), _eval_expr(expr, ctxt))
+
+    def test_exec_with_vars(self):
+        ctxt = Context(a=1)
+        ctxt.push({})
+        _exec_suite(Suite('c = a + b'), ctxt, {'b': 2})
+        self.assertEqual({'c': 3}, ctxt.pop())
+        self.assertFalse('b' in ctxt)
+
+    def test_globals_reused(self):
+        ctxt = Context(a=1)
+        Expression('a').evaluate(ctxt)
+        Suite('b = a').execute(ctxt)
+        self.assertEqual(1, len(ctxt._globals))
+        Expression('a', lookup='lenient').evaluate(ctxt)
+        self.assertEqual(2, len(ctxt._globals))
+
+
+class SpeedupsFlattenTestCase(unittest.TestCase):
+    """Compares the events produced by the C and pure-Python implementations
+    of `Template._flatten`.
+    """
+
+    def _assert_same_events(self, text, **data):
+        tmpl = MarkupTemplate(text)
+        vars = {'v': u'var'}
+        saved = base._speedups_flatten
+        try:
+            base._speedups_flatten = None
+            expected = list(tmpl._flatten(tmpl.stream, Context(**data),
+                                          **vars))
+        finally:
+            base._speedups_flatten = saved
+        actual = list(flatten(tmpl.stream, Context(**data), vars,
+                              tmpl._number_conv))
+        self.assertEqual(expected, actual)
+        self.assertEqual([type(event[1]) for event in expected],
+                         [type(event[1]) for event in actual])
+
+    def test_expressions(self):
+        class Obj(object):
+            def __unicode__(self):
+                return u'obj'
+            __str__ = __unicode__
+        self._assert_same_events("""<p>
+          ${none}${string}${bytes}${markup}${num}${big}${flt}${flag}${obj}
+          ${items}${(x * 2 for x in items)}${v}
+        </p>""", none=None, string=u'<b>', bytes='b', markup=Markup('<b/>'),
+            num=1, big=10 ** 20, flt=.5, flag=True, obj=Obj(),
+            items=[1, 'a'])
+
+    def test_attributes(self):
+        self._assert_same_events("""<p xmlns:py="http://genshi.edgewall.org/"
+             class="${cls}" title="a ${none} b" id="${none}" lang="en"
+             data-v="$v" py:attrs="attrs"><br class="${cls}x"/></p>""",
+            cls='c', none=None, attrs={'dir': 'ltr', 'lang': None})
+
+    def test_directives(self):
+        self._assert_same_events("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <?python total = 0 ?>
+          <li py:for="idx, item in enumerate(items)" py:if="item"
+              py:with="total = total + idx">${idx}: ${item} ${total} $v</li>
+          <py:choose test="len(items)">
+            <py:when test="3">three</py:when>
+            <py:otherwise>other</py:otherwise>
+          </py:choose>
+        </ul>""", items=['a', '', 'c'])
+
+    def test_errors(self):
+        tmpl = MarkupTemplate('<p>${1 / zero}</p>')
+        self.assertRaises(ZeroDivisionError, list,
+                          tmpl._flatten_events(tmpl.stream, Context(zero=0),
+                                               {}))
+        self.assertRaises(ZeroDivisionError, list,
+                          flatten(tmpl.stream, Context(zero=0), {},
+                                  tmpl._number_conv))
+
+
+class _Value(object):
+    """Awaitable that suspends once before producing a value, or raising an
+    exception."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __await__(self):
+        return _ValueIterator(self.value)
+
+
+class _ValueIterator(object):
+
+    def __init__(self, value):
+        self.value = value
+        self.suspended = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.send(None)
+
+    def send(self, value):
+        if not self.suspended:
+            self.suspended = True
+            return 'suspended'
+        if isinstance(self.value, Exception):
+            raise self.value
+        raise StopIteration(self.value)
+
+    def throw(self, error):
+        raise error
+
+
+class _Items(object):
+    """Asynchronous iterable over the given items."""
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if not self.items:
+            return _Value(StopAsyncIteration())
+        return _Value(self.items.pop(0))
+
+
+class _Writer(object):
+
+    def __init__(self, awaitable=False):
+        self.awaitable = awaitable
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+        if self.awaitable:
+            return _Value(None)
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    def _render(self, stream, **kwargs):
+        # Run the rendering like an event loop would, and return what the
+        # renderer suspended for along with the chunks written
+        out = kwargs.pop('out', None) or _Writer()
+        steps = []
+        iterator = stream.render_async(out, **kwargs).__await__()
+        for step in iterator:
+            steps.append(step)
+        return steps, out.data
+
+    def test_await_expression(self):
+        tmpl = MarkupTemplate('<p>${title}: ${count}</p>')
+        steps, data = self._render(tmpl.generate_async(title=_Value('Foo'),
+                                                       count=_Value(0)))
+        self.assertEqual(['suspended', 'suspended', None], steps)
+        self.assertEqual(['<p>Foo: 0</p>'], data)
+
+    def test_await_error(self):
+        tmpl = MarkupTemplate('<p>${title}</p>')
+        stream = tmpl.generate_async(title=_Value(KeyError('title')))
+        self.assertRaises(KeyError, self._render, stream)
+
+    def test_await_in_attribute(self):
+        tmpl = MarkupTemplate('<p title="${title}"/>')
+        stream = tmpl.generate_async(title=_Value('Foo'))
+        self.assertRaises(TemplateRuntimeError, self._render, stream)
+
+    def test_render_without_awaiting(self):
+        tmpl = MarkupTemplate('<p>${title}</p>')
+        stream = tmpl.generate_async(title=_Value('Foo'))
+        self.assertRaises(TemplateRuntimeError, stream.render)
+
+    def test_for_async_iterable(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx, item in items">$idx: $item</li>
+        </ul>""")
+        items = _Items([(1, 'a'), (2, 'b')])
+        steps, data = self._render(tmpl.generate_async(items=items),
+                                   encoding=None)
+        self.assertEqual(['suspended'] * 3 + [None], steps)
+        self.assertEqual(["""<ul>
+          <li>1: a</li><li>2: b</li>
+        </ul>"""], data)
+
+    def test_for_iterable(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in iter(items)">$item</li>
+        </ul>""")
+        steps, data = self._render(tmpl.generate_async(items=['a', 'b']))
+        self.assertEqual([None], steps)
+        self.assertEqual(["""<ul>
+          <li>a</li><li>b</li>
+        </ul>"""], data)
+
+    def test_match_template(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="li" once="true"><li class="item">${
+            select('text()')
+          }</li></py:match><li py:for="item in items">$item</li>
+        </ul>""")
+        steps, data = self._render(tmpl.generate_async(items=_Items('ab')))
+        self.assertEqual(["""<ul>
+          <li class="item">a</li><li>b</li>
+        </ul>"""], data)
+
+    def test_chunks(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items">$item</li>
+        </ul>""")
+        steps, data = self._render(tmpl.generate_async(items=_Items('abc')),
+                                   out=_Writer(awaitable=True), chunk_size=10)
+        self.assertEqual(['<ul>\n          ', '<li>a</li>', '<li>b</li>',
+                          '<li>c</li>', '\n        </ul>'], data)
+        # Every write is awaited, followed by a suspension without a future
+        # that lets other tasks run; the other suspensions are for getting the
+        # next item of the loop
+        self.assertEqual(['suspended', None] +
+                         ['suspended', 'suspended', None] * 4, steps)
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite(Template.__module__))
     suite.addTest(unittest.makeSuite(ContextTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(AsyncTestCase, 'test'))
+    if flatten is not None:
+        suite.addTest(unittest.makeSuite(SpeedupsFlattenTestCase, 'test'))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import shutil
+import tempfile
+import unittest
+
+from genshi.template import batch
+from genshi.template.batch import BatchError, render_batch
+from genshi.template.loader import TemplateLoader
+
+
+class RenderBatchTestCase(unittest.TestCase):
+    """Tests for rendering batches of jobs in worker processes."""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self._write('item.html', '<li>$item</li>')
+        self._write('para.html', '<p title="$item">$item</p>')
+        self.loader = TemplateLoader([self.dirname])
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, source):
+        fileobj = open(os.path.join(self.dirname, filename), 'w')
+        try:
+            fileobj.write(source)
+        finally:
+            fileobj.close()
+
+    def _jobs(self, count):
+        for idx in range(count):
+            yield ('item.html', 'para.html')[idx % 2], dict(item=idx)
+
+    def test_ordered(self):
+        expected = [self.loader.load(name).generate(**data)
+                    .render(encoding='utf-8') for name, data in self._jobs(100)]
+        for chunk_size in (1, 7, 100):
+            self.assertEqual(expected,
+                             list(render_batch(self.loader, self._jobs(100),
+                                               processes=2,
+                                               chunk_size=chunk_size)))
+
+    def test_unordered(self):
+        expected = [self.loader.load(name).generate(**data).render('html')
+                    for name, data in self._jobs(50)]
+        results = list(render_batch(self.loader, self._jobs(50), 'html',
+                                    encoding=None, processes=2,
+                                    ordered=False, chunk_size=4))
+        self.assertEqual(expected,
+                         [output for index, output in sorted(results)])
+
+    def test_empty(self):
+        self.assertEqual([], list(render_batch(self.loader, [], processes=2)))
+
+    def test_error(self):
+        jobs = list(self._jobs(10))
+        jobs[5] = ('missing.html', {})
+        results = []
+        try:
+            for output in render_batch(self.loader, jobs, processes=2,
+                                       chunk_size=2):
+                results.append(output)
+            self.fail('Expected BatchError')
+        except BatchError, e:
+            self.assertEqual(5, e.index)
+            self.assertEqual('missing.html', e.name)
+            self.assertTrue('TemplateNotFound' in e.details)
+        # The output of the jobs before the failed one is produced first
+        self.assertEqual(5, len(results))
+
+    def test_unpicklable_data(self):
+        for ordered in (True, False):
+            jobs = list(self._jobs(10))
+            jobs[4] = ('item.html', dict(item=lambda: None))
+            try:
+                list(render_batch(self.loader, jobs, processes=2,
+                                  ordered=ordered, chunk_size=2))
+                self.fail('Expected BatchError')
+            except BatchError, e:
+                self.assertEqual(4, e.index)
+                self.assertEqual('item.html', e.name)
+
+    def test_preload_error(self):
+        iterator = render_batch(self.loader, self._jobs(10), processes=2,
+                                preload=['item.html', 'missing.html'])
+        self.assertRaises(BatchError, list, iterator)
+
+    def test_stop(self):
+        iterator = render_batch(self.loader, self._jobs(1000), processes=2,
+                                chunk_size=10)
+        self.assertEqual(u'<li>0</li>'.encode('utf-8'), next(iterator))
+        iterator.close()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(batch))
+    suite.addTest(unittest.makeSuite(RenderBatchTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
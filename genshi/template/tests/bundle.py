@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from genshi.compat import StringIO
+from genshi.filters.i18n import Translator
+from genshi.template import bundle
+from genshi.template.base import TemplateError
+from genshi.template.bundle import TemplateBundle, main, write_bundle
+from genshi.template.loader import TemplateLoader, TemplateNotFound
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+
+class TemplateBundleTestCase(unittest.TestCase):
+    """Tests for loading templates from bundles."""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self.path = os.path.join(self.dirname, 'templates.bundle')
+        self.tmpldir = os.path.join(self.dirname, 'templates')
+        os.makedirs(os.path.join(self.tmpldir, 'sub'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, source, dirname=None):
+        fileobj = open(os.path.join(dirname or self.tmpldir, filename), 'w')
+        try:
+            fileobj.write(source)
+        finally:
+            fileobj.close()
+
+    def _assert_same(self, filename, **data):
+        expected = TemplateLoader([self.tmpldir]).load(filename) \
+                                  .generate(**data).render(encoding=None)
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        tmpl = loader.load(filename)
+        self.assertEqual(expected, tmpl.generate(**data).render(encoding=None))
+        return tmpl
+
+    def test_load(self):
+        self._write('index.html', """<div xmlns:py="http://genshi.edgewall.org/">
+          <b py:for="x in items" py:if="x">$x</b>
+          <py:match path="b"><i>${select('text()')}</i></py:match>
+        </div>""")
+        self.assertEqual(['index.html'], write_bundle(self.path, self.tmpldir))
+        tmpl = self._assert_same('index.html', items=[0, 1, 2])
+        self.assertTrue(isinstance(tmpl, MarkupTemplate))
+        self.assertEqual(os.path.join(self.path, 'index.html'), tmpl.filepath)
+
+    def test_include_relative(self):
+        self._write('layout.html', '<div>$x</div>')
+        self._write('sub/a.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="b.html" /><xi:include href="../layout.html" />
+        </html>""")
+        self._write('sub/b.html', '<p>$x</p>')
+        self.assertEqual(['layout.html', 'sub/a.html', 'sub/b.html'],
+                         write_bundle(self.path, self.tmpldir))
+        self._assert_same('sub/a.html', x=1)
+
+    def test_search_path_order(self):
+        otherdir = os.path.join(self.dirname, 'other')
+        os.makedirs(otherdir)
+        self._write('index.html', '<p>first</p>')
+        self._write('index.html', '<p>second</p>', otherdir)
+        self._write('other.html', '<p>other</p>', otherdir)
+        write_bundle(self.path, [self.tmpldir, otherdir])
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        self.assertEqual('<p>first</p>', loader.load('index.html')
+                                               .generate().render(encoding=None))
+        self.assertEqual('<p>other</p>', loader.load('other.html')
+                                               .generate().render(encoding=None))
+
+    def test_not_in_bundle(self):
+        self._write('index.html', '<p>$x</p>')
+        write_bundle(self.path, self.tmpldir)
+        self._write('new.html', '<p>new</p>')
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        self.assertRaises(TemplateNotFound, loader.load, 'new.html')
+        loader = TemplateLoader([TemplateLoader.bundle(self.path),
+                                 self.tmpldir])
+        self.assertEqual('<p>new</p>', loader.load('new.html')
+                                             .generate().render(encoding=None))
+
+    def test_patterns(self):
+        self._write('index.html', '<p>$x</p>')
+        self._write('mail.txt', '{% for x in items %}* $x\n{% end %}')
+        self._write('notes.rst', 'not a template')
+        self.assertEqual(['index.html', 'mail.txt'],
+                         write_bundle(self.path, self.tmpldir))
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        tmpl = loader.load('mail.txt', cls=NewTextTemplate)
+        self.assertEqual('* 1\n* 2\n',
+                         tmpl.generate(items=[1, 2]).render(encoding=None))
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        self.assertRaises(TemplateError, loader.load, 'mail.txt')
+
+        write_bundle(self.path, self.tmpldir, patterns=[('*.rst',
+                                                         NewTextTemplate)])
+        self.assertEqual(1, len(TemplateBundle(self.path)))
+
+    def test_callback(self):
+        self._write('index.html', """<p xmlns:i18n="http://genshi.edgewall.org/i18n"
+          i18n:msg="name">Hello, ${name}!</p>""")
+        def _setup(tmpl):
+            Translator(lambda s: s.upper()).setup(tmpl)
+        write_bundle(self.path, self.tmpldir, callback=_setup)
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)],
+                                callback=_setup)
+        tmpl = loader.load('index.html')
+        self.assertEqual('<p>HELLO, %(NAME)S!</p>',
+                         tmpl.generate(name='x').render(encoding=None))
+
+    def test_invalid_bundle(self):
+        self._write('index.html', '<p>$x</p>')
+        self.assertRaises(TemplateError, TemplateBundle,
+                          os.path.join(self.tmpldir, 'index.html'))
+
+    def test_main(self):
+        self._write('index.html', '<p>$x</p>')
+        self._write('mail.txt', '$x')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEqual(0, main(['-t', '*.txt', self.path, self.tmpldir]))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('mail.txt\n', output)
+        loader = TemplateLoader([TemplateLoader.bundle(self.path)])
+        tmpl = loader.load('mail.txt', cls=NewTextTemplate)
+        self.assertEqual('1', tmpl.generate(x=1).render(encoding=None))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(bundle))
+    suite.addTest(unittest.makeSuite(TemplateBundleTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import shutil
+import tempfile
+import unittest
+
+from genshi.filters.i18n import Translator
+from genshi.template import cache
+from genshi.template.cache import TemplateCache
+from genshi.template.eval import LenientLookup
+from genshi.template.loader import TemplateLoader
+from genshi.template.text import NewTextTemplate
+
+
+class TemplateCacheTestCase(unittest.TestCase):
+    """Tests for loading templates through the on-disk cache."""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(suffix='genshi_test')
+        self.cachedir = os.path.join(self.dirname, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, filename, source):
+        fileobj = open(os.path.join(self.dirname, filename), 'w')
+        try:
+            fileobj.write(source)
+        finally:
+            fileobj.close()
+
+    def _load(self, filename='tmpl.html', **kwargs):
+        loader = TemplateLoader([self.dirname], cache_dir=self.cachedir,
+                                **kwargs)
+        return loader.load(filename)
+
+    def _entries(self):
+        return [name for name in os.listdir(self.cachedir)
+                if name.endswith('.cache')]
+
+    def _assert_cached(self, tmpl):
+        # Expressions loaded from the cache have no AST, it is only parsed
+        # again from the source when needed
+        def _exprs(stream):
+            for kind, data, pos in stream:
+                if kind is tmpl.EXPR:
+                    yield data
+                elif kind is tmpl.SUB:
+                    for expr in _exprs(data[1]):
+                        yield expr
+        exprs = list(_exprs(tmpl.stream))
+        self.assertTrue(exprs)
+        for expr in exprs:
+            self.assertEqual(None, expr._ast)
+            self.assertNotEqual(None, expr.ast)
+
+    def test_load_from_cache(self):
+        self._write('tmpl.html', """<div xmlns:py="http://genshi.edgewall.org/">
+          <?python y = x * 2 ?>
+          <py:match path="p" once="true"><em>${select('text()')}</em></py:match>
+          <py:def function="echo(a, b=1)">[$a $b]</py:def>
+          <b py:for="idx, (a, b) in enumerate(items)" py:if="a">$idx $a $b</b>
+          <p py:with="z = y + 1; w = z">$z $w ${echo(x)}</p>
+          <py:choose test="x"><i py:when="1">one</i><i py:otherwise="">?</i>
+          </py:choose>
+          <span py:attrs="{'class': 'c'}" title="$x" py:content="x" />
+          <py:strip>${Markup('&lt;')}</py:strip>
+        </div>""")
+        expected = self._load().generate(x=1, items=[(1, 2), (0, 3)]) \
+                               .render(encoding=None)
+        self.assertEqual(1, len(self._entries()))
+
+        tmpl = self._load()
+        self._assert_cached(tmpl)
+        self.assertEqual(expected, tmpl.generate(x=1, items=[(1, 2), (0, 3)])
+                                       .render(encoding=None))
+
+    def test_source_changed(self):
+        self._write('tmpl.html', '<p>$x</p>')
+        self._load()
+        self._write('tmpl.html', '<p>[$x]</p>')
+        tmpl = self._load()
+        self.assertEqual('<p>[1]</p>', tmpl.generate(x=1).render(encoding=None))
+        self.assertEqual(1, len(self._entries()))
+        self._assert_cached(self._load())
+
+    def test_source_changed_same_mtime(self):
+        self._write('tmpl.html', '<p>$x</p>')
+        self._load()
+        filepath = os.path.join(self.dirname, 'tmpl.html')
+        mtime = os.path.getmtime(filepath)
+        self._write('tmpl.html', '<b>$x</b>')
+        os.utime(filepath, (mtime, mtime))
+        tmpl = self._load()
+        self.assertEqual('<b>1</b>', tmpl.generate(x=1).render(encoding=None))
+
+    def test_options_in_key(self):
+        self._write('tmpl.html', '<p>$x</p>')
+        self._load()
+        tmpl = self._load(variable_lookup='lenient')
+        self.assertEqual(2, len(self._entries()))
+        self.assertEqual('<p/>', tmpl.generate().render(encoding=None))
+        tmpl = self._load(variable_lookup=LenientLookup)
+        self.assertEqual(3, len(self._entries()))
+        tmpl = self._load(variable_lookup=LenientLookup)
+        self._assert_cached(tmpl)
+        self.assertEqual('<p/>', tmpl.generate().render(encoding=None))
+
+    def test_include_not_cached(self):
+        self._write('tmpl1.html', '<div>$x</div>')
+        self._write('tmpl2.html', """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+          <xi:include href="tmpl1.html" />
+        </html>""")
+        self._load('tmpl2.html')
+        self._write('tmpl1.html', '<div>[$x]</div>')
+        tmpl = self._load('tmpl2.html')
+        self.assertEqual("""<html>
+          <div>[1]</div>
+        </html>""", tmpl.generate(x=1).render(encoding=None))
+
+    def test_callback(self):
+        self._write('tmpl.html', """<p xmlns:i18n="http://genshi.edgewall.org/i18n"
+          i18n:msg="name">Hello, ${name}!</p>""")
+        calls = []
+        def _setup(tmpl):
+            calls.append(tmpl)
+            Translator(lambda s: s.upper()).setup(tmpl)
+        self._load(callback=_setup)
+        tmpl = self._load(callback=_setup)
+        self.assertEqual(2, len(calls))
+        self._assert_cached(tmpl)
+        self.assertEqual('<p>HELLO, %(NAME)S!</p>',
+                         tmpl.generate(name='x').render(encoding=None))
+
+    def test_text_template(self):
+        self._write('tmpl.txt', """{% for x in items %}
+          {% if x %}* ${x}{% end %}
+        {% end %}""")
+        expected = self._load('tmpl.txt', default_class=NewTextTemplate) \
+                       .generate(items=[0, 1]).render(encoding=None)
+        tmpl = self._load('tmpl.txt', default_class=NewTextTemplate)
+        self.assertTrue(isinstance(tmpl, NewTextTemplate))
+        self.assertEqual(expected,
+                         tmpl.generate(items=[0, 1]).render(encoding=None))
+
+    def test_invalid_entry(self):
+        self._write('tmpl.html', '<p>$x</p>')
+        self._load()
+        for name in self._entries():
+            fileobj = open(os.path.join(self.cachedir, name), 'wb')
+            try:
+                fileobj.write('garbage'.encode('ascii'))
+            finally:
+                fileobj.close()
+        tmpl = self._load()
+        self.assertEqual('<p>1</p>', tmpl.generate(x=1).render(encoding=None))
+        self._assert_cached(self._load())
+
+    def test_get_missing(self):
+        self.assertEqual(None, TemplateCache(self.cachedir).get(('x',), 'x'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(cache))
+    suite.addTest(unittest.makeSuite(TemplateCacheTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
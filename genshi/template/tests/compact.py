@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import pickle
+import unittest
+
+from genshi.compat import BytesIO
+from genshi.core import Attrs, Markup, QName, START, TEXT
+from genshi.input import XML
+from genshi.template import compact
+from genshi.template.base import SUB, _compact
+from genshi.template.compact import CompactStream, EventTable
+from genshi.template.markup import MarkupTemplate
+
+
+class CompactStreamTestCase(unittest.TestCase):
+
+    def test_events(self):
+        events = list(XML('<ul>\n  <li>1</li>\n  <li>2</li>\n</ul>'))
+        stream = CompactStream(events)
+        self.assertEqual(events, list(stream))
+        self.assertEqual(len(events), len(stream))
+        self.assertEqual(events[2], stream[2])
+        self.assertEqual(events[-1], stream[-1])
+        self.assertEqual(events[1:-1], stream[1:-1])
+        self.assertEqual(events[::2], stream[::2])
+        self.assertRaises(IndexError, stream.__getitem__, len(events))
+
+    def test_shared_data(self):
+        events = list(XML('<ul>\n  <li>1</li>\n  <li>2</li>\n</ul>'))
+        stream = CompactStream(events)
+        # The two start tags, end tags and white-space texts of the list items
+        # are only stored once, and the tag names are shared by start and end
+        # tags
+        self.assertEqual(8, len(stream.table.values))
+        assert stream[0][1][0] is stream[-1][1]
+        assert stream[2][1][0] is stream[8][1]
+
+    def test_equal_data_of_different_types(self):
+        pos = (None, 1, 0)
+        events = [(TEXT, u'<b>', pos), (TEXT, Markup(u'<b>'), pos),
+                  (START, (QName('b'), Attrs([(QName('x'), u'1')])), pos),
+                  (START, (QName('b'), Attrs([(QName('x'), Markup(u'1'))])),
+                   pos)]
+        stream = CompactStream(events)
+        self.assertEqual(5, len(stream.table.values))
+        self.assertEqual([unicode, Markup],
+                         [type(data) for kind, data, pos in stream][:2])
+        self.assertEqual(Markup, type(stream[3][1][1].get('x')))
+
+    def test_positions(self):
+        events = [(TEXT, u'a', ('a.html', 1, -1)),
+                  (TEXT, u'b', ('b.html', 100000, 70000)),
+                  (TEXT, u'c', (None, -1, -1))]
+        stream = CompactStream(events)
+        self.assertEqual(events, list(stream))
+        self.assertEqual(['a.html', 'b.html', None], stream.table.files)
+
+    def test_invalid_position(self):
+        self.assertRaises(TypeError, CompactStream, [(TEXT, u'a', None)])
+        self.assertRaises(TypeError, CompactStream,
+                          [(TEXT, u'a', (None, None, -1))])
+        self.assertRaises(ValueError, CompactStream,
+                          [(TEXT, u'a', (None, 1))])
+        events = [(TEXT, u'a', (None, 1, 0)), (TEXT, u'b', None)]
+        self.assertEqual(events, _compact(events))
+
+    def test_shared_table(self):
+        table = EventTable()
+        events1 = [(TEXT, u'a', (None, 1, 0)), (TEXT, u'b', (None, 2, 0))]
+        events2 = [(TEXT, u'b', ('x.html', 300, -1)),
+                   (TEXT, u'c', ('x.html', 100000, 0))]
+        stream1 = CompactStream(events1, table)
+        table.pack()
+        stream2 = CompactStream(events2, table)
+        self.assertEqual([u'a', u'b', u'c'], table.values)
+        self.assertEqual(4, len(table))
+        self.assertEqual(events1, list(stream1))
+        self.assertEqual(events2, list(stream2))
+        self.assertEqual(events1[-1], stream1[-1])
+        self.assertEqual(events2[0], stream2[0])
+
+    def test_pickle(self):
+        table = EventTable()
+        pos = ('test.html', 1, 0)
+        stream1 = CompactStream([(TEXT, u'a', pos)], table)
+        stream2 = CompactStream([(TEXT, u'b', pos)], table)
+        buf = BytesIO()
+        pickle.dump((stream1, stream2), buf, 2)
+        buf.seek(0)
+        unpickled1, unpickled2 = pickle.load(buf)
+        self.assertEqual(list(stream1), list(unpickled1))
+        self.assertEqual(list(stream2), list(unpickled2))
+        assert unpickled1.table is unpickled2.table
+        self.assertEqual(2, len(unpickled1.table))
+
+
+class TemplateStreamTestCase(unittest.TestCase):
+
+    def test_prepared_stream(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items">${item}</li>
+        </ul>""")
+        stream = tmpl.stream
+        assert isinstance(stream, CompactStream)
+        subs = [data for kind, data, pos in stream if kind is SUB]
+        self.assertEqual(1, len(subs))
+        assert isinstance(subs[0][1], CompactStream)
+        assert subs[0][1].table is stream.table
+        self.assertEqual("""<ul>
+          <li>1</li><li>2</li>
+        </ul>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+
+    def test_static_stream(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p>Hello</p>
+          <p py:if="x">${x}</p>
+        </div>""")
+        self.assertEqual("""<div>
+          <p>Hello</p>
+          <p>1</p>
+        </div>""", tmpl.generate(x=1).render(encoding=None))
+        static = tmpl._prepare_static()
+        assert isinstance(static, CompactStream)
+        assert static.table is tmpl.stream.table
+
+    def test_pickle(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:if="items">${items}</li>
+        </ul>""")
+        tmpl.stream
+        buf = BytesIO()
+        pickle.dump(tmpl, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        assert isinstance(unpickled.stream, CompactStream)
+        self.assertEqual("""<ul>
+          <li>2</li>
+        </ul>""", unpickled.generate(items=2).render(encoding=None))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(compact))
+    suite.addTest(unittest.makeSuite(CompactStreamTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TemplateStreamTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
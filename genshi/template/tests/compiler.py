@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Edgewall Software
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://genshi.edgewall.org/wiki/License.
+#
+# This software consists of voluntary contributions made by many
+# individuals. For the exact contribution history, see the revision
+# history and logs, available at http://genshi.edgewall.org/log/.
+
+import doctest
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+from genshi.compat import BytesIO
+from genshi.template import compiler
+from genshi.template.base import TemplateRuntimeError
+from genshi.template.loader import TemplateLoader
+from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
+
+
+class TemplateCompilerTestCase(unittest.TestCase):
+
+    def _assert_same(self, source, cls=MarkupTemplate, **data):
+        expected = cls(source).generate(**data).render(encoding=None)
+        tmpl = cls(source).compile()
+        self.assertEqual(expected, tmpl.generate(**data).render(encoding=None))
+        return tmpl
+
+    def test_compile_returns_template(self):
+        tmpl = MarkupTemplate('<p>$x</p>')
+        self.assertTrue(tmpl.compile() is tmpl)
+
+    def test_expressions(self):
+        self._assert_same("""<div>
+          ${none} ${text} ${number} ${number * 1.5} ${items} ${obj}
+          ${(x for x in items)}
+        </div>""", none=None, text='<a>', number=42, items=[1, 2],
+                   obj=object)
+
+    def test_interpolated_attrs(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <a href="${url}" title="${none}" class="x$num">link</a>
+        </div>""", url='/foo?a=1&b=2', none=None, num=3)
+
+    def test_if(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <b py:if="foo">foo</b><i py:if="not foo">bar</i>
+          <py:if test="foo">baz</py:if>
+        </div>""", foo=True)
+
+    def test_for(self):
+        self._assert_same("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="idx, (a, b) in enumerate(items)">$idx: $a $b</li>
+          <py:for each="x in []">$x</py:for>
+        </ul>""", items=[(1, 2), (3, 4)])
+
+    def test_for_scope_restored(self):
+        self._assert_same("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="x in items" py:if="x % 2">${x}</li>
+          $x
+        </ul>""", items=range(5), x='outer')
+
+    def test_nested_for(self):
+        self._assert_same("""<table xmlns:py="http://genshi.edgewall.org/">
+          <tr py:for="row in rows">
+            <td py:for="cell in row" py:content="cell"/>
+          </tr>
+        </table>""", rows=[[1, 2], [3, 4]])
+
+    def test_deep_nesting(self):
+        source = '<div xmlns:py="http://genshi.edgewall.org/">'
+        for idx in range(25):
+            source += '<py:for each="v%d in range(2)">' % idx
+        source += '.'
+        source += '</py:for>' * 25 + '</div>'
+        self._assert_same(source.replace('range(2)', 'range(1)'))
+
+    def test_with(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <span py:with="x = x * 2; y = x + 1">$x $y</span> $x
+        </div>""", x=5)
+
+    def test_choose(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="n in range(4)">
+            <py:choose test="n">
+              <b py:when="1">one</b>
+              <b py:when="2">two</b>
+              <b py:otherwise="">other</b>
+            </py:choose>
+            <py:choose>
+              <i py:when="n > 1">big</i>
+            </py:choose>
+          </py:for>
+        </div>""")
+
+    def test_strip(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <b py:for="x in range(3)" py:strip="x == 1">$x</b>
+          <i py:strip="">stripped</i>
+          <i py:strip="" py:content="'replaced'">stripped</i>
+        </div>""")
+
+    def test_def_and_call(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:def="echo(what, bold=0)" py:attrs="{'class': bold and 'b'}">
+            <py:if test="bold"><b>$what</b></py:if>
+          </p>
+          ${echo('hi')} ${echo('there', 1)}
+        </div>""")
+
+    def test_replace_content_attrs(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <span py:replace="'foo'">bar</span>
+          <span py:content="x" py:attrs="{'id': x}">bar</span>
+        </div>""", x=3)
+
+    def test_python_blocks(self):
+        self._assert_same("""<div xmlns:py="http://genshi.edgewall.org/">
+          <?python
+            items = [x * 2 for x in range(3)]
+          ?>
+          <py:for each="i in items">$i</py:for>
+        </div>""")
+
+    def test_match(self):
+        self._assert_same("""<html xmlns:py="http://genshi.edgewall.org/">
+          <body py:match="body" py:attrs="select('@*')">
+            <h1>Title</h1>${select('*|text()')}
+          </body>
+          <body class="x"><p py:for="i in range(2)">$i</p></body>
+        </html>""")
+
+    def test_text_template(self):
+        self._assert_same("""{% for x in items %}
+          {% if x %}* ${x}{% end %}
+          {% choose x %}{% when 1 %}one{% end %}{% end %}
+        {% end %}""", cls=NewTextTemplate, items=[0, 1, 2])
+
+    def test_include(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            file1 = open(os.path.join(dirname, 'tmpl1.html'), 'w')
+            try:
+                file1.write('<div xmlns:py="http://genshi.edgewall.org/">'
+                            '<b py:for="i in range(2)">$i</b></div>')
+            finally:
+                file1.close()
+            file2 = open(os.path.join(dirname, 'tmpl2.html'), 'w')
+            try:
+                file2.write('<html xmlns:xi="http://www.w3.org/2001/XInclude">'
+                            '<xi:include href="tmpl1.html" /></html>')
+            finally:
+                file2.close()
+
+            loader = TemplateLoader([dirname],
+                                    callback=lambda tmpl: tmpl.compile())
+            tmpl = loader.load('tmpl2.html')
+            self.assertTrue(tmpl._compiled is not None)
+            self.assertEqual('<html><div><b>0</b><b>1</b></div></html>',
+                             tmpl.generate().render(encoding=None))
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_error_position(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="x in items">
+            ${1 / x}
+          </py:for>
+        </div>""", filename='test.html').compile()
+        try:
+            list(tmpl.generate(items=[1, 0]))
+            self.fail('Expected ZeroDivisionError')
+        except ZeroDivisionError:
+            frames = []
+            tb = sys.exc_info()[2]
+            while tb.tb_next:
+                tb = tb.tb_next
+                frames.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+            self.assertTrue(('test.html', 3) in frames)
+
+    def test_runtime_error(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <py:choose test="1"><py:when test="2">x</py:when></py:choose>
+          <py:when test="1">y</py:when>
+        </div>""", filename='test.html').compile()
+        self.assertRaises(TemplateRuntimeError, list, tmpl.generate())
+
+    def test_pickle(self):
+        tmpl = MarkupTemplate('<div xmlns:py="http://genshi.edgewall.org/">'
+                              '<b py:if="x">$x</b></div>')
+        tmpl.compile()
+        buf = BytesIO()
+        pickle.dump(tmpl, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        self.assertEqual('<div><b>1</b></div>',
+                         unpickled.generate(x=1).render(encoding=None))
+        self.assertTrue(callable(unpickled._compiled))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(doctest.DocTestSuite(compiler))
+    suite.addTest(unittest.makeSuite(TemplateCompilerTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
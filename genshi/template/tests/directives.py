@@ -502,6 +502,17 @@ class ForDirectiveTestCase(unittest.TestCase):
                              frames[-1].tb_frame.f_code.co_filename)
             self.assertEqual(2, frames[-1].tb_lineno)
 
+    def test_loop_variable_scope(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:for each="x in items"><py:for each="x in [x * 2]">$x</py:for>$x
+          </py:for>${defined('x')} <py:for each="y in []"/>${defined('y')}
+        </doc>""")
+        self.assertEqual("""<doc>
+          21
+          42
+          False False
+        </doc>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+
     def test_for_with_empty_value(self):
         """
         Verify an empty 'for' value is an error
@@ -1026,6 +1037,151 @@ class MatchDirectiveTestCase(unittest.TestCase):
             <bar/>
           </root>""", tmpl.generate().render())
 
+    def test_match_order_with_named_and_wildcard_paths(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="*[@class='x']"><x>${select('*|text()')}</x></py:match>
+          <py:match path="a|b"><ab>${select('*|text()')}</ab></py:match>
+          <py:match path="b"><b2>${select('*|text()')}</b2></py:match>
+          <a>1</a><b>2</b><b class="x">3</b><c>4</c>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <ab>1</ab><ab>2</ab><x>3</x><c>4</c>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_match_named_path_with_position_predicate(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="p[2]"><second>${select('text()')}</second></py:match>
+          <p>1</p><q><p>2</p></q><p>3</p>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <p>1</p><q><second>2</second></q><p>3</p>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_match_once_then_defined(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="a" once="true"><a1/></py:match>
+          <py:match path="b"><b1/></py:match>
+          <a/><a/><b/>
+          <py:match path="a"><a2/></py:match>
+          <a/><b/>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <a1/><a/><b1/>
+          <a2/><b1/>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def _match_hints(self, source):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          %s
+        </doc>""" % source)
+        for kind, data, pos in tmpl.stream:
+            if kind is MarkupTemplate.SUB:
+                return sorted(data[0][0].hints)
+
+    def test_inferred_hints(self):
+        self.assertEqual(['match_once', 'not_buffered'], self._match_hints(
+            """<py:match path="html/body" xmlns="http://www.w3.org/1999/xhtml">
+              <body>${select('*')}</body>
+            </py:match>"""
+        ))
+        self.assertEqual(['not_buffered'], self._match_hints(
+            """<py:match path="body"><body>${select('*')}</body></py:match>"""
+        ))
+        self.assertEqual(['not_buffered'], self._match_hints(
+            """<py:match path="html//body"
+                         xmlns="http://www.w3.org/1999/xhtml">
+              <body>${select('*')}</body>
+            </py:match>"""
+        ))
+        self.assertEqual(['not_buffered', 'not_recursive'], self._match_hints(
+            """<py:match path="br|hr" xmlns="http://www.w3.org/1999/xhtml">
+              ${select('.')}
+            </py:match>"""
+        ))
+        self.assertEqual(['not_buffered'], self._match_hints(
+            """<py:match path="br|hr">${select('.')}</py:match>"""
+        ))
+        self.assertEqual(['match_once'], self._match_hints(
+            """<head py:match="html/head" xmlns="http://www.w3.org/1999/xhtml">
+              <title py:content="select('title/text()')" />${select('meta')}
+            </head>"""
+        ))
+        self.assertEqual([], self._match_hints(
+            """<py:match path="p"><py:if test="x">${select('*')}</py:if>
+            </py:match>"""
+        ))
+        self.assertEqual([], self._match_hints(
+            """<py:match path="p"><?python x = 1 ?>${select('*')}</py:match>"""
+        ))
+        self.assertEqual(['not_buffered'], self._match_hints(
+            """<py:match path="head" once="false">${select('*')}</py:match>"""
+        ))
+        self.assertEqual(['match_once'], self._match_hints(
+            """<py:match path="html" buffer="true"
+                         xmlns="http://www.w3.org/1999/xhtml">
+              ${select('*')}
+            </py:match>"""
+        ))
+        self.assertEqual(['not_buffered'], self._match_hints(
+            """<py:match path="head" xmlns="http://example.org/">
+              ${select('*')}
+            </py:match>"""
+        ))
+
+    def test_inferred_hints_repeated_body(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="body"><text>${select('text()')}</text></py:match>
+          <msg><body>a</body></msg><msg><body>b</body></msg>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <msg><text>a</text></msg><msg><text>b</text></msg>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_inferred_hints_nested_leaf_name(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <param py:match="param"><wrapped>${select('*|text()')}</wrapped></param>
+          <param>a<param>b</param></param>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <param><wrapped>a<param><wrapped>b</wrapped></param></wrapped></param>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_inferred_hints_select_in_attribute(self):
+        self.assertEqual([], self._match_hints(
+            """<py:match path="it">
+              <it n="${select('@n')}">${select('text()')}</it>
+            </py:match>"""
+        ))
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <it py:match="it" n="${select('@n')}">${select('text()')}</it>
+          <it n="1">a</it><it n="2">b</it>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <it n="1">a</it><it n="2">b</it>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_inferred_not_buffered_with_directives(self):
+        tmpl = MarkupTemplate("""<doc xmlns:py="http://genshi.edgewall.org/">
+          <p py:match="p" py:for="i in range(2)">${select('text()')}</p>
+          <p>x</p>
+        </doc>""")
+        self.assertEqual("""<doc>
+          <p>x</p><p>x</p>
+        </doc>""", tmpl.generate().render(encoding=None))
+
+    def test_match_once_multiple_templates(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="body[@id='content']/h2" />
+          <py:match path="head" once="true"><head/></py:match>
+          <py:match path="head" once="true"><head/></py:match>
+          <head />
+          <body />
+        </html>""")
+        self.assertEqual("""<html>
+          <head/>
+          <body/>
+        </html>""", tmpl.generate().render(encoding=None))
+
     # FIXME
     #def test_match_after_step(self):
     #    tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
@@ -1101,6 +1257,104 @@ class StripDirectiveTestCase(unittest.TestCase):
         </div>""", tmpl.generate().render(encoding=None))
 
 
+class FlushDirectiveTestCase(unittest.TestCase):
+    """Tests for the `py:flush` template directive."""
+
+    def _chunks(self, tmpl, **kwargs):
+        return list(tmpl.generate(**kwargs).render_iter(encoding=None))
+
+    def test_flush_after_element(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <head py:flush=""><title>Foo</title></head>
+          <body>Bar</body>
+        </html>""")
+        self.assertEqual(["""<html>
+          <head><title>Foo</title></head>""", """
+          <body>Bar</body>
+        </html>"""], self._chunks(tmpl))
+
+    def test_flush_as_element(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p>Foo</p><py:flush/><p>Bar</p>
+        </div>""")
+        self.assertEqual(["""<div>
+          <p>Foo</p>""", """<p>Bar</p>
+        </div>"""], self._chunks(tmpl))
+
+    def test_flush_condition(self):
+        tmpl = MarkupTemplate("""<ul xmlns:py="http://genshi.edgewall.org/">
+          <li py:for="item in items" py:flush="item % 2">${item}</li>
+        </ul>""")
+        self.assertEqual(["""<ul>
+          <li>1</li>""", """<li>2</li><li>3</li>""", """
+        </ul>"""], self._chunks(tmpl, items=[1, 2, 3]))
+
+    def test_flush_with_strip(self):
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <div py:strip="" py:flush=""><b>foo</b></div>
+        </div>""")
+        self.assertEqual(["""<div>
+          <b>foo</b>""", """
+        </div>"""], self._chunks(tmpl))
+
+    def test_flush_in_buffered_match(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <body py:match="body" py:attrs="select('@*')">
+            <div id="wrap">${select('*|text()')}</div>
+          </body>
+          <body class="page"><p>Foo</p><py:flush/><p>Bar</p></body>
+        </html>""")
+        self.assertEqual(["""<html>
+          <body class="page">
+            <div id="wrap"><p>Foo</p><p>Bar</p></div>
+          </body>""", """
+        </html>"""], self._chunks(tmpl))
+
+    def test_flush_in_streamed_match(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <body py:match="body">
+            <div id="wrap">${select('*|text()')}</div>
+          </body>
+          <body><p>Foo</p><py:flush/><p>Bar</p></body>
+        </html>""")
+        self.assertEqual(["""<html>
+          <body>
+            <div id="wrap"><p>Foo</p><p>Bar</p></div>
+          </body>""", """
+        </html>"""], self._chunks(tmpl))
+
+    def test_flush_in_match_template(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <body py:match="body">
+            <div id="header"/><py:flush/>
+            ${select('*')}
+          </body>
+          <body><p>Foo</p></body>
+        </html>""")
+        self.assertEqual(["""<html>
+          <body>
+            <div id="header"/>""", """
+            <p>Foo</p>
+          </body>
+        </html>"""], self._chunks(tmpl))
+
+    def test_flush_output(self):
+        class Output(object):
+            def __init__(self):
+                self.written = []
+            def write(self, string):
+                self.written.append(string)
+            def flush(self):
+                self.written.append(None)
+        tmpl = MarkupTemplate("""<div xmlns:py="http://genshi.edgewall.org/">
+          <p py:flush="">Foo</p>
+        </div>""")
+        out = Output()
+        tmpl.generate().render(out=out)
+        self.assertEqual(['<div>\n          <p>Foo</p>', None,
+                          '\n        </div>'], out.written)
+
+
 class WithDirectiveTestCase(unittest.TestCase):
     """Tests for the `py:with` template directive."""
 
@@ -1224,6 +1478,7 @@ def suite():
     suite.addTest(unittest.makeSuite(ContentDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ReplaceDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(StripDirectiveTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(FlushDirectiveTestCase, 'test'))
     suite.addTest(unittest.makeSuite(WithDirectiveTestCase, 'test'))
     return suite
 
@@ -19,9 +19,10 @@ from tempfile import mkstemp
 import unittest
 
 from genshi.core import Markup
+from genshi.template.astutil import _ast
 from genshi.template.base import Context
 from genshi.template.eval import Expression, Suite, Undefined, UndefinedError, \
-                                 UNDEFINED
+                                 UNDEFINED, StrictLookup
 from genshi.compat import BytesIO, IS_PYTHON2, wrapped_bytes
 
 
@@ -45,6 +46,28 @@ class ExpressionTestCase(unittest.TestCase):
         unpickled = pickle.load(buf)
         assert unpickled.evaluate({}) is True
 
+    def test_discard_ast(self):
+        expr = Expression('foo.bar', keep_ast=False)
+        self.assertEqual(None, expr._ast)
+        assert isinstance(expr.ast, _ast.Expression)
+        self.assertEqual('foo', expr.ast.body.value.id)
+        self.assertEqual(1, expr.evaluate({'foo': {'bar': 1}}))
+
+        # The AST is also parsed again if the code came from the cache
+        expr = Expression('foo.bar', keep_ast=False)
+        self.assertEqual(None, expr._ast)
+        assert isinstance(expr.ast, _ast.Expression)
+        assert isinstance(Expression('foo.bar')._ast, _ast.Expression)
+
+    def test_pickle_discarded_ast(self):
+        expr = Expression('1 < 2', keep_ast=False)
+        buf = BytesIO()
+        pickle.dump(expr, buf, 2)
+        buf.seek(0)
+        unpickled = pickle.load(buf)
+        assert unpickled.evaluate({}) is True
+        assert isinstance(unpickled.ast, _ast.Expression)
+
     def test_name_lookup(self):
         self.assertEqual('bar', Expression('foo').evaluate({'foo': 'bar'}))
         self.assertEqual(id, Expression('id').evaluate({}))
@@ -391,6 +414,66 @@ class ExpressionTestCase(unittest.TestCase):
         self.assertRaises(AttributeError,
                           Expression('s.prop_b').evaluate, {'s': Something()})
 
+    def test_getattr_dict_item(self):
+        expr = Expression('d.name')
+        self.assertEqual(1, expr.evaluate({'d': {'name': 1}}))
+        self.assertEqual(2, expr.evaluate({'d': {'name': 2}}))
+        self.assertRaises(UndefinedError, expr.evaluate, {'d': {}})
+        items = Expression('d.items').evaluate({'d': {'items': 1}})
+        self.assertEqual([('items', 1)], list(items()))
+
+    def test_getattr_dict_instance_attribute(self):
+        class AttrDict(dict):
+            pass
+        expr = Expression('d.name')
+        self.assertEqual(1, expr.evaluate({'d': AttrDict(name=1)}))
+        d = AttrDict(name=1)
+        d.name = 2
+        self.assertEqual(2, expr.evaluate({'d': d}))
+
+    def test_getattr_chain(self):
+        class Something(object):
+            d = {'b': {'c': 1}}
+        expr = Expression('s.d.b.c')
+        self.assertEqual(1, expr.evaluate({'s': Something()}))
+        expr = Expression('s.d.b.x', lookup='lenient')
+        retval = expr.evaluate({'s': Something()})
+        assert isinstance(retval, Undefined)
+        self.assertEqual('x', retval._name)
+        self.assertEqual({'c': 1}, retval._owner)
+        expr = Expression('s.d.x.c', lookup='lenient')
+        self.assertRaises(UndefinedError, expr.evaluate, {'s': Something()})
+        expr = Expression('s.d.b.x', lookup='strict')
+        self.assertRaises(UndefinedError, expr.evaluate, {'s': Something()})
+
+    def test_getattr_chain_custom_lookup(self):
+        class UpperLookup(StrictLookup):
+            @classmethod
+            def lookup_attr(cls, obj, key):
+                return StrictLookup.lookup_attr(obj, key.upper())
+        expr = Expression('a.b.c', lookup=UpperLookup)
+        self.assertEqual(1, expr.evaluate({'a': {'B': {'C': 1}}}))
+
+    def test_compile_cached(self):
+        expr1 = Expression('item.name', filename='a.html', lineno=3)
+        expr2 = Expression('item.name', filename='b.html', lineno=7,
+                           lookup='lenient')
+        assert expr1.code.co_code is expr2.code.co_code
+        self.assertEqual(('a.html', 3), (expr1.code.co_filename,
+                                         expr1.code.co_firstlineno))
+        self.assertEqual(('b.html', 7), (expr2.code.co_filename,
+                                         expr2.code.co_firstlineno))
+        self.assertEqual("<Expression 'item.name'>", expr2.code.co_name)
+        self.assertEqual(1, expr2.evaluate({'item': {'name': 1}}))
+        retval = expr2.evaluate({'item': {}})
+        assert isinstance(retval, Undefined)
+
+    def test_compile_cached_nested_code(self):
+        expr1 = Expression('(lambda: 1)', filename='a.html')
+        expr2 = Expression('(lambda: 1)', filename='b.html')
+        self.assertEqual('b.html', expr2.evaluate({}).__code__.co_filename)
+        self.assertEqual('a.html', expr1.evaluate({}).__code__.co_filename)
+
     def test_getitem_undefined_string(self):
         class Something(object):
             def __repr__(self):
@@ -15,11 +15,14 @@ import doctest
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
 from genshi.core import TEXT
+from genshi.template.base import EXPR, SUB, TemplateSyntaxError
 from genshi.template.loader import TemplateLoader
 from genshi.template.markup import MarkupTemplate
+from genshi.template.text import NewTextTemplate
 
 
 class TemplateLoaderTestCase(unittest.TestCase):
@@ -393,6 +396,39 @@ class TemplateLoaderTestCase(unittest.TestCase):
               <p>Hello, hello</p>
             </html>""", tmpl.generate().render(encoding=None))
 
+    def test_load_discards_ast(self):
+        fileobj = open(os.path.join(self.dirname, 'tmpl.html'), 'w')
+        try:
+            fileobj.write("""<html xmlns:py="http://genshi.edgewall.org/">
+              <p py:if="items">${len(items)} items</p>
+            </html>""")
+        finally:
+            fileobj.close()
+
+        def _exprs(tmpl):
+            for kind, data, pos in tmpl.stream:
+                if kind is SUB:
+                    yield data[0][0].expr
+                    for kind, data, pos in data[1]:
+                        if kind is EXPR:
+                            yield data
+
+        loader = TemplateLoader([self.dirname])
+        tmpl = loader.load('tmpl.html')
+        exprs = list(_exprs(tmpl))
+        self.assertEqual(2, len(exprs))
+        for expr in exprs:
+            self.assertEqual(None, expr._ast)
+            self.assertNotEqual(None, expr.ast)
+        self.assertEqual("""<html>
+              <p>2 items</p>
+            </html>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+
+        loader = TemplateLoader([self.dirname], keep_ast=True)
+        tmpl = loader.load('tmpl.html')
+        for expr in _exprs(tmpl):
+            self.assertNotEqual(None, expr._ast)
+
     def test_prefix_delegation_to_directories(self):
         """
         Test prefix delegation with the following layout:
@@ -495,6 +531,107 @@ class TemplateLoaderTestCase(unittest.TestCase):
               <div>bar/tmpl3</div> from sub1
             </html>""", tmpl.generate().render(encoding=None))
 
+    def _write_templates(self, templates):
+        for filename, source in templates.items():
+            filepath = os.path.join(self.dirname, filename)
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            fileobj = open(filepath, 'w')
+            try:
+                fileobj.write(source)
+            finally:
+                fileobj.close()
+
+    def test_preload(self):
+        self._write_templates({
+            'index.html': """<html xmlns:xi="http://www.w3.org/2001/XInclude">
+              <xi:include href="sub/inc.html" /> $x
+            </html>""",
+            'sub/inc.html': """<div>Included</div>""",
+            'mail.txt': """Hello ${x}""",
+            'README': """Not a template"""
+        })
+        loader = TemplateLoader([self.dirname], max_cache_size=1)
+        times = loader.preload(freeze=False)
+        self.assertEqual(['index.html', 'mail.txt', 'sub/inc.html'],
+                         [filename for filename, seconds in times])
+        for filename, seconds in times:
+            self.assertTrue(seconds >= 0)
+        self.assertEqual(3, len(loader._cache))
+
+        # The templates are prepared, with the static include inlined
+        tmpl = loader.load('index.html')
+        self.assertTrue(tmpl._prepared)
+        self.assertTrue(tmpl._static_stream is not None)
+        self.assertEqual([], [event for event in tmpl.stream
+                              if event[0] is MarkupTemplate.INCLUDE])
+        self.assertEqual("""<html>
+              <div>Included</div> 1
+            </html>""", tmpl.generate(x=1).render(encoding=None))
+        self.assertEqual('Hello 1', loader.load('mail.txt').generate(x=1)
+                                          .render(encoding=None))
+
+        # Templates that are already loaded are not loaded again
+        loader.preload(freeze=False)
+        self.assertTrue(loader.load('index.html') is tmpl)
+
+    def test_preload_patterns(self):
+        self._write_templates({
+            'index.html': """<p>$x</p>""",
+            'mail.txt': """<p>$x</p>"""
+        })
+        loader = TemplateLoader([self.dirname])
+        times = loader.preload(['*.html', ('*.txt', NewTextTemplate)],
+                               freeze=False)
+        self.assertEqual(['index.html', 'mail.txt'],
+                         [filename for filename, seconds in times])
+        self.assertTrue(isinstance(loader.load('index.html'), MarkupTemplate))
+        self.assertTrue(isinstance(loader.load('mail.txt'), NewTextTemplate))
+
+    def test_preload_threads(self):
+        templates = dict([('tmpl%d.html' % idx,
+                           """<p>${x + %d}</p>""" % idx) for idx in range(20)])
+        self._write_templates(templates)
+        loader = TemplateLoader([self.dirname])
+        times = loader.preload(threads=4, freeze=False)
+        self.assertEqual(sorted(templates),
+                         [filename for filename, seconds in times])
+        self.assertEqual('<p>6</p>', loader.load('tmpl5.html').generate(x=1)
+                                           .render(encoding=None))
+
+    def test_preload_threads_shared_include(self):
+        prepared = []
+        class Template(MarkupTemplate):
+            def _prepare(self, stream, inlined=True):
+                if stream is self._stream:
+                    prepared.append(self.filename)
+                    if self.filename == 'shared.html':
+                        time.sleep(0.05)
+                return MarkupTemplate._prepare(self, stream, inlined)
+        templates = dict([('tmpl%d.html' % idx, """<div
+            xmlns:xi="http://www.w3.org/2001/XInclude">
+              <xi:include href="shared.html" /> ${x + %d}
+            </div>""" % idx) for idx in range(8)])
+        templates['shared.html'] = """<p>Shared</p>"""
+        self._write_templates(templates)
+        loader = TemplateLoader([self.dirname])
+        loader.preload([('*.html', Template)], threads=4, freeze=False)
+        self.assertEqual(sorted(templates), sorted(prepared))
+        self.assertEqual("""<div>
+              <p>Shared</p> 6
+            </div>""", loader.load('tmpl5.html').generate(x=1)
+                                               .render(encoding=None))
+
+    def test_preload_error(self):
+        self._write_templates({
+            'good.html': """<p>$x</p>""",
+            'bad.html': """<p>$x</div>"""
+        })
+        loader = TemplateLoader([self.dirname])
+        self.assertRaises(TemplateSyntaxError, loader.preload, freeze=False)
+        self.assertRaises(TemplateSyntaxError, loader.preload, threads=2,
+                          freeze=False)
+
 
 def suite():
     suite = unittest.TestSuite()
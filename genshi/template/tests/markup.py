@@ -20,8 +20,9 @@ import tempfile
 import unittest
 
 from genshi.compat import BytesIO, StringIO
-from genshi.core import Markup
+from genshi.core import Markup, TEXT
 from genshi.input import XML
+from genshi.output import STATIC
 from genshi.template.base import BadDirectiveError, TemplateSyntaxError
 from genshi.template.loader import TemplateLoader, TemplateNotFound
 from genshi.template.markup import MarkupTemplate
@@ -756,6 +757,86 @@ class MarkupTemplateTestCase(unittest.TestCase):
           </lines>
         </rhyme>""", tmpl.generate().render(encoding=None)) 
 
+    def test_static_chunks(self):
+        tmpl = MarkupTemplate("""<html xmlns:py="http://genshi.edgewall.org/">
+          <div id="header"><h1>Title</h1></div>
+          <ul><li py:for="item in items"><b>Item:</b> $item</li></ul>
+        </html>""")
+        self.assertEqual("""<html>
+          <div id="header"><h1>Title</h1></div>
+          <ul><li><b>Item:</b> 1</li><li><b>Item:</b> 2</li></ul>
+        </html>""", tmpl.generate(items=[1, 2]).render(encoding=None))
+        kinds = [kind for kind, data, pos in tmpl._prepare_static()]
+        self.assertTrue(STATIC in kinds)
+
+        # Iterating over the stream yields the original events
+        kinds = [kind for kind, data, pos in tmpl.generate(items=[1, 2])]
+        self.assertFalse(STATIC in kinds)
+
+    def test_static_chunks_with_filter(self):
+        tmpl = MarkupTemplate("""<div><p>Foo</p><p>Bar</p></div>""")
+        def upper(stream, ctxt, **vars):
+            for kind, data, pos in stream:
+                if kind is TEXT:
+                    data = data.upper()
+                yield kind, data, pos
+        tmpl.filters.append(upper)
+        self.assertEqual('<div><p>FOO</p><p>BAR</p></div>',
+                         tmpl.generate().render(encoding=None))
+
+    def test_static_chunks_matched(self):
+        xml = ("""<html xmlns:py="http://genshi.edgewall.org/">
+          <div><p><b>Foo</b></p></div>
+          <b py:match="b">[${select('text()')}]</b>
+          <div><p><b>Bar</b></p></div>
+        </html>""")
+        tmpl = MarkupTemplate(xml, filename='test.html')
+        self.assertEqual("""<html>
+          <div><p><b>Foo</b></p></div>
+          <div><p><b>[Bar]</b></p></div>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def test_static_chunks_in_selected_content(self):
+        xml = ("""<html xmlns:py="http://genshi.edgewall.org/">
+          <py:match path="body" once="true">
+            <body><div id="content">${select('*')}</div></body>
+          </py:match>
+          <body><p class="static"><b>Foo</b></p></body>
+        </html>""")
+        tmpl = MarkupTemplate(xml, filename='test.html')
+        self.assertEqual("""<html>
+            <body><div id="content"><p class="static"><b>Foo</b></p></div></body>
+        </html>""", tmpl.generate().render(encoding=None))
+
+    def test_static_chunks_included(self):
+        dirname = tempfile.mkdtemp(suffix='genshi_test')
+        try:
+            file1 = open(os.path.join(dirname, 'tmpl1.html'), 'w')
+            try:
+                file1.write("""<div><p><b>Included</b></p></div>""")
+            finally:
+                file1.close()
+
+            file2 = open(os.path.join(dirname, 'tmpl2.html'), 'w')
+            try:
+                file2.write("""<html xmlns:xi="http://www.w3.org/2001/XInclude"
+                                     xmlns:py="http://genshi.edgewall.org/">
+                  <xi:include href="tmpl1.html" />
+                  <b py:match="b">[${select('text()')}]</b>
+                  <xi:include href="tmpl1.html" />
+                </html>""")
+            finally:
+                file2.close()
+
+            loader = TemplateLoader([dirname])
+            tmpl = loader.load('tmpl2.html')
+            self.assertEqual("""<html>
+                  <div><p><b>Included</b></p></div>
+                  <div><p><b>[Included]</b></p></div>
+                </html>""", tmpl.generate().render(encoding=None))
+        finally:
+            shutil.rmtree(dirname)
+
 
 def suite():
     suite = unittest.TestSuite()
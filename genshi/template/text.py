@@ -132,10 +132,11 @@ class NewTextTemplate(Template):
 
     def __init__(self, source, filepath=None, filename=None, loader=None,
                  encoding=None, lookup='strict', allow_exec=False,
-                 delims=('{%', '%}', '{#', '#}')):
+                 delims=('{%', '%}', '{#', '#}'), keep_ast=True):
         self.delimiters = delims
         Template.__init__(self, source, filepath=filepath, filename=filename,
-                          loader=loader, encoding=encoding, lookup=lookup)
+                          loader=loader, encoding=encoding, lookup=lookup,
+                          keep_ast=keep_ast)
 
     def _get_delims(self):
         return self._delims
@@ -179,7 +180,8 @@ class NewTextTemplate(Template):
             if start > offset:
                 text = _escape_sub(_escape_repl, source[offset:start])
                 for kind, data, pos in interpolate(text, self.filepath, lineno,
-                                                   lookup=self.lookup):
+                                                   lookup=self.lookup,
+                                                   keep_ast=self.keep_ast):
                     stream.append((kind, data, pos))
                 lineno += len(text.splitlines())
 
@@ -189,7 +191,8 @@ class NewTextTemplate(Template):
             if command == 'include':
                 pos = (self.filename, lineno, 0)
                 value = list(interpolate(value, self.filepath, lineno, 0,
-                                         lookup=self.lookup))
+                                         lookup=self.lookup,
+                                         keep_ast=self.keep_ast))
                 if len(value) == 1 and value[0][0] is TEXT:
                     value = value[0][1]
                 stream.append((INCLUDE, (value, None, []), pos))
@@ -200,7 +203,7 @@ class NewTextTemplate(Template):
                                               self.filepath, lineno)
                 try:
                     suite = Suite(value, self.filepath, lineno,
-                                  lookup=self.lookup)
+                                  lookup=self.lookup, keep_ast=self.keep_ast)
                 except SyntaxError, err:
                     raise TemplateSyntaxError(err, self.filepath,
                                               lineno + (err.lineno or 1) - 1)
@@ -228,7 +231,8 @@ class NewTextTemplate(Template):
         if offset < len(source):
             text = _escape_sub(_escape_repl, source[offset:])
             for kind, data, pos in interpolate(text, self.filepath, lineno,
-                                               lookup=self.lookup):
+                                               lookup=self.lookup,
+                                               keep_ast=self.keep_ast):
                 stream.append((kind, data, pos))
 
         return stream
@@ -289,7 +293,8 @@ class OldTextTemplate(Template):
             if start > offset:
                 text = source[offset:start]
                 for kind, data, pos in interpolate(text, self.filepath, lineno,
-                                                   lookup=self.lookup):
+                                                   lookup=self.lookup,
+                                                   keep_ast=self.keep_ast):
                     stream.append((kind, data, pos))
                 lineno += len(text.splitlines())
 
@@ -324,7 +329,8 @@ class OldTextTemplate(Template):
         if offset < len(source):
             text = source[offset:].replace('\\#', '#')
             for kind, data, pos in interpolate(text, self.filepath, lineno,
-                                               lookup=self.lookup):
+                                               lookup=self.lookup,
+                                               keep_ast=self.keep_ast):
                 stream.append((kind, data, pos))
 
         return stream
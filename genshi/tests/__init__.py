@@ -13,7 +13,35 @@
 
 import unittest
 
+
+class PythonTestSuite(unittest.TestSuite):
+    """Test suite that runs its tests with the pure-Python implementations of
+    the functions the optional C extension module provides.
+    """
+
+    def run(self, result, *args, **kwargs):
+        from genshi import output
+        from genshi.template import base
+        saved = output._speedups_serialize, base._speedups_flatten
+        output._speedups_serialize = base._speedups_flatten = None
+        try:
+            return unittest.TestSuite.run(self, result, *args, **kwargs)
+        finally:
+            output._speedups_serialize, base._speedups_flatten = saved
+
+
 def suite():
+    from genshi import output
+    from genshi.template import base
+
+    suite = _suite()
+    # If the C extension module is available, also run the tests without it
+    if output._speedups_serialize is not None or \
+            base._speedups_flatten is not None:
+        suite.addTest(PythonTestSuite([_suite()]))
+    return suite
+
+def _suite():
     import genshi
     from genshi.tests import builder, core, input, output, path, util
     from genshi.filters import tests as filters
@@ -12,7 +12,11 @@
 # history and logs, available at http://genshi.edgewall.org/log/.
 
 import doctest
+import os
 import pickle
+import sys
+import tempfile
+import traceback
 import unittest
 
 from genshi import core
@@ -48,6 +52,182 @@ class StreamTestCase(unittest.TestCase):
         self.assertEqual(None, xml.render(encoding=None, out=strio))
         self.assertEqual(u'<li>Über uns</li>', strio.getvalue())
 
+    def test_render_encoded_serializer(self):
+        from genshi.output import encode
+        xml = XML('<ul>%s</ul>' % ('<li title="Über">Über uns</li>' * 100))
+        for method in ('xml', 'xhtml', 'html', 'text'):
+            expected = encode(xml.serialize(method), method, 'ascii')
+            self.assertEqual(expected, xml.render(method, encoding='ascii'))
+            strio = BytesIO()
+            xml.render(method, encoding='ascii', out=strio, buffer_size=100)
+            self.assertEqual(expected, strio.getvalue())
+
+    def test_render_iter(self):
+        xml = XML('<ul>%s</ul>' % ('<li title="Über">Über uns</li>' * 1000))
+        for method in ('xml', 'xhtml', 'html', 'text'):
+            chunks = list(xml.render_iter(method, chunk_size=1000))
+            self.assertEqual(xml.render(method, encoding='utf-8'),
+                             ''.join(chunks))
+            self.assertEqual(set([str]), set([type(chunk) for chunk in chunks]))
+            self.assertTrue(len(chunks) > 5)
+            chunks = list(xml.render_iter(method, encoding=None,
+                                          chunk_size=1000))
+            self.assertEqual(xml.render(method, encoding=None),
+                             u''.join(chunks))
+            for chunk in chunks[:-1]:
+                self.assertTrue(1000 <= len(chunk) < 1100)
+
+    def test_render_iter_flush(self):
+        first, second = XML('<p>Über</p>'), XML('<p>uns</p>')
+        stream = core.Stream(list(first) + [(core.FLUSH, None, (None, -1, -1))] +
+                             list(second))
+        for method in ('xml', 'xhtml', 'html', 'text'):
+            for kwargs in ({}, {'fused': True}):
+                if method == 'text':
+                    kwargs = {}
+                for encoding in (None, 'utf-8'):
+                    self.assertEqual(
+                        [first.render(method, encoding=encoding),
+                         second.render(method, encoding=encoding)],
+                        list(stream.render_iter(method, encoding=encoding,
+                                                **kwargs)))
+
+    def test_render_async(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 200))
+        writes = []
+        class Output(object):
+            def write(self, data):
+                writes.append(data)
+        for method in ('xml', 'xhtml', 'html', 'text'):
+            for kwargs in ({}, {'fused': True}):
+                if method == 'text':
+                    kwargs = {}
+                for encoding in (None, 'utf-8'):
+                    del writes[:]
+                    steps = list(xml.render_async(Output(), method,
+                                                  encoding=encoding,
+                                                  chunk_size=512,
+                                                  **kwargs).__await__())
+                    self.assertEqual(xml.render(method, encoding=encoding),
+                                     writes[0][:0].join(writes))
+                    self.assertTrue(len(writes) > 2)
+                    # The renderer suspends after every chunk
+                    self.assertEqual([None] * len(writes), steps)
+
+    def test_render_output_buffered(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 100))
+        writes = []
+        class Output(object):
+            def write(self, data):
+                writes.append(data)
+        self.assertEqual(None, xml.render(encoding='utf-8', out=Output(),
+                                          buffer_size=512))
+        self.assertEqual(xml.render(encoding='utf-8'), ''.join(writes))
+        self.assertEqual(3, len(writes))
+        del writes[:]
+        xml.render(encoding=None, out=Output(), buffer_size=0)
+        self.assertEqual(xml.render(encoding=None), ''.join(writes))
+        self.assertEqual(302, len(writes))
+
+    def test_render_output_queued(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 100))
+        stream = core.Stream(list(xml) + [(core.FLUSH, None, (None, -1, -1))] +
+                             list(XML('<p>Über</p>')))
+        writes = []
+        class Output(object):
+            def write(self, data):
+                writes.append(data)
+            def flush(self):
+                writes.append(None)
+        for buffer_size in (512, 0):
+            del writes[:]
+            self.assertEqual(None, stream.render(encoding='utf-8',
+                                                 out=Output(),
+                                                 buffer_size=buffer_size,
+                                                 queue_size=2))
+            self.assertEqual(stream.render(encoding='utf-8'),
+                             ''.join([data for data in writes if data]))
+            self.assertEqual(None, writes[-2])
+
+    def test_render_output_queued_error(self):
+        def generate():
+            for event in XML('<ul><li>Über uns</li></ul>'):
+                yield event
+            raise ValueError('generate')
+        class Output(object):
+            def write(self, data):
+                pass
+        try:
+            core.Stream(generate()).render(encoding='utf-8', out=Output(),
+                                           queue_size=2)
+            self.fail('Expected ValueError')
+        except ValueError:
+            # The traceback includes the frames of the producing thread
+            frames = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEqual('generate', frames[-1][2])
+
+    def test_render_iter_queued(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 1000))
+        chunks = list(xml.render_iter(chunk_size=1000, queue_size=2))
+        self.assertEqual(list(xml.render_iter(chunk_size=1000)), chunks)
+
+    def test_render_iter_queued_close(self):
+        generated = []
+        def generate():
+            for idx in range(1000):
+                generated.append(idx)
+                yield core.TEXT, u'x' * 100, (None, -1, -1)
+        chunks = core.Stream(generate()).render_iter('text', chunk_size=100,
+                                                     queue_size=2)
+        self.assertEqual('x' * 100, next(chunks))
+        chunks.close()
+        # The thread stops when it finds that the iteration was stopped after
+        # putting an item in the queue
+        self.assertTrue(len(generated) < 10)
+
+    def test_render_output_big_chunks(self):
+        from genshi.output import encode
+        writes = []
+        class Output(object):
+            def write(self, data):
+                writes.append(data)
+        encode(iter([u'a', u'b' * 10, u'c', u'd' * 20]), encoding='utf-8',
+               out=Output(), buffer_size=10)
+        self.assertEqual(['a', 'b' * 10, 'c', 'd' * 20], writes)
+
+    def test_render_output_file_descriptor(self):
+        xml = XML('<ul>%s</ul>' % ('<li>Über uns</li>' * 1000))
+        fd, filename = tempfile.mkstemp()
+        try:
+            try:
+                self.assertEqual(None, xml.render(encoding='utf-8', out=fd,
+                                                  buffer_size=1000))
+            finally:
+                os.close(fd)
+            fileobj = open(filename, 'rb')
+            try:
+                self.assertEqual(xml.render(encoding='utf-8'), fileobj.read())
+            finally:
+                fileobj.close()
+        finally:
+            os.remove(filename)
+
+    def test_render_output_file_descriptor_writev(self):
+        from genshi.output import _write_fd
+        calls = []
+        written = []
+        def writev(fd, strings):
+            # Write no more than 4 bytes at a time, stopping mid-string
+            calls.append(list(strings))
+            data = ''.join(strings)[:4]
+            written.append(data)
+            return len(data)
+        strings = ['abc', 'defgh', 'ij', 'klmnopq']
+        _write_fd(42, list(strings), writev=writev)
+        self.assertEqual(''.join(strings), ''.join(written))
+        self.assertEqual([strings, ['efgh', 'ij', 'klmnopq'],
+                          ['ij', 'klmnopq'], ['mnopq'], ['q']], calls)
+
     def test_pickle(self):
         xml = XML('<li>Foo</li>')
         buf = BytesIO()
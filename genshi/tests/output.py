@@ -17,8 +17,14 @@ import sys
 
 from genshi.core import Attrs, Markup, QName, Stream
 from genshi.input import HTML, XML
+from genshi import output
+try:
+    from genshi._speedups import serialize
+except ImportError:
+    serialize = None
 from genshi.output import DocType, XMLSerializer, XHTMLSerializer, \
-                          HTMLSerializer, EmptyTagFilter
+                          HTMLSerializer, EmptyTagFilter, SerializationCache, \
+                          StaticChunk, StaticChunkFilter
 
 
 class XMLSerializerTestCase(unittest.TestCase):
@@ -202,6 +208,26 @@ class XMLSerializerTestCase(unittest.TestCase):
         output = XML(text).render(XMLSerializer, encoding=None)
         self.assertEqual(text, output)
 
+    def test_repeated_namespace_scopes(self):
+        text = """<feed xmlns="http://www.w3.org/2005/Atom">
+            <entry><id>1</id><content type="xhtml">
+                <div xmlns="http://www.w3.org/1999/xhtml"><p>One</p></div>
+            </content></entry>
+            <entry><id>2</id><content type="xhtml">
+                <div xmlns="http://www.w3.org/1999/xhtml"><p>Two</p></div>
+            </content></entry>
+            <entry><id>3</id></entry>
+        </feed>"""
+        output = XML(text).render(XMLSerializer, encoding=None)
+        self.assertEqual(text, output)
+        output = XML(text).render(XMLSerializer, encoding=None, cache=False)
+        self.assertEqual(text, output)
+
+    def test_nested_namespace_declaration(self):
+        text = """<x:a xmlns:x="http://example.org/"><x:a/><x:a/></x:a>"""
+        output = XML(text).render(XMLSerializer, encoding=None)
+        self.assertEqual(text, output)
+
 
 class XHTMLSerializerTestCase(unittest.TestCase):
 
@@ -468,12 +494,433 @@ class EmptyTagFilterTestCase(unittest.TestCase):
                          [ev[0] for ev in stream])
 
 
+class StaticChunkFilterTestCase(unittest.TestCase):
+
+    def _stream(self, before, chunk, after):
+        events = list(XML(before + '<static>%s</static>' % chunk + after))
+        start = [idx for idx, event in enumerate(events)
+                 if event[0] is Stream.START and
+                    event[1][0].localname == 'static'][0]
+        end = [idx for idx, event in enumerate(events)
+               if event[0] is Stream.END and event[1].localname == 'static'][0]
+        chunk = StaticChunk(events[start + 1:end])
+        return chunk, Stream(events[:start] +
+                             [(StaticChunkFilter.STATIC, chunk, (None, -1, -1))]
+                             + events[end + 1:])
+
+    def _assert_output(self, before, chunk, after, method='xml',
+                       prerendered=True, **kwargs):
+        expected = XML(before + chunk + after).render(method, encoding=None,
+                                                      **kwargs)
+        chunk, stream = self._stream(before, chunk, after)
+        self.assertEqual(expected, stream.render(method, encoding=None,
+                                                 **kwargs))
+        self.assertEqual(prerendered,
+                         bool([v for v in chunk.cache.values() if v]))
+
+    def test_prerendered(self):
+        self._assert_output('<div>\n  ', '<p class="a">Hello <b>&amp;</b></p>'
+                            '<hr/><!-- comment -->', '\n</div>')
+
+    def test_prerendered_html(self):
+        self._assert_output('<div>', '<p>Hello<br/></p><p/>', '</div>',
+                            method='html')
+
+    def test_prerendered_xhtml(self):
+        self._assert_output('<div>', '<p>Hello<br/></p><p/>', '</div>',
+                            method='xhtml')
+
+    def test_cache_reused(self):
+        chunk, stream = self._stream('<div>', '<p>Hello</p>', '</div>')
+        stream.render('xml')
+        output = list(chunk.cache.values())
+        self.assertEqual(1, len(output))
+        self.assertEqual('<p>Hello</p>', output[0])
+        self.assertEqual('<div><p>Hello</p></div>', stream.render('xml'))
+        self.assertEqual(output, list(chunk.cache.values()))
+
+    def test_empty_tags(self):
+        stream = XML('<elem><sub /><sub /></elem>') | \
+                 StaticChunkFilter(XMLSerializer())
+        self.assertEqual([Stream.START, EmptyTagFilter.EMPTY,
+                          EmptyTagFilter.EMPTY, Stream.END],
+                         [ev[0] for ev in stream])
+
+    def test_bound_namespace(self):
+        self._assert_output('<div xmlns:x="urn:x">', '<x:p x:a="1">Hi</x:p>',
+                            '</div>')
+
+    def test_default_namespace(self):
+        self._assert_output('<div xmlns="urn:x">', '<p><b>Hi</b></p>',
+                            '</div>')
+
+    def test_namespace_declared_in_chunk(self):
+        self._assert_output('<div>', '<p xmlns="urn:x"><b>Hi</b></p>',
+                            '</div>')
+
+    def test_undeclared_namespace(self):
+        chunk, stream = self._stream('<div>', '<x:p xmlns:x="urn:x"/>',
+                                     '</div>')
+        # Drop the namespace declaration from the chunk
+        chunk.events = chunk.events[1:-1]
+        chunk.namespaces = frozenset(['urn:x'])
+        self.assertEqual('<div><p xmlns="urn:x"/></div>', stream.render('xml'))
+        self.assertEqual({}, chunk.cache)
+
+    def test_preserved_whitespace(self):
+        self._assert_output('<div><pre>', '<b>a  \n\n\nb</b>', '</pre></div>',
+                            method='xhtml')
+
+    def test_preserved_whitespace_in_chunk(self):
+        self._assert_output('<div>', '<pre>a  \n\n\nb</pre>', '</div>',
+                            method='xhtml', prerendered=False)
+
+    def test_preserved_whitespace_no_strip(self):
+        self._assert_output('<div>', '<pre>a  \n\n\nb</pre>', '</div>',
+                            method='xhtml', strip_whitespace=False)
+
+    def test_script(self):
+        self._assert_output('<div><script>', '<b>a &lt; b</b>',
+                            '</script></div>', method='html',
+                            prerendered=False)
+
+    def test_cdata(self):
+        chunk, stream = self._stream('<div>', '<b>a &lt; b</b>', '</div>')
+        pos = (None, -1, -1)
+        stream = Stream(stream.events[:1] +
+                        [(Stream.START_CDATA, None, pos)] +
+                        stream.events[1:-1] +
+                        [(Stream.END_CDATA, None, pos)] +
+                        stream.events[-1:])
+        self.assertEqual('<div><![CDATA[<b>a < b</b>]]></div>',
+                         stream.render('xml'))
+        self.assertEqual({}, chunk.cache)
+
+
+class SerializationCacheTestCase(unittest.TestCase):
+
+    def test_shared_between_renders(self):
+        cache = SerializationCache()
+        stream = XML('<ul><li class="a">1</li><li class="a">2</li></ul>')
+        self.assertEqual('<ul><li class="a">1</li><li class="a">2</li></ul>',
+                         stream.render('xml', encoding=None, cache=cache))
+        self.assertEqual((0, 4), (cache.hits, cache.misses))
+        self.assertEqual('<ul><li class="a">1</li><li class="a">2</li></ul>',
+                         stream.render('xml', encoding=None, cache=cache))
+        self.assertEqual((4, 4), (cache.hits, cache.misses))
+        self.assertEqual(4, cache.size)
+        self.assertEqual(0.5, cache.hit_rate)
+
+    def test_keyed_by_serializer(self):
+        cache = SerializationCache()
+        stream = XML('<div><br/><hr noshade="noshade"/></div>')
+        self.assertEqual('<div><br/><hr noshade="noshade"/></div>',
+                         stream.render('xml', encoding=None, cache=cache))
+        self.assertEqual('<div><br /><hr noshade="noshade" /></div>',
+                         stream.render('xhtml', encoding=None, cache=cache))
+        self.assertEqual('<div><br><hr noshade></div>',
+                         stream.render('html', encoding=None, cache=cache))
+        self.assertEqual(0, cache.hits)
+
+    def test_text_not_cached(self):
+        cache = SerializationCache()
+        stream = XML('<p>a &lt; b</p>')
+        for i in range(2):
+            self.assertEqual('<p>a &lt; b</p>',
+                             stream.render('html', encoding=None, cache=cache,
+                                           strip_whitespace=False))
+        self.assertEqual(2, cache.size)
+
+    def test_script_escaping(self):
+        cache = SerializationCache()
+        stream = XML('<div><script>if (1 &lt; 2) {}</script>1 &lt; 2</div>')
+        for i in range(2):
+            self.assertEqual('<div><script>if (1 < 2) {}</script>1 &lt; 2'
+                             '</div>',
+                             stream.render('html', encoding=None, cache=cache,
+                                           strip_whitespace=False))
+
+    def test_capacity(self):
+        cache = SerializationCache(3)
+        stream = XML('<a><b><c><d/></c></b></a>')
+        stream.render('xml', cache=cache)
+        self.assertEqual(3, cache.size)
+        self.assertEqual(0, cache.hits)
+        stream.render('xml', cache=cache)
+        self.assertEqual(3, cache.size)
+        self.assertEqual(0, cache.hits)
+
+    def test_clear(self):
+        cache = SerializationCache()
+        XML('<a/>').render('xml', cache=cache)
+        cache.clear()
+        self.assertEqual((0, 0, 0), (cache.size, cache.hits, cache.misses))
+        self.assertEqual(0.0, cache.hit_rate)
+
+    def test_threads(self):
+        import threading
+        cache = SerializationCache(50)
+        stream = XML('<table>%s</table>' % ''.join([
+            '<tr class="r%d"><td>%d</td></tr>' % (i % 30, i)
+            for i in range(200)
+        ]))
+        expected = stream.render('xhtml', encoding=None)
+        results = []
+        def render():
+            for i in range(5):
+                results.append(stream.render('xhtml', encoding=None,
+                                             cache=cache))
+        threads = [threading.Thread(target=render) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([expected] * 20, results)
+        # The shared cache is only consulted once per tag and serialization
+        self.assertEqual(20 * 35, cache.hits + cache.misses)
+
+
+def _mixed_events():
+    pos = (None, -1, -1)
+    return [
+        (Stream.XML_DECL, ('1.0', 'utf-8', 1), pos),
+        (Stream.DOCTYPE, ('html', '-//W3C//DTD <X> "1"', None), pos),
+        (Stream.XML_DECL, ('1.0', None, -1), pos),
+        (Stream.DOCTYPE, DocType.HTML5, pos),
+        (Stream.PI, ('php', 'echo "<x>"'), pos),
+    ] + list(XML(u'''<html xmlns="http://www.w3.org/1999/xhtml"
+                            xml:lang="de">
+      <!-- a <comment> -->
+      <head><script>if (a &lt; b &amp;&amp; c) {}</script></head>
+      <body xml:space="preserve">
+        <p lang="en" xml:lang="en" title="&quot;q&quot; &amp; &lt;a&gt;">
+          Döner &amp; Bier <br/><hr noshade="noshade"/><div/>
+        </p>
+        <p lang="en" xml:lang="en" title="&quot;q&quot; &amp; &lt;a&gt;">
+          Döner &amp; Bier <br/><hr noshade="noshade"/><div/>
+        </p>
+        <select multiple="" disabled="disabled" xmlns:x="urn:x"
+                x:y="z"><option selected="">1</option></select>
+      </body>
+    </html>''')) + [
+        (Stream.START_CDATA, None, pos),
+        (Stream.TEXT, u'a < b', pos),
+        (Stream.END_CDATA, None, pos),
+        (Stream.TEXT, u'a < b', pos),
+        (Stream.TEXT, Markup(u'<b>markup</b>'), pos),
+    ]
+
+
+class SpeedupsSerializerTestCase(unittest.TestCase):
+    """Compares the output of the C and pure-Python implementations of the
+    serializers.
+    """
+
+    def _assert_same_output(self, stream, method, **kwargs):
+        serializer = output.get_serializer(method, **kwargs)
+        saved = output._speedups_serialize
+        try:
+            output._speedups_serialize = None
+            expected = list(serializer(stream))
+            output._speedups_serialize = serialize
+            actual = list(serializer(stream))
+        finally:
+            output._speedups_serialize = saved
+        self.assertEqual(expected, actual)
+        self.assertEqual([type(chunk) for chunk in expected],
+                         [type(chunk) for chunk in actual])
+
+    def test_xml(self):
+        for cache in (True, False):
+            self._assert_same_output(_mixed_events(), 'xml', cache=cache)
+
+    def test_xml_no_strip(self):
+        self._assert_same_output(_mixed_events(), 'xml',
+                                 strip_whitespace=False)
+
+    def test_xhtml(self):
+        for cache in (True, False):
+            self._assert_same_output(_mixed_events(), 'xhtml', cache=cache)
+
+    def test_xhtml_with_xml_decl(self):
+        self._assert_same_output(_mixed_events(), 'xhtml',
+                                 drop_xml_decl=False)
+
+    def test_html(self):
+        self._assert_same_output(_mixed_events(), 'html')
+
+    def test_html_no_strip(self):
+        self._assert_same_output(_mixed_events(), 'html',
+                                 strip_whitespace=False)
+
+    def test_shared_cache(self):
+        for method in ('xml', 'xhtml', 'html'):
+            self._assert_same_output(_mixed_events(), method,
+                                     cache=SerializationCache())
+
+    def test_encoding(self):
+        for method in ('xml', 'xhtml', 'html'):
+            self._assert_same_output(_mixed_events(), method, encoding='ascii')
+
+    def test_flush(self):
+        events = _mixed_events()
+        events.insert(len(events) // 2, (Stream.FLUSH, None, (None, -1, -1)))
+        for method in ('xml', 'xhtml', 'html'):
+            for encoding in (None, 'ascii'):
+                self._assert_same_output(events, method, encoding=encoding)
+
+    def test_attribute_values(self):
+        pos = (None, -1, -1)
+        events = [(Stream.START, (QName('p'), Attrs([(QName('a'), 1),
+                                                     (QName('b'), 0),
+                                                     (QName('c'), None),
+                                                     (QName('checked'), 0)])),
+                   pos),
+                  (Stream.END, QName('p'), pos)]
+        for method in ('xml', 'xhtml', 'html'):
+            self._assert_same_output(events, method)
+
+    def test_invalid_event(self):
+        for method in ('xml', 'xhtml', 'html'):
+            serializer = output.get_serializer(method)
+            self.assertRaises(ValueError, list,
+                              serializer._serialize([(Stream.TEXT, u'a')]))
+            self.assertRaises(ValueError, list,
+                              serialize([(Stream.TEXT, u'a')], method))
+
+
+class FusedSerializerTestCase(unittest.TestCase):
+    """Compares the output of the fused serialization loop with that of the
+    filters and serializers it replaces.
+    """
+
+    def _assert_same_output(self, stream, method, **kwargs):
+        stream = list(stream)
+        # The text output cached by the serializers doesn't take into account
+        # whether the text is in a CDATA section
+        serializer = output.get_serializer(method, **dict(kwargs, cache=False))
+        expected = list(serializer(stream))
+        serializer = output.get_serializer(method, fused=True, **kwargs)
+        actual = list(serializer(stream))
+        self.assertEqual(u''.join(expected), u''.join(actual))
+        self.assertEqual(set([Markup]), set([type(chunk) for chunk in actual]))
+
+    def test_xml(self):
+        for cache in (True, False):
+            self._assert_same_output(_mixed_events(), 'xml', cache=cache)
+
+    def test_xml_no_strip(self):
+        self._assert_same_output(_mixed_events(), 'xml',
+                                 strip_whitespace=False)
+
+    def test_xhtml(self):
+        for cache in (True, False):
+            self._assert_same_output(_mixed_events(), 'xhtml', cache=cache)
+
+    def test_xhtml_with_xml_decl(self):
+        self._assert_same_output(_mixed_events(), 'xhtml',
+                                 drop_xml_decl=False)
+
+    def test_html(self):
+        self._assert_same_output(_mixed_events(), 'html')
+
+    def test_html_no_strip(self):
+        self._assert_same_output(_mixed_events(), 'html',
+                                 strip_whitespace=False)
+
+    def test_doctype(self):
+        for method in ('xml', 'xhtml', 'html'):
+            for events in ([], _mixed_events(), _mixed_events()[2:],
+                           list(XML('<html><p/></html>'))):
+                self._assert_same_output(events, method, doctype='html5')
+
+    def test_namespaces(self):
+        text = """<feed xmlns="http://www.w3.org/2005/Atom" xml:lang="en">
+            <entry><title type="xhtml">
+                <div xmlns="http://www.w3.org/1999/xhtml">Example</div>
+            </title></entry>
+            <entry><title type="xhtml">
+                <div xmlns="http://www.w3.org/1999/xhtml">Example</div>
+            </title></entry>
+            <x:a xmlns:x="urn:x" x:b="c"><x:d/></x:a>
+            <x:a xmlns:x="urn:x"><x:a/><x:a/></x:a>
+        </feed>"""
+        events = list(XML(text))
+        events.insert(3, (Stream.START, (QName('urn:y}e'),
+                                         Attrs([(QName('urn:z}f'), 'g')])),
+                          (None, -1, -1)))
+        events.insert(4, (Stream.END, QName('urn:y}e'), (None, -1, -1)))
+        for method in ('xml', 'xhtml'):
+            self._assert_same_output(events, method)
+        self._assert_same_output(events, 'xml',
+                                 namespace_prefixes={'urn:z': 'z'})
+
+    def test_static_chunks(self):
+        from genshi.template import MarkupTemplate
+        tmpl = MarkupTemplate("""<html xmlns="http://www.w3.org/1999/xhtml"
+                                       xmlns:py="http://genshi.edgewall.org/">
+          <ul py:for="item in items">
+            <li class="item">${item}</li>
+            <li><b>static</b> <br/></li>
+          </ul>
+          <pre py:if="True">  <b>a  </b>  
+
+
+</pre>
+          <script>if (a &lt; b) {}</script>
+        </html>""")
+        for method in ('xml', 'xhtml', 'html'):
+            for strip_whitespace in (True, False):
+                self._assert_same_output(tmpl.generate(items=[1, '<2>']),
+                                         method,
+                                         strip_whitespace=strip_whitespace)
+
+    def test_encoding(self):
+        from genshi.template import MarkupTemplate
+        tmpl = MarkupTemplate(u"""<html xmlns:py="http://genshi.edgewall.org/">
+          <p py:for="item in items" title="\u2603">\xfcber ${item}</p>
+          <div><b>static \xfcber</b> <br/></div>
+        </html>""")
+        for method in ('xml', 'xhtml', 'html'):
+            for strip_whitespace in (True, False):
+                serializer = output.get_serializer(
+                    method, strip_whitespace=strip_whitespace, cache=False)
+                expected = u''.join(serializer(tmpl.generate(items=[1, 2])))
+                serializer = output.get_serializer(
+                    method, strip_whitespace=strip_whitespace, fused=True,
+                    encoding='ascii')
+                for idx in range(2):
+                    actual = list(serializer(tmpl.generate(items=[1, 2])))
+                    self.assertEqual(expected.encode('ascii',
+                                                     'xmlcharrefreplace'),
+                                     ''.join(actual))
+                    self.assertEqual(set([str]),
+                                     set([type(chunk) for chunk in actual]))
+
+    def test_encoding_xml_decl(self):
+        stream = Stream([(Stream.XML_DECL, ('1.0', 'iso-8859-1', -1), None),
+                         (Stream.TEXT, u'\u20ac', None)])
+        serializer = output.get_serializer('xml', fused=True, encoding='utf-8')
+        self.assertEqual('<?xml version="1.0" encoding="iso-8859-1"?>\n'
+                         '\xe2\x82\xac', ''.join(serializer(stream)))
+
+    def test_custom_filters(self):
+        serializer = output.get_serializer('xml', fused=True)
+        serializer.filters.insert(1, lambda stream: XML('<b/>'))
+        self.assertEqual('<b></b>', ''.join(serializer(XML('<a/>'))))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(XMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(XHTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(HTMLSerializerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(EmptyTagFilterTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(StaticChunkFilterTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SerializationCacheTestCase, 'test'))
+    if serialize is not None:
+        suite.addTest(unittest.makeSuite(SpeedupsSerializerTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(FusedSerializerTestCase, 'test'))
     suite.addTest(doctest.DocTestSuite(XMLSerializer.__module__))
     return suite
 
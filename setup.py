@@ -144,6 +144,9 @@ feature is a template language, which is heavily inspired by Kid.""",
         'plugin': ['setuptools>=0.6a2']
     },
     entry_points = """
+    [console_scripts]
+    genshi-bundle = genshi.template.bundle:main
+    
     [babel.extractors]
     genshi = genshi.filters.i18n:extract[i18n]
     